@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Cache compression benchmark: disk size versus CPU time of the `cache_compression` methods.
+
+Usage:
+
+    python benchmarks/cache_compression.py [--diagrams N] [--size KB] [--format svg|txt]
+
+Saves N synthetic diagrams, looking like PlantUML sequence diagrams, in a `directory` cache without compression and
+with every compression method, then reads them back, and prints the size on disk and the write and read times.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from plantuml_markdown.cache import COMPRESSION_METHODS, CompressedCache, DirectoryCache  # noqa: E402
+
+WORDS = ['request', 'response', 'validate', 'store', 'notify', 'user', 'order', 'payment', 'retry', 'cache']
+
+
+def svg_diagram(rnd: random.Random, size: int) -> bytes:
+    parts = ['<?xml version="1.0" encoding="us-ascii" standalone="no"?><svg xmlns="http://www.w3.org/2000/svg" '
+             'xmlns:xlink="http://www.w3.org/1999/xlink" contentScriptType="application/ecmascript" '
+             'contentStyleType="text/css" preserveAspectRatio="none" version="1.1"><defs/><g>']
+    y = 20
+    while sum(map(len, parts)) < size:
+        x1, x2 = rnd.randrange(20, 400), rnd.randrange(20, 400)
+        label = ' '.join(rnd.choice(WORDS) for _ in range(3))
+        parts.append(f'<line style="stroke:#181818;stroke-width:1.0;" x1="{x1}" x2="{x2}" y1="{y}" y2="{y}"/>'
+                     f'<polygon fill="#181818" points="{x2},{y},{x2 - 10},{y - 4},{x2 - 6},{y},{x2 - 10},{y + 4}" '
+                     f'style="stroke:#181818;stroke-width:1.0;"/>'
+                     f'<text fill="#000000" font-family="sans-serif" font-size="13" lengthAdjust="spacing" '
+                     f'textLength="{len(label) * 7}" x="{min(x1, x2) + 7}" y="{y - 5}">{label}</text>')
+        y += 30
+    parts.append('</g></svg>')
+    return ''.join(parts).encode('ascii')
+
+
+def txt_diagram(rnd: random.Random, size: int) -> bytes:
+    lines = []
+    while sum(map(len, lines)) < size:
+        label = ' '.join(rnd.choice(WORDS) for _ in range(2))
+        lines.append(f'     |{label:^30}|          |\n     |------------------------------>|\n')
+    return ''.join(lines).encode('ascii')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--diagrams', type=int, default=500, help='diagrams saved (default 500)')
+    parser.add_argument('--size', type=float, default=30, help='diagram size in KB (default 30)')
+    parser.add_argument('--format', choices=['svg', 'txt'], default='svg', help='diagrams format (default svg)')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    build = svg_diagram if args.format == 'svg' else txt_diagram
+    diagrams = {f'{n:08x}.{args.format}': build(rnd, int(args.size * 1024)) for n in range(args.diagrams)}
+    raw_size = sum(map(len, diagrams.values()))
+
+    for method in [None] + list(COMPRESSION_METHODS):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = CompressedCache(DirectoryCache(cache_dir), {args.format: method} if method else {})
+            start = time.perf_counter()
+            for name, data in diagrams.items():
+                cache.put(name, data)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for name, data in diagrams.items():
+                assert cache.get(name) == data, f'{name}: different data read back'
+            read_time = time.perf_counter() - start
+
+            disk_size = sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+        finally:
+            shutil.rmtree(cache_dir)
+
+        print(f'{method or "none":5} {disk_size / 1024 / 1024:8.2f} MB on disk ({disk_size / raw_size:6.1%}), '
+              f'write {write_time / args.diagrams * 1000:6.3f} ms/diagram, '
+              f'read {read_time / args.diagrams * 1000:6.3f} ms/diagram')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Downstream processing benchmark: time spent by the Markdown processors running after the plugin, by image size.
+
+Usage:
+
+    python benchmarks/downstream.py [--sizes MB,MB,...] [--paragraphs N] [--runs N]
+
+Converts a page with some prose and a cached PNG diagram of growing size, and prints the time of the conversion
+without the plugin preprocessor, with the diagram tags stashed (as the plugin does) and with the tags left raw in the
+text (as done before): raw tags are scanned by every later block and inline processor, stashed tags are not.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import markdown  # noqa: E402
+
+from plantuml_markdown.plantuml_markdown import RenderContext, RenderManifest  # noqa: E402
+
+CODE = 'A -> B\n'
+PARAGRAPH = 'Some *emphasis*, a [link](https://plantuml.com), `code` and __strong__ text.\n\n'
+
+
+def downstream_time(md: markdown.Markdown, text: str, raw: bool, runs: int) -> float:
+    """
+    Returns the best conversion time, without the time of the plugin preprocessor.
+    """
+    preprocessor = md.preprocessors['plantuml']
+    run = preprocessor.run
+    spent = []
+
+    def timed_run(lines):
+        start = time.perf_counter()
+        lines = run(lines)
+        if raw:
+            # the tags are put back in the text, as before stashing them
+            html = RenderManifest.PLACEHOLDER_RE.sub(lambda m: md.htmlStash.rawHtmlBlocks[int(m.group(1))],
+                                                     '\n'.join(lines))
+            lines = html.split('\n')
+        spent.append(time.perf_counter() - start)
+        return lines
+
+    preprocessor.run = timed_run
+    best = None
+    try:
+        for _ in range(runs):
+            spent.clear()
+            start = time.perf_counter()
+            md.reset().convert(text)
+            elapsed = time.perf_counter() - start - sum(spent)
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        preprocessor.run = run
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='0.1,1,4,16', help='image sizes in MB (default 0.1,1,4,16)')
+    parser.add_argument('--paragraphs', type=int, default=50, help='paragraphs around the diagram (default 50)')
+    parser.add_argument('--runs', type=int, default=3, help='time measures (default 3)')
+    args = parser.parse_args()
+
+    text = PARAGRAPH * args.paragraphs + f'```uml\n{CODE}```\n\n' + PARAGRAPH * args.paragraphs
+    cache_dir = tempfile.mkdtemp()
+    try:
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'cachedir': cache_dir, 'format': 'png',
+                                                                        'image_maps': False}})
+        preprocessor = md.preprocessors['plantuml']
+        preprocessor._local.context = RenderContext()
+        name = preprocessor._diagram_key(CODE) + '.png'
+        preprocessor._local.context = None
+
+        for size in (float(size) for size in args.sizes.split(',')):
+            with open(os.path.join(cache_dir, name), 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(int(size * 1024 * 1024)))
+            raw_time = downstream_time(md, text, True, args.runs)
+            stashed_time = downstream_time(md, text, False, args.runs)
+            print(f'{size:6.1f} MB image: raw tags {raw_time * 1000:9.2f} ms, stashed tags {stashed_time * 1000:7.2f} ms')
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Image tags benchmark: time and memory needed to build the tags of large data URI images.
+
+Usage:
+
+    python benchmarks/image_tags.py [--size MB] [--runs N]
+
+Builds the `img` tag of a PNG image, the `picture` tag of a PNG image with its dark variant and the `object` tag of a
+SVG image, with the plugin and with the `ElementTree` serializer used before, and prints the time and the memory peak
+(measured with `tracemalloc`) of both, checking that the output is the same.
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import tracemalloc
+from xml.etree import ElementTree as etree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import markdown  # noqa: E402
+
+from plantuml_markdown.plantuml_markdown import RenderContext  # noqa: E402
+
+OPTIONS = {'classes': 'uml', 'alt': 'uml diagram', 'title': 'a "large" diagram', 'width': None, 'height': None,
+           'id': None}
+
+
+def etree_tag(tag: str, attrib: dict, short_empty_elements: bool = True) -> str:
+    element = etree.Element(tag)
+    element.attrib.update(attrib)
+    return etree.tostring(element, short_empty_elements=short_empty_elements).decode()
+
+
+def etree_png(diagram: bytes) -> str:
+    return etree_tag('img', {'src': 'data:image/png;base64,{0}'.format(base64.b64encode(diagram).decode('ascii')),
+                             'class': OPTIONS['classes'], 'alt': OPTIONS['alt'], 'title': OPTIONS['title']})
+
+
+def etree_picture(diagram: bytes) -> str:
+    source = etree_tag('source', {'media': '(prefers-color-scheme: dark)',
+                                  'srcset': 'data:image/png;base64,{0}'.format(
+                                      base64.b64encode(diagram).decode('ascii'))})
+    return '<picture>' + source + etree_png(diagram) + '</picture>'
+
+
+def etree_object(diagram: bytes) -> str:
+    return etree_tag('object', {'data': 'data:image/svg+xml;base64,{0}'.format(
+        base64.b64encode(diagram).decode('ascii')), 'class': OPTIONS['classes'], 'alt': OPTIONS['alt'],
+        'title': OPTIONS['title']}, short_empty_elements=False)
+
+
+def measure(build, diagram: bytes, runs: int):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        build(diagram)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    out = build(diagram)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=4, help='image size in MB (default 4)')
+    parser.add_argument('--runs', type=int, default=5, help='time measures (default 5)')
+    args = parser.parse_args()
+
+    md = markdown.Markdown(extensions=['plantuml_markdown'])
+    preprocessor = md.preprocessors['plantuml']
+    preprocessor._local.context = RenderContext()
+    diagram = os.urandom(int(args.size * 1024 * 1024))
+    mb = len(diagram) / 1024 / 1024
+
+    cases = [
+        ('png img', etree_png, lambda data: preprocessor._png_image(data, OPTIONS, '')),
+        ('png picture', etree_picture, lambda data: preprocessor._png_image(data, OPTIONS, '', data)),
+        ('svg object', etree_object, lambda data: preprocessor._svg_object_image(data, OPTIONS)),
+    ]
+    for name, before, after in cases:
+        expected, before_time, before_peak = measure(before, diagram, args.runs)
+        out, after_time, after_peak = measure(after, diagram, args.runs)
+        assert out == expected, f'{name}: different output'
+        print(f'{name:12} ElementTree {before_time * 1000:8.2f} ms {before_peak / len(diagram):5.1f}x memory, '
+              f'plugin {after_time * 1000:8.2f} ms {after_peak / len(diagram):5.1f}x memory '
+              f'({mb / after_time:.0f} MB/s)')
+
+
+if __name__ == '__main__':
+    main()
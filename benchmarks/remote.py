@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Remote rendering benchmark, against local stand-in PlantUML/Kroki servers.
+
+Usage:
+
+    python benchmarks/remote.py [--diagrams N] [--servers N] [--kroki] [--latency S] [--error-rate R]
+                                [--throttle-rate R] [--drop-rate R] [--rate N]
+
+Converts a page with N distinct diagrams, without cache, using stand-in servers (see
+`plantuml_markdown/stand_in_server.py`) with the given latency and failure rates, and prints the conversion time and
+what every server has seen. Failures are injected only in the first server, so the others are used for failover.
+"""
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import markdown  # noqa: E402
+
+from plantuml_markdown.stand_in_server import StandInServer  # noqa: E402
+
+
+def page(diagrams: int) -> str:
+    return '\n'.join(f'## Diagram {n}\n\n```uml\nA --> B: message {n}\n```\n' for n in range(diagrams))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--diagrams', type=int, default=200, help='diagrams in the page (default 200)')
+    parser.add_argument('--servers', type=int, default=2, help='stand-in servers (default 2)')
+    parser.add_argument('--kroki', action='store_true', help='use Kroki servers')
+    parser.add_argument('--format', default='svg', help='diagrams format (default svg)')
+    parser.add_argument('--latency', type=float, default=0.01, help='server latency in seconds (default 0.01)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='HTTP 500 rate of the first server')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='HTTP 429 rate of the first server')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='dropped connections rate of the first server')
+    parser.add_argument('--rate', type=float, default=0, help='client side rate limit of the first server')
+    args = parser.parse_args()
+
+    servers = [StandInServer(kroki=args.kroki, latency=args.latency, error_rate=args.error_rate,
+                             throttle_rate=args.throttle_rate, drop_rate=args.drop_rate, retry_after=0.1)]
+    servers += [StandInServer(kroki=args.kroki, latency=args.latency) for _ in range(args.servers - 1)]
+    for server in servers:
+        server.start()
+
+    try:
+        urls = [{'url': server.url, 'kroki': args.kroki} for server in servers]
+        if args.rate:
+            urls[0]['rate'] = args.rate
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'servers': urls, 'format': args.format}})
+        text = page(args.diagrams)
+
+        start = time.perf_counter()
+        html = md.convert(text)
+        elapsed = time.perf_counter() - start
+    finally:
+        for server in servers:
+            server.stop()
+
+    print(f'{args.diagrams} diagrams in {elapsed:.2f} s, {elapsed / args.diagrams * 1000:.1f} ms/diagram, '
+          f'{html.count("color: red")} errors')
+    for n, server in enumerate(servers):
+        print(f'server {n}: ' + ' '.join(f'{name}={value}' for name, value in server.stats.items()))
+
+
+if __name__ == '__main__':
+    main()
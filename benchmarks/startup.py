@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Startup benchmark: import time of the extension and setup cost for pages without diagrams.
+
+Usage:
+
+    python benchmarks/startup.py [--pages N] [--imports N]
+
+The import time is measured in fresh interpreters, and compared with the import time of `markdown` alone. The page
+cost is measured running the extension preprocessor alone on a page without diagrams, then converting pages with and
+without the extension, with the same `Markdown` instance (like `markdown_py` does) and with a new instance for every
+page (like MkDocs does).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import markdown  # noqa: E402
+
+IMPORT_SNIPPET = '''
+import sys, time
+t = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t
+print(elapsed, ','.join(m for m in ('requests', 'urllib3', 'uuid', 'sqlite3') if m in sys.modules))
+'''
+
+PAGE = '''# A page without diagrams
+
+Some text with a [link](https://plantuml.com), **bold** and `code`.
+
+* a list item
+* another list item
+
+```python
+print("a code block")
+```
+''' * 10
+
+CONFIG = {
+    'plantuml_markdown': {
+        'servers': ['https://www.plantuml.com/plantuml', 'https://kroki.io'],
+        'base_dir': ['.', 'docs', 'includes'],
+        'cachedir': os.path.join(os.path.dirname(HERE), '.bench-cache'),
+    }
+}
+
+
+def import_time(module: str, runs: int):
+    times = []
+    loaded = ''
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)], cwd=os.path.dirname(HERE),
+                             check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(out[0]))
+        loaded = out[1] if len(out) > 1 else ''
+    return statistics.median(times), loaded
+
+
+def page_time(pages: int, extensions, configs, new_instance: bool, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        md = markdown.Markdown(extensions=extensions, extension_configs=configs)
+        start = time.perf_counter()
+        for _ in range(pages):
+            if new_instance:
+                md = markdown.Markdown(extensions=extensions, extension_configs=configs)
+            md.reset().convert(PAGE)
+        elapsed = (time.perf_counter() - start) / pages
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def preprocessor_time(pages: int, repeat: int = 3) -> float:
+    md = markdown.Markdown(extensions=['plantuml_markdown'], extension_configs=CONFIG)
+    preprocessor = md.preprocessors['plantuml']
+    lines = PAGE.split('\n')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(pages):
+            preprocessor.run(lines)
+        elapsed = (time.perf_counter() - start) / pages
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=500, help='pages to convert (default 500)')
+    parser.add_argument('--imports', type=int, default=5, help='import measures (default 5)')
+    args = parser.parse_args()
+
+    base, _ = import_time('markdown', args.imports)
+    ext, loaded = import_time('plantuml_markdown', args.imports)
+    print(f'import markdown                  {base * 1000:8.2f} ms')
+    print(f'import plantuml_markdown         {ext * 1000:8.2f} ms (modules loaded: {loaded or "none of them"})')
+
+    print(f'plantuml preprocessor alone      {preprocessor_time(args.pages * 10) * 1e6:8.2f} us/page')
+
+    for new_instance in (False, True):
+        label = 'new Markdown per page' if new_instance else 'same Markdown        '
+        without = page_time(args.pages, ['fenced_code'], {}, new_instance)
+        with_ext = page_time(args.pages, ['fenced_code', 'plantuml_markdown'], CONFIG, new_instance)
+        print(f'{label}            {without * 1e6:8.1f} us/page without extension, '
+              f'{with_ext * 1e6:8.1f} us/page with extension ({(with_ext - without) * 1e6:+.1f} us)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,894 @@
+#!/usr/bin/env python
+"""
+   Diagram cache support for the [PlantUML][] extension
+   ===================================================
+
+   Rendered diagrams are cached in a backend, selected with the `cache_backend` option:
+
+   * `directory` (default): every diagram is saved in its own file, named `<hash>.<format>`, in the `cachedir` folder
+   * `sqlite`: all diagrams are saved in a single SQLite database, `cachedir/diagrams.sqlite`
+   * `http`: diagrams are read and saved with `GET` and `PUT` requests on a plain HTTP object store, at the `cachedir`
+     url, so that a diagram rendered on one CI runner is found by all the others
+   * a `module:Class` reference to a subclass of `CacheBackend`, built with the value of `cachedir`
+
+   Moving tens of thousands of small files between CI nodes is slow, so this module can also pack a cache directory
+   into a single indexed file and unpack it again:
+
+      plantuml-markdown-cache export <cachedir> <pack file>
+      plantuml-markdown-cache import <pack file> <cachedir>
+      plantuml-markdown-cache list <pack file>
+
+   The extension can also read a pack directly (option `cache_pack`), using a memory-mapping of the file and the offset
+   index stored at its end, so a freshly provisioned machine has a warm cache without unpacking anything.
+
+   The `cachedir` option can also be a list of layers, searched in order: for example a local read-write directory
+   first, then a read-only team cache populated by CI. New diagrams are saved in the first writable layer, and diagrams
+   found in a lower layer can be copied there (option `cache_promote`).
+
+   Text diagrams (`svg`, `txt` and `map`) can be saved compressed (option `cache_compression`), with any backend.
+   Compressed entries start with COMPRESSED_MAGIC and the id of the compression method, so uncompressed entries written
+   by older versions, or with another configuration, are still read.
+
+   Pack layout (all integers are little endian):
+
+      header   MAGIC (8 bytes), format version (uint32), reserved (uint32)
+      data     the content of every entry, one after the other
+      index    for every entry: name length (uint16), name (utf-8), offset (uint64), length (uint64)
+      footer   index offset (uint64), number of entries (uint32), MAGIC (8 bytes)
+
+   [PlantUML]: https://plantuml.com
+"""
+
+import atexit
+import importlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+if TYPE_CHECKING:
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+logger = logging.getLogger('MARKDOWN')
+
+PACK_MAGIC = b'PUMLPACK'
+PACK_VERSION = 1
+
+_HEADER = struct.Struct('<8sII')
+_INDEX_ENTRY = struct.Struct('<QQ')
+_NAME_LEN = struct.Struct('<H')
+_FOOTER = struct.Struct('<QI8s')
+
+# no diagram starts with a NUL byte
+COMPRESSED_MAGIC = b'\x00PUMLZ'
+# compression methods, by name, and their id written after the magic
+COMPRESSION_METHODS = {'zlib': b'z', 'gzip': b'g', 'lzma': b'x'}
+# formats of the text diagrams
+TEXT_FORMATS = ('svg', 'txt', 'map')
+
+
+def valid_entry_name(name: str) -> bool:
+    """
+    Checks that an entry name, read from a pack, is a plain file name that cannot point outside the cache directory.
+    """
+    return bool(name) and name not in ('.', '..') and os.path.basename(name) == name and \
+        not os.path.isabs(name) and '/' not in name and '\\' not in name and '\0' not in name
+
+
+def compress_entry(data: bytes, method: str) -> bytes:
+    """
+    Compresses an entry with `zlib`, `gzip` or `lzma`, adding the header recognized by `decompress_entry`.
+    """
+    if method == 'zlib':
+        packed = zlib.compress(data, 9)
+    elif method == 'gzip':
+        import gzip
+        packed = gzip.compress(data, 9, mtime=0)
+    elif method == 'lzma':
+        import lzma
+        packed = lzma.compress(data)
+    else:
+        raise ValueError(f'[plantuml_markdown] Unknown cache compression: {method}')
+    return COMPRESSED_MAGIC + COMPRESSION_METHODS[method] + packed
+
+
+def decompress_entry(data: bytes) -> bytes:
+    """
+    Decompresses an entry written by `compress_entry`; other entries are returned as they are.
+    """
+    if data[:len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+        return data
+    method_id = data[len(COMPRESSED_MAGIC):len(COMPRESSED_MAGIC) + 1]
+    packed = data[len(COMPRESSED_MAGIC) + 1:]
+    if method_id == COMPRESSION_METHODS['zlib']:
+        return zlib.decompress(packed)
+    elif method_id == COMPRESSION_METHODS['gzip']:
+        import gzip
+        return gzip.decompress(packed)
+    elif method_id == COMPRESSION_METHODS['lzma']:
+        import lzma
+        return lzma.decompress(packed)
+    raise ValueError(f'Unknown compression of cache entry: {method_id!r}')
+
+
+def compression_config(value) -> Dict[str, str]:
+    """
+    Parses the `cache_compression` option: a method for all the text formats, or a mapping from format to method.
+
+    Returns:
+        Dict[str, str]: The compression method, by format.
+    """
+    if not value:
+        return {}
+    if isinstance(value, str):
+        value = dict.fromkeys(TEXT_FORMATS, value)
+    config = {fmt.strip(): method.strip().lower() for fmt, method in value.items() if method}
+    for method in config.values():
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f'[plantuml_markdown] Unknown cache compression: {method}')
+    return config
+
+
+class CacheBackend:
+    """
+    Base class for the diagram cache backends.
+
+    Entries are identified by name, the same name of the file in the `directory` backend (ex: `0a1b2c3d.png`).
+    Backends may buffer writes, which are saved at the latest when `flush` is called at the end of each document.
+    """
+    read_only = False
+
+    def get(self, name: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, bytes]:
+        """
+        Reads several entries at once.
+
+        Returns:
+            Dict[str, bytes]: The found entries, by name; missing entries are not included.
+        """
+        found = {}
+        for name in names:
+            data = self.get(name)
+            if data is not None:
+                found[name] = data
+        return found
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        """
+        Saves an entry.
+
+        Args:
+            name (str): The entry name.
+            data (bytes): The entry content.
+            render_time (Optional[float]): Seconds spent rendering the diagram, if known.
+            backend (Optional[str]): What has rendered the diagram (a server url or `local`), if known.
+        """
+        raise NotImplementedError
+
+    def delete(self, name: str):
+        """
+        Removes an entry, if present; backends not supporting it keep the entry.
+        """
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class DirectoryCache(CacheBackend):
+    """
+    The classic cache layout: every entry is a file in the cache directory.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        self._path = os.path.expanduser(path)
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(self._path, exist_ok=True)
+        elif not os.path.isdir(self._path):
+            raise FileNotFoundError(f'No such directory: {self._path}')
+
+    def get(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self._path, name), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache directory {self._path}')
+        os.makedirs(self._path, exist_ok=True)
+        with open(os.path.join(self._path, name), 'wb') as f:
+            f.write(data)
+
+    def delete(self, name: str):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache directory {self._path}')
+        try:
+            os.remove(os.path.join(self._path, name))
+        except FileNotFoundError:
+            pass
+
+
+class SqliteCache(CacheBackend):
+    """
+    Cache saved in a SQLite database, in WAL mode so that several processes can read while one is writing.
+
+    Writes and last access updates are buffered and saved in a single transaction when `flush` is called, or when more
+    than `batch_size` writes are pending. Every entry keeps some metadata: size, creation and last access time, render
+    time and the backend which has rendered it.
+
+    A read-only database, like one on a read-only mount, is opened in read-only mode and the last access times are not
+    updated. It is opened as immutable too, so it must not be changed while it is in use.
+    """
+    DB_NAME = 'diagrams.sqlite'
+    SELECT_CHUNK = 500
+
+    def __init__(self, path: str, batch_size: int = 100, timeout: float = 30.0, read_only: bool = False):
+        path = os.path.expanduser(path)
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._path = os.path.join(path, self.DB_NAME)
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self.read_only = read_only
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[bytes, Optional[float], Optional[str]]] = {}
+        self._accessed: Dict[str, float] = {}
+        self._deleted: Set[str] = set()
+
+        import sqlite3
+        try:
+            if read_only:
+                # fails now if the database does not exist
+                self._connection().execute('SELECT 1 FROM diagrams LIMIT 1')
+                return
+            self._connection().execute('CREATE TABLE IF NOT EXISTS diagrams ('
+                                       'name TEXT PRIMARY KEY, '
+                                       'data BLOB NOT NULL, '
+                                       'size INTEGER NOT NULL, '
+                                       'created REAL NOT NULL, '
+                                       'last_access REAL NOT NULL, '
+                                       'render_time REAL, '
+                                       'backend TEXT)')
+        except sqlite3.Error as exc:
+            # reported like the other backends, which cannot be opened with an OSError
+            raise OSError(f'Cannot open {self._path}: {exc}') from exc
+
+    def _connection(self) -> 'sqlite3.Connection':
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            if self.read_only:
+                # immutable, since a WAL database on a read-only mount cannot be opened without its -shm file
+                conn = sqlite3.connect(f'file:{quote(os.path.abspath(self._path))}?mode=ro&immutable=1', uri=True,
+                                       timeout=self._timeout, isolation_level=None)
+            else:
+                conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, name: str) -> Optional[bytes]:
+        return self.get_many([name]).get(name)
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, bytes]:
+        names = list(dict.fromkeys(names))
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            for name in names:
+                if name in self._pending:
+                    found[name] = self._pending[name][0]
+            # deletions not saved yet
+            missing = [name for name in names if name not in found and name not in self._deleted]
+        conn = self._connection()
+
+        for i in range(0, len(missing), self.SELECT_CHUNK):
+            chunk = missing[i:i + self.SELECT_CHUNK]
+            rows = conn.execute('SELECT name, data FROM diagrams WHERE name IN (%s)' % ','.join('?' * len(chunk)),
+                                chunk)
+            found.update((name, bytes(data)) for name, data in rows)
+
+        if not self.read_only:
+            with self._lock:
+                self._accessed.update((name, now) for name in found)
+        return found
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache database {self._path}')
+        with self._lock:
+            self._pending[name] = (data, render_time, backend)
+            self._deleted.discard(name)
+            full = len(self._pending) >= self._batch_size
+        if full:
+            self.flush()
+
+    def delete(self, name: str):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache database {self._path}')
+        with self._lock:
+            self._pending.pop(name, None)
+            self._accessed.pop(name, None)
+            self._deleted.add(name)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            accessed, self._accessed = self._accessed, {}
+            deleted, self._deleted = self._deleted, set()
+        if not pending and not accessed and not deleted:
+            return
+
+        import sqlite3
+
+        now = time.time()
+        conn = None
+        try:
+            conn = self._connection()
+            # take the write lock immediately, avoiding deadlocks with other processes upgrading from a read lock
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR REPLACE INTO diagrams '
+                             '(name, data, size, created, last_access, render_time, backend) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(name, data, len(data), now, now, render_time, backend)
+                              for name, (data, render_time, backend) in pending.items()])
+            conn.executemany('UPDATE diagrams SET last_access = ? WHERE name = ?',
+                             [(when, name) for name, when in accessed.items() if name not in pending])
+            conn.executemany('DELETE FROM diagrams WHERE name = ?', [(name,) for name in deleted])
+            conn.execute('COMMIT')
+        except BaseException as exc:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if not isinstance(exc, sqlite3.Error):
+                raise
+            # for example the database locked by a writer of another process for longer than the timeout: the
+            # changes are kept for the next flush, newer ones first
+            logger.warning(f'[plantuml_markdown] Could not save the diagram cache {self._path}: {exc}')
+            with self._lock:
+                for name, entry in pending.items():
+                    if name not in self._deleted:
+                        self._pending.setdefault(name, entry)
+                for name, when in accessed.items():
+                    self._accessed.setdefault(name, when)
+                self._deleted.update(name for name in deleted if name not in self._pending)
+
+    def metadata(self, name: str) -> Optional[Dict[str, object]]:
+        """
+        Returns the metadata of an entry: `size`, `created`, `last_access`, `render_time` and `backend`.
+        """
+        self.flush()
+        row = self._connection().execute('SELECT size, created, last_access, render_time, backend '
+                                         'FROM diagrams WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('size', 'created', 'last_access', 'render_time', 'backend'), row))
+
+
+class HttpCache(CacheBackend):
+    """
+    Cache saved in a plain HTTP object store shared by many machines, like a cache server on the network of the CI
+    runners: entries are read with `GET <url>/<name>` and saved with `PUT <url>/<name>`, with the same names of the
+    `directory` backend.
+
+    Requests run on a pool of persistent connections, with bounded connect and read timeouts. Entries read together
+    are fetched concurrently. Writes are buffered until `flush`, which checks with concurrent `HEAD` requests which
+    entries are already in the store (saved by another machine) and uploads only the others.
+
+    When the store does not answer, or answers with a server error, it is left alone for `retry_after` seconds: reads
+    find nothing, so the diagrams are rendered as without cache, and the pending writes are dropped.
+    """
+
+    def __init__(self, url: str, workers: int = 8, timeout: Tuple[float, float] = (2.0, 10.0),
+                 retry_after: float = 60.0, batch_size: int = 100, read_only: bool = False):
+        """
+        Args:
+            url (str): Base url of the store; entry names are appended to it.
+            workers (int): Requests sent at the same time, and connections kept open.
+            timeout (Tuple[float, float]): Connect and read timeouts of every request, in seconds.
+            retry_after (float): Seconds without requests after a failure of the store.
+            batch_size (int): Pending writes that trigger a flush.
+            read_only (bool): Only read the entries.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._url = url if url.endswith('/') else url + '/'
+        self._workers = workers
+        self._timeout = timeout
+        self._retry_after = retry_after
+        self._batch_size = batch_size
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._pending: Dict[str, bytes] = {}
+        self._unavailable_until = 0.0
+        self._executor: Optional['ThreadPoolExecutor'] = None
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    def _request(self, method: str, name: str, data: Optional[bytes] = None) -> Optional['requests.Response']:
+        """
+        Sends a request for an entry.
+
+        Returns:
+            Optional[requests.Response]: The answer, or `None` if the store is not available.
+        """
+        import requests
+
+        if not self.available:
+            return None
+        try:
+            resp = self._session.request(method, self._url + quote(name), data=data, timeout=self._timeout)
+        except requests.RequestException as exc:
+            self._failed(exc)
+            return None
+        if resp.status_code >= 500:
+            self._failed(f'HTTP {resp.status_code}')
+            return None
+        return resp
+
+    def _failed(self, reason):
+        with self._lock:
+            was_available = self.available
+            self._unavailable_until = time.monotonic() + self._retry_after
+        if was_available:
+            logger.warning(f'[plantuml_markdown] Cache store {self._url} not available, not used for '
+                           f'{self._retry_after:g} seconds: {reason}')
+
+    def _map(self, func, items: List) -> List:
+        """
+        Applies a function to the items, with concurrent requests.
+        """
+        if len(items) < 2:
+            return [func(item) for item in items]
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(self._workers, thread_name_prefix='plantuml-cache')
+            executor = self._executor
+        try:
+            return list(executor.map(func, items))
+        except RuntimeError:
+            # the interpreter is exiting and no more threads can be started
+            return [func(item) for item in items]
+
+    def _read(self, name: str) -> Optional[bytes]:
+        resp = self._request('GET', name)
+        if resp is None or resp.status_code != 200:
+            return None
+        return resp.content
+
+    def get(self, name: str) -> Optional[bytes]:
+        return self.get_many([name]).get(name)
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, bytes]:
+        names = list(dict.fromkeys(names))
+        with self._lock:
+            found = {name: self._pending[name] for name in names if name in self._pending}
+        missing = [name for name in names if name not in found]
+        for name, data in zip(missing, self._map(self._read, missing)):
+            if data is not None:
+                found[name] = data
+        return found
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache store {self._url}')
+        with self._lock:
+            self._pending[name] = data
+            full = len(self._pending) >= self._batch_size
+        if full:
+            self.flush()
+
+    def delete(self, name: str):
+        if self.read_only:
+            raise PermissionError(f'Read-only cache store {self._url}')
+        with self._lock:
+            self._pending.pop(name, None)
+        resp = self._request('DELETE', name)
+        if resp is not None:
+            resp.close()
+
+    def _exists(self, name: str) -> Optional[bool]:
+        resp = self._request('HEAD', name)
+        return None if resp is None else resp.status_code == 200
+
+    def _write(self, item: Tuple[str, bytes]):
+        resp = self._request('PUT', item[0], item[1])
+        if resp is not None and not resp.ok:
+            logger.warning(f'[plantuml_markdown] Cannot save {item[0]} in the cache store {self._url}: '
+                           f'HTTP {resp.status_code}')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or not self.available:
+            return
+
+        # the entries are content addressed: the ones already saved by another machine are the same
+        names = list(pending)
+        exists = self._map(self._exists, names)
+        self._map(self._write, [(name, pending[name]) for name, found in zip(names, exists) if found is False])
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._session.close()
+
+
+class ReadOnlyCache(CacheBackend):
+    """
+    Read-only view of a backend, for the cache layers shared by many users.
+    """
+    read_only = True
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    def get(self, name: str) -> Optional[bytes]:
+        return self.backend.get(name)
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, bytes]:
+        return self.backend.get_many(names)
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        raise PermissionError('Read-only cache layer')
+
+    def delete(self, name: str):
+        raise PermissionError('Read-only cache layer')
+
+    def flush(self):
+        pass  # nothing is written, not even the access times
+
+
+class CompressedCache(CacheBackend):
+    """
+    Wrapper of a backend, saving the text diagrams compressed; the entries are decompressed when read, if needed.
+    """
+
+    def __init__(self, backend: CacheBackend, compression: Dict[str, str]):
+        """
+        Args:
+            backend (CacheBackend): The wrapped backend.
+            compression (Dict[str, str]): The compression method (`zlib`, `gzip` or `lzma`), by diagram format.
+        """
+        self.backend = backend
+        self.compression = compression
+        self.read_only = backend.read_only
+
+    def get(self, name: str) -> Optional[bytes]:
+        data = self.backend.get(name)
+        return None if data is None else decompress_entry(data)
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, bytes]:
+        return {name: decompress_entry(data) for name, data in self.backend.get_many(names).items()}
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        method = self.compression.get(name.rsplit('.', 1)[-1])
+        if method:
+            packed = compress_entry(data, method)
+            if len(packed) < len(data):
+                data = packed
+        self.backend.put(name, data, render_time, backend)
+
+    def delete(self, name: str):
+        self.backend.delete(name)
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+
+
+class CachePack(CacheBackend):
+    """
+    Read-only view of a cache pack file.
+
+    The file is memory-mapped and only the index is parsed when opening it, so looking up an entry costs a dictionary
+    access and a copy of the entry bytes.
+    """
+    read_only = True
+
+    def __init__(self, path: str):
+        self._path = path
+        self._index: Dict[str, Tuple[int, int]] = {}
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size + _FOOTER.size:
+                raise ValueError(f'Not a diagram cache pack: {path}')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _ = _HEADER.unpack_from(self._map, 0)
+        index_offset, count, end_magic = _FOOTER.unpack_from(self._map, size - _FOOTER.size)
+
+        if magic != PACK_MAGIC or end_magic != PACK_MAGIC:
+            self._map.close()
+            raise ValueError(f'Not a diagram cache pack: {path}')
+        if version != PACK_VERSION:
+            self._map.close()
+            raise ValueError(f'Unsupported cache pack version {version}: {path}')
+
+        pos = index_offset
+        for _ in range(count):
+            name_len, = _NAME_LEN.unpack_from(self._map, pos)
+            pos += _NAME_LEN.size
+            name = self._map[pos:pos + name_len].decode('utf-8')
+            pos += name_len
+            if not valid_entry_name(name):
+                self._map.close()
+                raise ValueError(f'Invalid entry name {name!r} in cache pack: {path}')
+            self._index[name] = _INDEX_ENTRY.unpack_from(self._map, pos)
+            pos += _INDEX_ENTRY.size
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def get(self, name: str) -> Optional[bytes]:
+        """
+        Returns the content of an entry.
+
+        Args:
+            name (str): The entry name, the same as the file name in the cache directory (ex: `0a1b2c3d.png`).
+
+        Returns:
+            Optional[bytes]: The entry content, or `None` if the pack does not contain the entry.
+        """
+        entry = self._index.get(name)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._map[offset:offset + length]
+
+    def put(self, name: str, data: bytes, render_time: Optional[float] = None, backend: Optional[str] = None):
+        raise PermissionError(f'Cache pack {self._path} is read-only')
+
+    def names(self) -> List[str]:
+        return list(self._index)
+
+    def close(self):
+        self._map.close()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __enter__(self) -> 'CachePack':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_packs: Dict[str, Tuple[float, CachePack]] = {}
+_packs_lock = threading.Lock()
+
+
+def open_pack(path: str) -> Optional[CachePack]:
+    """
+    Opens a cache pack, reusing an already opened one if the file has not changed.
+
+    Args:
+        path (str): Path of the pack file.
+
+    Returns:
+        Optional[CachePack]: The pack, or `None` if the file does not exist.
+    """
+    path = os.path.realpath(os.path.expanduser(path))
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+    with _packs_lock:
+        opened = _packs.get(path)
+        if opened is not None and opened[0] == mtime:
+            return opened[1]
+        pack = CachePack(path)
+        _packs[path] = (mtime, pack)
+        # the previous mapping is not closed: another thread could be reading from it
+        return pack
+
+
+CACHE_BACKENDS = {
+    'directory': DirectoryCache,
+    'sqlite': SqliteCache,
+    'http': HttpCache,
+}
+_backends: Dict[Tuple[str, str, bool], CacheBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(kind: str, location: str, read_only: bool = False) -> CacheBackend:
+    """
+    Returns the cache backend for a location, creating it the first time; backends are shared by all the documents
+    converted by the process.
+
+    Args:
+        kind (str): `directory`, `sqlite`, `http` or a `module:Class` reference to a `CacheBackend` subclass.
+        location (str): Where the cache is saved (the `cachedir` option): a path, or the url of an object store.
+        read_only (bool): Open the cache only for reading; custom backends are wrapped in a `ReadOnlyCache`.
+
+    Returns:
+        CacheBackend: The cache backend.
+    """
+    kind = (kind or 'directory').strip()
+    key = (kind, location if '://' in location else os.path.abspath(os.path.expanduser(location)), read_only)
+
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            if kind in CACHE_BACKENDS:
+                backend = CACHE_BACKENDS[kind](location, read_only=read_only)
+            elif ':' in kind:
+                module_name, class_name = kind.split(':', 1)
+                backend = getattr(importlib.import_module(module_name), class_name)(location)
+                if read_only:
+                    backend = ReadOnlyCache(backend)
+            else:
+                raise ValueError(f'[plantuml_markdown] Unknown cache backend: {kind}')
+            _backends[key] = backend
+        return backend
+
+
+@atexit.register
+def _flush_backends():
+    with _backends_lock:
+        # nothing is written in read-only caches, not even the access times
+        backends = [backend for backend in _backends.values() if not backend.read_only]
+    for backend in backends:
+        try:
+            backend.flush()
+        except Exception as exc:
+            logger.warning(f'[plantuml_markdown] Could not save the diagram cache: {exc}')
+
+
+def _cache_entries(cache_dir: str) -> Iterator[os.DirEntry]:
+    with os.scandir(cache_dir) as it:
+        # skip the files of the sqlite backend, if it has been used in the same directory
+        entries = [entry for entry in it if entry.is_file() and not entry.name.startswith(SqliteCache.DB_NAME)]
+    return iter(sorted(entries, key=lambda e: e.name))
+
+
+def export_cache(cache_dir: str, pack_file: str) -> int:
+    """
+    Packs all the entries of a cache directory into a single file.
+
+    Args:
+        cache_dir (str): The cache directory (the `cachedir` option).
+        pack_file (str): The pack file to write; it is replaced atomically if it already exists.
+
+    Returns:
+        int: The number of packed entries.
+    """
+    import tempfile
+
+    cache_dir = os.path.expanduser(cache_dir)
+    pack_file = os.path.expanduser(pack_file)
+    index: List[Tuple[bytes, int, int]] = []
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(pack_file)), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0))
+            offset = _HEADER.size
+
+            for entry in _cache_entries(cache_dir):
+                with open(entry.path, 'rb') as f:
+                    data = f.read()
+                out.write(data)
+                index.append((entry.name.encode('utf-8'), offset, len(data)))
+                offset += len(data)
+
+            for name, entry_offset, length in index:
+                out.write(_NAME_LEN.pack(len(name)))
+                out.write(name)
+                out.write(_INDEX_ENTRY.pack(entry_offset, length))
+            out.write(_FOOTER.pack(offset, len(index), PACK_MAGIC))
+        os.replace(temp_file, pack_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+    return len(index)
+
+
+def import_cache(pack_file: str, cache_dir: str, overwrite: bool = False) -> int:
+    """
+    Unpacks a cache pack into a cache directory.
+
+    Args:
+        pack_file (str): The pack file to read.
+        cache_dir (str): The cache directory, created if missing.
+        overwrite (bool): If `True` replace entries already present in the cache directory.
+
+    Returns:
+        int: The number of written entries.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    written = 0
+
+    with CachePack(os.path.expanduser(pack_file)) as pack:
+        for name in pack.names():
+            if not valid_entry_name(name):
+                raise ValueError(f'Invalid entry name {name!r} in cache pack: {pack_file}')
+            target = os.path.join(cache_dir, name)
+            if not overwrite and os.path.exists(target):
+                continue
+            with open(target, 'wb') as f:
+                f.write(pack.get(name))
+            written += 1
+
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='plantuml-markdown-cache',
+                                     description='Pack and unpack the plantuml_markdown diagram cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_cmd = commands.add_parser('export', help='pack a cache directory into a single file')
+    export_cmd.add_argument('cachedir', help='the cache directory')
+    export_cmd.add_argument('pack', help='the pack file to create')
+
+    import_cmd = commands.add_parser('import', help='unpack a pack file into a cache directory')
+    import_cmd.add_argument('pack', help='the pack file to read')
+    import_cmd.add_argument('cachedir', help='the cache directory')
+    import_cmd.add_argument('--overwrite', action='store_true', help='replace entries already in the cache directory')
+
+    list_cmd = commands.add_parser('list', help='list the entries of a pack file')
+    list_cmd.add_argument('pack', help='the pack file to read')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        count = export_cache(args.cachedir, args.pack)
+        print(f'Packed {count} entries into {args.pack}')
+    elif args.command == 'import':
+        count = import_cache(args.pack, args.cachedir, args.overwrite)
+        print(f'Unpacked {count} entries into {args.cachedir}')
+    else:
+        with CachePack(args.pack) as pack:
+            for name in pack.names():
+                print(name)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+   Local render daemon for the [PlantUML][] extension
+   =================================================
+
+   A long-running process serving the local PlantUML renders of all the builds running on a host, over a Unix domain
+   socket: the daemon limits the PlantUML processes running at the same time, runs only once the same diagram
+   requested by many builds, and keeps the rendered diagrams in memory for the following builds.
+
+      plantuml-markdown-daemon --socket /tmp/plantuml-markdown.sock --workers 4 --cache-size 256
+
+   The builds send their renders to the daemon when the `daemon_socket` option is set to the same path, and run
+   PlantUML by themselves when the socket does not exist or the daemon does not answer:
+
+      plantuml_markdown:
+        daemon_socket: /tmp/plantuml-markdown.sock
+
+   The daemon runs the PlantUML command line of the build (`plantuml_cmd` and its options) in the build working
+   directory, so the renders are the same as without the daemon. The content of the PlantUML configuration file is
+   part of the key of the kept diagrams, while diagrams including local files are never kept, as their changes cannot
+   be seen. The socket can be used only by the user running the daemon.
+
+   Protocol: every message is a JSON header line, with the `size` of the body following it. Requests have the `cmd`
+   to run, its `cwd`, a `timeout` (seconds, or null) and the `max_output` size (bytes, or 0), and the diagram source
+   as body; answers have a `status` (`ok`, `timeout`, `too_large` or `error`), the `returncode` and the `stderr` of
+   PlantUML and the rendered image as body.
+
+   [PlantUML]: https://plantuml.com
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from subprocess import TimeoutExpired
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from .plantuml_markdown import DiagramTooLarge, run_plantuml
+
+logger = logging.getLogger('MARKDOWN')
+
+# seconds to wait for the connection to the daemon, and added to the render timeout for the answer
+CONNECT_TIMEOUT = 5
+ANSWER_MARGIN = 5
+
+# local files read by PlantUML, whose changes cannot be seen by the daemon
+LOCAL_INCLUDE_RE = re.compile(rb'^\s*!(?:include(?:_once|_many|sub|def)?|import)\s+(?!<|https?:)', re.MULTILINE)
+
+
+def _write_message(stream: BinaryIO, header: Dict, body: bytes = b''):
+    stream.write(json.dumps(dict(header, size=len(body))).encode('utf-8') + b'\n')
+    stream.write(body)
+    stream.flush()
+
+
+def _read_message(stream: BinaryIO) -> Tuple[Dict, bytes]:
+    line = stream.readline()
+    if not line.endswith(b'\n'):
+        raise ConnectionError('connection closed')
+    header = json.loads(line)
+    body = stream.read(header['size'])
+    if len(body) != header['size']:
+        raise ConnectionError('connection closed')
+    return header, body
+
+
+def render(socket_path: str, cmdline: List[str], code: bytes, timeout: Optional[float] = None,
+           max_output: int = 0) -> Optional[Tuple[bytes, int, str]]:
+    """
+    Renders a diagram with the daemon listening on a socket.
+
+    Args:
+        socket_path (str): The socket of the daemon.
+        cmdline (List[str]): The PlantUML command line.
+        code (bytes): The diagram source, sent to PlantUML standard input.
+        timeout (Optional[float]): Seconds to wait for the diagram.
+        max_output (int): Maximum size of the diagram in bytes, 0 for no limit.
+
+    Returns:
+        Optional[Tuple[bytes, int, str]]: The output, return code and standard error of PlantUML, or `None` if the
+        daemon is not available.
+
+    Raises:
+        TimeoutExpired: If the diagram is not rendered in time.
+        DiagramTooLarge: If the diagram exceeds the maximum size.
+        OSError: If the daemon cannot run PlantUML.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.settimeout(timeout + ANSWER_MARGIN if timeout else None)
+            with sock.makefile('rwb') as stream:
+                _write_message(stream, {'cmd': cmdline, 'cwd': os.getcwd(), 'timeout': timeout,
+                                        'max_output': max_output}, code)
+                header, out = _read_message(stream)
+    except socket.timeout:
+        raise TimeoutExpired(cmdline, timeout)
+    except (OSError, ValueError) as exc:
+        # the daemon has been stopped, or it is broken
+        logger.warning(f'[plantuml_markdown] Render daemon not available on {socket_path}: {exc}')
+        return None
+
+    if header['status'] == 'timeout':
+        raise TimeoutExpired(cmdline, timeout)
+    if header['status'] == 'too_large':
+        raise DiagramTooLarge(max_output)
+    if header['status'] != 'ok':
+        raise OSError(header.get('error', 'render daemon error'))
+    return out, header['returncode'], header['stderr']
+
+
+class RenderDaemon:
+    """
+    Render daemon, serving requests in background threads:
+
+        with RenderDaemon('/tmp/plantuml-markdown.sock', workers=4):
+            ... convert documents with `daemon_socket` set to the same path ...
+    """
+
+    def __init__(self, socket_path: str, workers: Optional[int] = None, cache_size: int = 256 * 1024 * 1024):
+        """
+        Args:
+            socket_path (str): The socket to listen on.
+            workers (Optional[int]): PlantUML processes running at the same time; defaults to the number of CPUs.
+            cache_size (int): Bytes of rendered diagrams kept in memory; 0 disables the cache.
+        """
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self.stats: Dict[str, int] = dict.fromkeys(('requests', 'rendered', 'cached', 'shared', 'timeouts',
+                                                    'errors'), 0)
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._lock = threading.Lock()
+        self._cache: 'OrderedDict[str, Tuple[bytes, int, str]]' = OrderedDict()
+        self._cached_bytes = 0
+        # renders in progress, with their timeout and maximum output size
+        self._rendering: Dict[str, Tuple[Future, Optional[float], int]] = {}
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'RenderDaemon':
+        if os.path.exists(self.socket_path):
+            # a socket left by a daemon that has been killed, unless the daemon is still running
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.socket_path)
+                except OSError:
+                    os.unlink(self.socket_path)
+                else:
+                    raise RuntimeError(f'A render daemon is already listening on {self.socket_path}')
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, self._handler_class())
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='plantuml-daemon', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.unlink(self.socket_path)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> 'RenderDaemon':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def render(self, cmdline: List[str], cwd: str, code: bytes, timeout: Optional[float],
+               max_output: int = 0) -> Tuple[bytes, int, str]:
+        """
+        Renders a diagram, from the cache if already rendered, or waiting for the same render requested by another
+        build.
+
+        Raises:
+            TimeoutExpired: If the diagram is not rendered in time.
+            DiagramTooLarge: If the diagram exceeds the maximum size.
+        """
+        result = self._render(cmdline, cwd, code, timeout, max_output)
+        if max_output and len(result[0]) > max_output:
+            # rendered for a build without limits
+            raise DiagramTooLarge(max_output)
+        return result
+
+    @staticmethod
+    def _config_file(cmdline: List[str], cwd: str) -> bytes:
+        """
+        Returns the content of the PlantUML configuration file of a command line, if any.
+        """
+        if '-config' not in cmdline[:-1]:
+            return b''
+        try:
+            with open(os.path.join(cwd, cmdline[cmdline.index('-config') + 1]), 'rb') as f:
+                return f.read()
+        except OSError:
+            return b''
+
+    def _render(self, cmdline: List[str], cwd: str, code: bytes, timeout: Optional[float],
+                max_output: int) -> Tuple[bytes, int, str]:
+        # the configuration file is part of the key, so its changes are seen at once
+        config = self._config_file(cmdline, cwd)
+        key = hashlib.sha256(json.dumps([cmdline, cwd]).encode('utf-8') + b'\0' + config + b'\0' + code).hexdigest()
+        # diagrams including local files are not kept, they are only rendered once for the builds waiting for them
+        cacheable = not LOCAL_INCLUDE_RE.search(code) and not LOCAL_INCLUDE_RE.search(config)
+        with self._lock:
+            result = self._cache.get(key) if cacheable else None
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.stats['cached'] += 1
+                return result
+            rendering = self._rendering.get(key)
+            owner = rendering is None
+            if owner:
+                rendering = self._rendering[key] = (Future(), timeout, max_output)
+        future, owner_timeout, owner_max_output = rendering
+
+        if not owner:
+            self._count('shared')
+            start = time.monotonic()
+            try:
+                return future.result(timeout)
+            except FutureTimeoutError:
+                raise TimeoutExpired(cmdline, timeout)
+            except TimeoutExpired:
+                if not self._looser(timeout, owner_timeout):
+                    raise
+            except DiagramTooLarge:
+                if not self._looser(max_output, owner_max_output):
+                    raise
+            # a limit of the other build was exceeded, not this one: rendered again with the limits of this build
+            remaining = timeout - (time.monotonic() - start) if timeout else None
+            if remaining is not None and remaining <= 0:
+                raise TimeoutExpired(cmdline, timeout)
+            return self._render(cmdline, cwd, code, remaining, max_output)
+
+        try:
+            result = self._run(cmdline, cwd, code, timeout, max_output)
+        except BaseException as exc:
+            # removed first, so the builds rendering again do not find the failed render
+            with self._lock:
+                del self._rendering[key]
+            future.set_exception(exc)
+            raise
+        if cacheable:
+            self._store(key, result)
+        with self._lock:
+            del self._rendering[key]
+        future.set_result(result)
+        return result
+
+    @staticmethod
+    def _looser(limit: Optional[float], other: Optional[float]) -> bool:
+        """
+        Tells if a limit is looser than another one; a limit of 0 or `None` means no limit.
+        """
+        return bool(other) and (not limit or limit > other)
+
+    def _run(self, cmdline: List[str], cwd: str, code: bytes, timeout: Optional[float],
+             max_output: int) -> Tuple[bytes, int, str]:
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutExpired(cmdline, timeout)
+        try:
+            # the time spent waiting for a worker is part of the timeout
+            out, returncode, err = run_plantuml(cmdline, code,
+                                                max(0.0, timeout - (time.monotonic() - start)) if timeout else None,
+                                                max_output, cwd)
+        finally:
+            self._slots.release()
+        self._count('rendered')
+        return out, returncode, err.decode('utf-8', 'replace')
+
+    def _store(self, key: str, result: Tuple[bytes, int, str]):
+        size = len(result[0])
+        if size > self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = result
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_size:
+                _, (out, _, _) = self._cache.popitem(last=False)
+                self._cached_bytes -= len(out)
+
+    def _handler_class(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request, code = _read_message(self.rfile)
+                except (ConnectionError, ValueError, KeyError):
+                    return
+                daemon._count('requests')
+
+                try:
+                    out, returncode, err = daemon.render(request['cmd'], request['cwd'], code, request['timeout'],
+                                                         request.get('max_output', 0))
+                except TimeoutExpired:
+                    daemon._count('timeouts')
+                    _write_message(self.wfile, {'status': 'timeout'})
+                except DiagramTooLarge:
+                    _write_message(self.wfile, {'status': 'too_large'})
+                except Exception as exc:
+                    daemon._count('errors')
+                    logger.error(f'[plantuml_markdown] Render daemon cannot run PlantUML: {exc}')
+                    _write_message(self.wfile, {'status': 'error', 'error': str(exc)})
+                else:
+                    _write_message(self.wfile, {'status': 'ok', 'returncode': returncode, 'stderr': err}, out)
+
+        return Handler
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='plantuml-markdown-daemon',
+                                     description='Local PlantUML render daemon, shared by the builds of a host')
+    parser.add_argument('--socket', required=True, help='Unix socket to listen on')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='PlantUML processes running at the same time (default: number of CPUs)')
+    parser.add_argument('--cache-size', type=float, default=256,
+                        help='MB of rendered diagrams kept in memory, 0 to disable (default 256)')
+    args = parser.parse_args(argv)
+
+    daemon = RenderDaemon(args.socket, workers=args.workers, cache_size=int(args.cache_size * 1024 * 1024))
+    with daemon:
+        print(f'Render daemon listening on {args.socket} with {daemon.workers} workers')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    print(' '.join(f'{name}={value}' for name, value in daemon.stats.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
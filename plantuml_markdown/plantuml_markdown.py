@@ -58,23 +58,32 @@
 import os
 import re
 import base64
+import copy
+import hashlib
+import json
+import threading
 import zlib
 import string
-import urllib3
-from subprocess import Popen, PIPE
-from typing import Dict, List, Optional, Tuple
+import struct
+import tempfile
+import textwrap
+import time
+from subprocess import Popen, PIPE, TimeoutExpired
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 from zlib import adler32
 
 import logging
 import markdown
-import uuid
-import requests
+from markdown import util
 from markdown.util import AtomicString
-from requests import Session
-from requests.adapters import HTTPAdapter, Retry, Response
 from xml.etree import ElementTree as etree
 
+from .cache import CacheBackend, CompressedCache, compression_config, get_backend, open_pack
 
+if TYPE_CHECKING:
+    # `requests` is slow to import and needed only with remote servers: it is imported when used
+    import requests
 
 # use markdown_py with -v to enable warnings, or with --noisy to enable debug logs
 logger = logging.getLogger('MARKDOWN')
@@ -82,6 +91,602 @@ plantuml_alphabet = string.digits + string.ascii_uppercase + string.ascii_lowerc
 base64_alphabet = string.ascii_uppercase + string.ascii_lowercase + string.digits + '+/'
 b64_to_plantuml = bytes.maketrans(base64_alphabet.encode('utf-8'), plantuml_alphabet.encode('utf-8'))
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+SVG_ROOT_RE = re.compile(rb'<svg\b[^>]*>')
+SVG_LENGTH_RE = re.compile(rb'\s(width|height)="\s*([\d.]+)(?:px)?\s*"')
+# shows only the diagram variant matching the color scheme of the browser
+DARK_MODE_STYLE = '<style>@media (prefers-color-scheme: dark) {.plantuml-light {display: none}} ' \
+                  '@media not all and (prefers-color-scheme: dark) {.plantuml-dark {display: none}}</style>'
+# separates the images rendered with a single PlantUML process
+PIPE_DELIMITER = b'@@plantuml_markdown@@'
+SVG_VIEWBOX_RE = re.compile(rb'\sviewBox="\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)\s*"')
+
+
+# comment lines, with the single quote or on a single line with the block syntax
+COMMENT_LINE_RE = re.compile(r"^(?:'.*|/'.*'/)$")
+# diagrams with raw data, where a line starting with a single quote is not a comment
+RAW_DIAGRAM_RE = re.compile(r'^\s*@start(?:ditaa|json|yaml|math|latex|creole|regex|ebnf|files)\b', re.MULTILINE)
+
+
+def canonical_source(code: str) -> str:
+    """
+    Returns the canonical form of a diagram source, the same for all the sources differing only in ways that cannot
+    change the picture: line endings, trailing whitespace, the common indentation, blank lines around the diagram
+    and comment-only lines.
+
+    Args:
+        code (str): The diagram source.
+
+    Returns:
+        str: The canonical source.
+    """
+    lines = [line.rstrip() for line in code.replace('\r\n', '\n').replace('\r', '\n').split('\n')]
+    comments = [bool(COMMENT_LINE_RE.match(line.lstrip())) for line in lines]
+    # inside block comments on many lines, the lines starting with a quote are not comments on their own
+    block_comments = any(("/'" in line or "'/" in line) and not comment for line, comment in zip(lines, comments))
+    if not block_comments and not RAW_DIAGRAM_RE.search(code):
+        lines = [line for line, comment in zip(lines, comments) if not comment]
+    return textwrap.dedent('\n'.join(lines)).strip('\n') + '\n'
+
+
+# multi-line texts, where blank and comment lines are part of the text: notes, legends, titles and such
+TEXT_BLOCK_START_RE = re.compile(r'^(?:[rh]?note\b[^:"]*|ref over\b[^:]*|legend\b[^:]*|'
+                                 r'(?:(?:left|center|right)\s+)?(?:header|footer)|title|caption)$', re.IGNORECASE)
+TEXT_BLOCK_END_RE = re.compile(r'^end\s?(?:[rh]?note|ref|legend|header|footer|title|caption)$', re.IGNORECASE)
+# activity and mind map labels on many lines, ended by one of the shape characters
+MULTILINE_LABEL_START_RE = re.compile(r'^(?:[*+\-]+\S*?\s*|#\w+\s*)?:')
+MULTILINE_LABEL_END_RE = re.compile(r'[;|<>/\]}]$')
+# diagrams where the indentation can be meaningful
+INDENTED_DIAGRAM_RE = re.compile(r'^\s*@start(?:mindmap|wbs)\b', re.MULTILINE)
+
+
+def minify_source(code: str) -> str:
+    """
+    Returns a smaller but equivalent diagram source, for sending it to the servers: removes comments, blank lines
+    and the whitespace around the lines. Multi-line texts (notes, legends, activity labels, etc.), continued lines
+    and diagrams with raw data are kept as they are, as well as the whitespace inside the lines, where it can be part
+    of a label.
+
+    Args:
+        code (str): The diagram source.
+
+    Returns:
+        str: The minified source.
+    """
+    if RAW_DIAGRAM_RE.search(code) or INDENTED_DIAGRAM_RE.search(code):
+        return code
+
+    out: List[str] = []
+    block_end: Optional[Callable[[str], bool]] = None
+    block_comment = continued = False
+    for line in code.splitlines():
+        stripped = line.strip()
+        if continued or block_end is not None:
+            # inside a text, everything is kept
+            out.append(line)
+            if block_end is not None and block_end(stripped):
+                block_end = None
+        elif block_comment:
+            if "'/" in stripped:
+                block_comment = False
+                stripped = stripped[stripped.index("'/") + 2:].strip()
+                if stripped:
+                    out.append(stripped)
+            continue
+        elif stripped.startswith("/'"):
+            block_comment = "'/" not in stripped[2:]
+            if not block_comment:
+                rest = stripped[stripped.index("'/", 2) + 2:].strip()
+                if rest:
+                    out.append(rest)
+            continue
+        elif not stripped or stripped.startswith("'"):
+            continue
+        else:
+            out.append(stripped)
+            if TEXT_BLOCK_START_RE.match(stripped):
+                block_end = TEXT_BLOCK_END_RE.match
+            elif MULTILINE_LABEL_START_RE.match(stripped) and not MULTILINE_LABEL_END_RE.search(stripped):
+                block_end = MULTILINE_LABEL_END_RE.search
+            elif stripped.endswith('['):
+                block_end = lambda text: text.startswith(']')  # noqa: E731
+        continued = out[-1].endswith('\\') if out else False
+    return '\n'.join(out) + '\n'
+
+
+def image_size(diagram: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Reads the intrinsic size of a diagram image, from the IHDR chunk of a PNG or from the root tag of a SVG.
+
+    Args:
+        diagram (bytes): The PNG or SVG image.
+
+    Returns:
+        Optional[Tuple[int, int]]: Width and height in pixels, `None` if the size cannot be determined.
+    """
+    if diagram.startswith(PNG_SIGNATURE):
+        # the IHDR chunk is always the first one: length (4 bytes), type (4 bytes), width and height
+        if diagram[12:16] == b'IHDR' and len(diagram) >= 24:
+            return struct.unpack('>II', diagram[16:24])
+        return None
+
+    m = SVG_ROOT_RE.search(diagram, 0, 4096)  # the root tag is at the beginning, no need to scan the whole image
+    if not m:
+        return None
+
+    sizes = {name: float(value) for name, value in SVG_LENGTH_RE.findall(m.group(0))}
+    if b'width' in sizes and b'height' in sizes:
+        return round(sizes[b'width']), round(sizes[b'height'])
+
+    view_box = SVG_VIEWBOX_RE.search(m.group(0))
+    if view_box:
+        return round(float(view_box.group(1))), round(float(view_box.group(2)))
+    return None
+
+
+class DataURI(NamedTuple):
+    """
+    A base64 data URI, encoded only when the tag containing it is serialized.
+    """
+    mime_type: str
+    data: bytes
+
+
+# bytes encoded at a time when writing a data URI, multiple of 3 so the chunks do not need padding
+DATA_URI_CHUNK = 3 * 64 * 1024
+
+
+# the characters escaped by ElementTree in attribute values
+ATTRIB_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                                '\t': '&#09;'})
+
+
+def html_tag(tag: str, attrib: Dict[str, Union[str, DataURI]], short_empty_elements: bool = True) \
+        -> List[Union[bytes, DataURI]]:
+    """
+    Serializes an empty tag exactly like `etree.tostring` does, leaving the data URIs to `join_tags`.
+
+    Args:
+        tag (str): The tag name.
+        attrib (Dict[str, str | DataURI]): The attributes, in order.
+        short_empty_elements (bool): If the tag is closed with `/>`, or with an end tag.
+
+    Returns:
+        List[bytes | DataURI]: The chunks of the tag, to be joined with `join_tags`.
+    """
+    chunks = [b'<' + tag.encode('ascii')]
+    for name, value in attrib.items():
+        if isinstance(value, DataURI):
+            # base64 never needs escaping
+            chunks.append(b' ' + name.encode('ascii') + b'="data:' + value.mime_type.encode('ascii') + b';base64,')
+            chunks.append(value)
+            chunks.append(b'"')
+        else:
+            # the same escaping of the standard serializer, which writes non ASCII characters as references
+            chunks.append(b' ' + name.encode('ascii') + b'="' +
+                          value.translate(ATTRIB_ESCAPES).encode('ascii', 'xmlcharrefreplace') + b'"')
+    chunks.append(b' />' if short_empty_elements else b'></' + tag.encode('ascii') + b'>')
+    return chunks
+
+
+def join_tags(chunks: List[Union[bytes, DataURI]]) -> str:
+    """
+    Joins the chunks of tags built by `html_tag`.
+
+    The data URIs are base64 encoded directly in a buffer of the final size, so large images are not copied again
+    and again as with `etree.tostring`.
+    """
+    size = sum(4 * ((len(chunk.data) + 2) // 3) if isinstance(chunk, DataURI) else len(chunk) for chunk in chunks)
+    buffer = bytearray(size)
+    pos = 0
+    for chunk in chunks:
+        if isinstance(chunk, DataURI):
+            data = memoryview(chunk.data)
+            for start in range(0, len(data), DATA_URI_CHUNK):
+                encoded = base64.b64encode(data[start:start + DATA_URI_CHUNK])
+                buffer[pos:pos + len(encoded)] = encoded
+                pos += len(encoded)
+        else:
+            buffer[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    return buffer.decode('ascii')
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests sent to a server, shared by all the renders of the process.
+
+    The bucket holds up to `burst` tokens and is refilled at `rate` tokens per second; every request takes a token.
+    When the server answers with HTTP 429 the rate is halved and requests wait for the `Retry-After` delay, then the
+    rate recovers slowly, a little at every successful request.
+    """
+    MIN_RATE = 0.1
+    RECOVERY = 0.05  # fraction of the configured rate recovered at every successful request
+
+    _limiters: Dict[str, 'RateLimiter'] = {}
+    _limiters_lock = threading.Lock()
+
+    @classmethod
+    def for_server(cls, url: str, rate: float, burst: int) -> 'RateLimiter':
+        """
+        Returns the rate limiter of a server.
+        """
+        with cls._limiters_lock:
+            limiter = cls._limiters.get(url)
+            if limiter is None or limiter.max_rate != rate or limiter.burst != burst:
+                limiter = cls._limiters[url] = cls(rate, burst)
+            return limiter
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Takes a token, waiting for it if needed.
+
+        Returns:
+            bool: False if the token is not available within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def throttled(self, retry_after: Optional[float] = None):
+        """
+        Slows down after a 429 answer from the server.
+        """
+        with self._lock:
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self._tokens = 0.0
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        """
+        Recovers the configured rate, after a successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.RECOVERY)
+
+    @staticmethod
+    def retry_after(value: Optional[str]) -> Optional[float]:
+        """
+        Parses the `Retry-After` header, given in seconds or as a date.
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+
+class DiagramError(str):
+    """
+    Error message for a diagram that cannot be rendered as it is, like a syntax error reported by Kroki. Unlike network
+    errors it does not go away until the diagram changes, so it can be cached.
+    """
+
+
+class DiagramTooLarge(Exception):
+    """
+    Raised when a rendered diagram exceeds the maximum output size; the render is stopped as soon as it is detected.
+    """
+
+    def __init__(self, max_size: int):
+        super().__init__(f'[uml directive] Diagram too large: more than {max_size} bytes')
+        self.max_size = max_size
+
+
+# seconds between two checks of the output size of a running PlantUML
+OUTPUT_CHECK_INTERVAL = 0.1
+
+
+def run_plantuml(cmdline: List[str], code: bytes, timeout: Optional[float] = None, max_output: int = 0,
+                 cwd: Optional[str] = None) -> Tuple[bytes, int, bytes]:
+    """
+    Runs a PlantUML command, killing it when the timeout expires or when its output grows too much.
+
+    Args:
+        cmdline (List[str]): The command line.
+        code (bytes): The diagram source, sent to the standard input.
+        timeout (Optional[float]): Seconds to wait for the command.
+        max_output (int): Maximum size of the output in bytes, 0 for no limit.
+        cwd (Optional[str]): The working directory of the command.
+
+    Returns:
+        Tuple[bytes, int, bytes]: The output, the return code and the standard error.
+
+    Raises:
+        TimeoutExpired: If the command has been killed for the timeout.
+        DiagramTooLarge: If the command has been killed for its output size.
+    """
+    # On Windows run batch files through a shell so the extension can be resolved
+    shell = os.name == 'nt'
+    if not max_output:
+        p = Popen(cmdline, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=shell, cwd=cwd)
+        try:
+            out, err = p.communicate(input=code, timeout=timeout)
+        except TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise
+        return out, p.returncode, err
+
+    # the output goes to a file, which size is checked while the command runs
+    with tempfile.TemporaryFile() as stdout:
+        p = Popen(cmdline, stdin=PIPE, stdout=stdout, stderr=PIPE, shell=shell, cwd=cwd)
+        deadline = time.monotonic() + timeout if timeout else None
+        stdin = code
+        while True:
+            wait = OUTPUT_CHECK_INTERVAL if deadline is None \
+                else max(0.0, min(OUTPUT_CHECK_INTERVAL, deadline - time.monotonic()))
+            try:
+                _, err = p.communicate(input=stdin, timeout=wait)
+                break
+            except TimeoutExpired:
+                stdin = None  # already sent
+                if os.fstat(stdout.fileno()).st_size > max_output:
+                    p.kill()
+                    p.communicate()
+                    raise DiagramTooLarge(max_output)
+                if deadline is not None and time.monotonic() >= deadline:
+                    p.kill()
+                    p.communicate()
+                    raise TimeoutExpired(cmdline, timeout)
+
+        if os.fstat(stdout.fileno()).st_size > max_output:
+            raise DiagramTooLarge(max_output)
+        stdout.seek(0)
+        return stdout.read(), p.returncode, err
+
+
+class RenderManifest:
+    """
+    In memory map from the source of a diagram block to its finished HTML, reused across documents conversions.
+
+    Live-reload servers convert the same pages again and again, often with no changes on diagrams: with the manifest
+    the HTML of an unchanged block is spliced back in the document, without parsing options, expanding includes and
+    looking up the cache. Stashed HTML (see `md.htmlStash`) is saved raw and stashed again when reused.
+    """
+    MAX_ENTRIES = 1000
+    _PLACEHOLDER_PREFIX, _PLACEHOLDER_SUFFIX = util.HTML_PLACEHOLDER.split('%s')
+    PLACEHOLDER_RE = re.compile(re.escape(_PLACEHOLDER_PREFIX) + r'(\d+)' + re.escape(_PLACEHOLDER_SUFFIX))
+
+    _manifests: Dict[str, 'RenderManifest'] = {}
+    _manifests_lock = threading.Lock()
+
+    @classmethod
+    def for_config(cls, config: Dict) -> 'RenderManifest':
+        """
+        Returns the manifest for an extension configuration; blocks rendered with a different configuration are not
+        shared.
+        """
+        fingerprint = json.dumps(config, sort_keys=True, default=str)
+        with cls._manifests_lock:
+            return cls._manifests.setdefault(fingerprint, cls())
+
+    def __init__(self):
+        self._entries: 'OrderedDict[str, Tuple[List[Tuple[bool, str]], Dict[str, float]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, block: str, md: markdown.Markdown,
+            rewrite: Optional[Callable[[str], str]] = None) -> Optional[str]:
+        """
+        Returns the HTML for a diagram block, if the block has already been rendered and the files it depends on are
+        unchanged; `rewrite` is applied to every part of the HTML before stashing it.
+        """
+        with self._lock:
+            entry = self._entries.get(block)
+            if entry is None:
+                return None
+            self._entries.move_to_end(block)
+        parts, depends = entry
+
+        for path, mtime in depends.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+
+        if rewrite is not None:
+            parts = [(stashed, rewrite(html)) for stashed, html in parts]
+        return ''.join(md.htmlStash.store(html) if stashed else html for stashed, html in parts)
+
+    def put(self, block: str, html: str, md: markdown.Markdown, depends: List[str]):
+        """
+        Saves the HTML of a diagram block.
+
+        Args:
+            block (str): The whole diagram block, with options.
+            html (str): The finished HTML, possibly with stash placeholders.
+            md (markdown.Markdown): The Markdown instance which has stashed the HTML.
+            depends (List[str]): Files used by the diagram (external source, configuration file).
+        """
+        parts: List[Tuple[bool, str]] = []
+        idx = 0
+        for m in self.PLACEHOLDER_RE.finditer(html):
+            if m.start() > idx:
+                parts.append((False, html[idx:m.start()]))
+            parts.append((True, md.htmlStash.rawHtmlBlocks[int(m.group(1))]))
+            idx = m.end()
+        if idx < len(html):
+            parts.append((False, html[idx:]))
+
+        try:
+            mtimes = {path: os.stat(path).st_mtime for path in depends}
+        except OSError:
+            return
+
+        with self._lock:
+            self._entries[block] = (parts, mtimes)
+            self._entries.move_to_end(block)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+
+class StaleOutputs:
+    """
+    Last rendered output of every diagram block, by page and block position, for the stale-while-revalidate mode.
+
+    When a diagram block changes, its previous output is served at once while the new diagram is rendered in
+    background. Outputs are kept in memory, and saved in the cache as small `.stale` entries pointing to the cached
+    diagram, so they survive restarts.
+    """
+    MAX_ENTRIES = 1000
+    MAX_WORKERS = 2
+
+    _outputs: 'OrderedDict[str, Tuple[str, float, bytes]]' = OrderedDict()
+    _refreshing: Dict[str, object] = {}
+    _executor = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, key: str, caches: List[CacheBackend], max_age: float) -> Optional[Tuple[str, bytes]]:
+        """
+        Returns the name and the data of the last output of a block, if not older than `max_age` seconds (0 for no
+        limit).
+        """
+        with cls._lock:
+            output = cls._outputs.get(key)
+
+        if output is None:
+            # maybe rendered by a previous process
+            for cache in caches:
+                pointer = cache.get(key + '.stale')
+                if pointer is not None:
+                    pointer = json.loads(pointer)
+                    data = next((d for d in (c.get(pointer['name']) for c in caches) if d is not None), None)
+                    if data is not None:
+                        output = (pointer['name'], pointer['time'], data)
+                    break
+
+        if output is None or (max_age and time.time() - output[1] > max_age):
+            return None
+        return output[0], output[2]
+
+    @classmethod
+    def put(cls, key: str, name: str, data: bytes, caches: List[CacheBackend]):
+        """
+        Saves the last output of a block.
+        """
+        now = time.time()
+        with cls._lock:
+            output = cls._outputs.get(key)
+            if output is not None and output[0] == name:
+                return  # nothing changed
+            cls._outputs[key] = (name, now, data)
+            cls._outputs.move_to_end(key)
+            while len(cls._outputs) > cls.MAX_ENTRIES:
+                cls._outputs.popitem(last=False)
+
+        for cache in caches:
+            if not cache.read_only:
+                cache.put(key + '.stale', json.dumps({'name': name, 'time': now}).encode('utf-8'))
+                break
+
+    @classmethod
+    def refresh(cls, name: str, render: Callable[[], None]):
+        """
+        Renders a diagram in background, unless it is already being rendered.
+        """
+        with cls._lock:
+            if name in cls._refreshing:
+                return
+            if cls._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_WORKERS, thread_name_prefix='plantuml')
+
+            def run():
+                try:
+                    render()
+                except Exception as exc:
+                    logger.error(f'[plantuml_markdown] Error rendering diagram in background: {exc}')
+                finally:
+                    with cls._lock:
+                        cls._refreshing.pop(name, None)
+
+            cls._refreshing[name] = cls._executor.submit(run)
+
+    @classmethod
+    def wait(cls, timeout: Optional[float] = None):
+        """
+        Waits for the end of the background renders.
+        """
+        from concurrent.futures import wait
+        with cls._lock:
+            futures = list(cls._refreshing.values())
+        wait(futures, timeout)
+
+
+class RenderContext:
+    """
+    State of a single document conversion.
+
+    The preprocessor keeps only its configuration, while everything computed for a document lives in a context
+    owned by the converting thread: the same `Markdown` instance can be reused by different threads (one conversion at
+    a time, as Python-Markdown itself is not reentrant), and the preprocessor can render diagrams concurrently.
+    """
+
+    def __init__(self):
+        self.caches: List[CacheBackend] = []
+        self.rendered_by: Optional[str] = None
+        self.plantuml_servers: list[dict[str, str | bool]] = []
+        self.kroki_server: bool = False
+        self.base_dir: Optional[List[str]] = None
+        self.encoding: str = 'utf-8'
+        self.http_method: str = 'GET'
+        self.max_url_length: int = 4096
+        self.fallback_to_get: bool = True
+        self.config_path: Optional[str] = None
+        self.image_maps: bool = False
+        self.intrinsic_size: bool = False
+        self.lazy_loading: bool = False
+        self.manifest: Optional[RenderManifest] = None
+        self.render_failed: bool = False
+        self.timeouts: Tuple[Optional[float], Optional[float]] = (None, None)
+        self.local_timeout: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self.max_stale: float = 0
+        self.page_key: Optional[str] = None
+        self.block_index: int = 0
+        self.stale_key: Optional[str] = None
+        self.error_cache_ttl: float = 0
+        self.normalize_cache_keys: bool = False
+        self.cache_promote: bool = False
+        self.minify_source: bool = False
+        # size limits in bytes, 0 means no limit
+        self.max_source_size: int = 0
+        self.max_include_size: int = 0
+        self.max_output_size: int = 0
+        self.lang: str = 'uml'
+        # when prefetching, the diagrams found in the documents: code, format and requested format
+        self.prefetch: Optional[List[Tuple[str, str, str]]] = None
+        # the page has paired variants, which need the style showing only one of them
+        self.dark_mode_style: bool = False
+
 
 # For details see https://python-markdown.github.io/extensions/api/#blockparser
 class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
@@ -124,85 +729,284 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
     # (?P<indent>[ ]*)(?P<fence>(?:~{3}|`{3}))[ ]*(\{?\.?(plant)?uml)[ ]*\n(?P<code>.*?)(?<=\n)(?P=indent)(?P=fence)$
     FENCED_CODE_RE = re.compile(r'(?P<fence>(~{4,}|`{4,})).*?(?P=fence)',
                                 re.MULTILINE | re.DOTALL | re.VERBOSE)
+    # includes of local files, which changes cannot be tracked by the render manifest
+    LOCAL_INCLUDE_RE = re.compile(r'^\s*!include(?:_once|_many|sub)?\s+(?!<|https?:)', re.MULTILINE)
+    # image map ids, ending with the position of their block in the page
+    MAP_ID_RE = re.compile(r'(plantuml-map-[0-9a-f]{8}-)\d+')
 
     def __init__(self, md):
         super(PlantUMLPreprocessor, self).__init__(md)
-        self._cache_dir: Optional[str] = None
-        self._plantuml_servers: list[dict[str, str | bool]] = []
-        self._kroki_server: bool = False
-        self._base_dir: Optional[List[str]] = None
-        self._encoding: str = 'utf-8'
-        self._http_method: str = 'GET'
-        self._fallback_to_get: bool = True
-        self._config_path: Optional[str] = None
-        self._image_maps: bool = False
+        # the state of the conversions, by thread
+        self._local = threading.local()
+        # bytes of the diagram sources before and after the minification, for all the conversions
+        self.minify_stats: Dict[str, int] = {'diagrams': 0, 'source_bytes': 0, 'minified_bytes': 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def _context(self) -> RenderContext:
+        return self._local.context
 
     def run(self, lines: List[str]) -> List[str]:
+        # quick check for pages without diagrams: every syntax has the `uml` word in the block header
+        if not any('uml' in line and ('::uml::' in line or '```' in line or '~~~' in line) for line in lines):
+            return lines
+
+        ctx = self._new_context()
+        self._local.context = ctx
+        try:
+            return self._run(ctx, lines)
+        finally:
+            self._local.context = None
+
+    def _new_context(self) -> RenderContext:
         # extract some configurations, to simplify code
-        self._cache_dir = self.config['cachedir']
-        self._encoding = self.config['encoding'] or self._encoding
-        self._http_method = self.config['http_method'].strip()
-        self._fallback_to_get = bool(self.config['fallback_to_get'])
-        self._base_dir = self.config['base_dir']
-        self._image_maps = str(self.config['image_maps']).lower() in ['true', 'on', 'yes', '1']
-
-        self.__setup_servers()
-
-        if not isinstance(self._base_dir, list):
-            self._base_dir = [self._base_dir]
-
-        # make sure they are strings (can be DocsDirPlaceholder is !relative is used in mkdocs.yml)
-        self._base_dir = [str(v) for v in self._base_dir]
-
-        if self.config['config']:
-            self._config_path = self.config['config']
-            # try to find config file
-            for search_dir in self._base_dir:
-                if os.path.isfile(os.path.join(search_dir, self.config['config'])):
-                    self._config_path = os.path.join(search_dir, self.config['config'])
-                    break
-            else:
-                logger.error(f'Could not find config file {self._config_path} in any of {self._base_dir}')
-                return [self._render_error(f'Could not find config file {self._config_path} in any of {self._base_dir}')]
+        ctx = RenderContext()
+        ctx.caches = self.__setup_caches()
+        ctx.encoding = self.config['encoding'] or ctx.encoding
+        ctx.http_method = self.config['http_method'].strip().upper()
+        ctx.max_url_length = int(self.config['max_url_length'])
+        ctx.fallback_to_get = bool(self.config['fallback_to_get'])
+        ctx.image_maps = str(self.config['image_maps']).lower() in ['true', 'on', 'yes', '1']
+        ctx.intrinsic_size = str(self.config['intrinsic_size']).lower() in ['true', 'on', 'yes', '1']
+        ctx.lazy_loading = str(self.config['lazy_loading']).lower() in ['true', 'on', 'yes', '1']
+        ctx.manifest = RenderManifest.for_config(self.config) \
+            if str(self.config['render_manifest']).lower() in ['true', 'on', 'yes', '1'] else None
+        # timeouts in seconds, 0 means no timeout
+        ctx.timeouts = (float(self.config['connect_timeout']) or None, float(self.config['read_timeout']) or None)
+        ctx.local_timeout = float(self.config['local_timeout']) or None
+        page_timeout = float(self.config['page_timeout'])
+        ctx.deadline = time.monotonic() + page_timeout if page_timeout else None
+        ctx.error_cache_ttl = float(self.config['error_cache_ttl'])
+        ctx.max_stale = float(self.config['max_stale'])
+        ctx.normalize_cache_keys = str(self.config['normalize_cache_keys']).lower() in ['true', 'on', 'yes', '1']
+        ctx.cache_promote = str(self.config['cache_promote']).lower() in ['true', 'on', 'yes', '1']
+        ctx.minify_source = str(self.config['minify_source']).lower() in ['true', 'on', 'yes', '1']
+        ctx.max_source_size = int(self.config['max_source_size'])
+        ctx.max_include_size = int(self.config['max_include_size'])
+        ctx.max_output_size = int(self.config['max_output_size'])
+        return ctx
+
+    def _run(self, ctx: RenderContext, lines: List[str]) -> List[str]:
+        err = self.__setup(ctx)
+        if err:
+            logger.error(err)
+            return [self._render_error(err)]
+
         # start parsing
         text = '\n'.join(lines)
         idx = 0
 
+        if str(self.config['stale_while_revalidate']).lower() in ['true', 'on', 'yes', '1'] \
+                and str(self.config['force_fresh']).lower() not in ['true', 'on', 'yes', '1']:
+            # pages have no identity in Markdown: they are recognized by their text, without the diagrams
+            prose = self.BLOCK_RE.sub('', self.FENCED_BLOCK_RE.sub('', text))
+            fingerprint = json.dumps(self.config, sort_keys=True, default=str) + prose
+            ctx.page_key = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
         # loop until all text is parsed
         while idx < len(text):
             text1, idx1 = self._replace_block(text[idx:])
             text = text[:idx]+text1
             idx += idx1
 
+        for cache in ctx.caches:
+            cache.flush()
+
+        if ctx.dark_mode_style:
+            # once for the whole page
+            text = self.md.htmlStash.store(DARK_MODE_STYLE) + '\n\n' + text
         return text.split('\n')
 
-    def __setup_servers(self):
+    def prefetch(self, sources: Iterable[str], max_workers: int = 8) -> int:
+        """
+        Renders concurrently the diagrams of many Markdown documents, saving them in the cache: the documents are only
+        parsed to find their diagrams, then converted as usual, with the diagrams already rendered.
+
+        Args:
+            sources (Iterable[str]): The Markdown documents.
+            max_workers (int): The diagrams rendered at the same time.
+
+        Returns:
+            int: The number of diagrams rendered, those already in the cache excluded.
+        """
+        ctx = self._new_context()
+        ctx.deadline = None  # page budgets do not apply to a whole site
+        ctx.prefetch = []
+        self._local.context = ctx
+        try:
+            err = self.__setup(ctx)
+            if err:
+                logger.error(err)
+                return 0
+            # the documents are prepared like in a conversion, by the preprocessors running before this one
+            previous = []
+            for preprocessor in self.md.preprocessors:
+                if preprocessor is self:
+                    break
+                previous.append(preprocessor)
+
+            for source in sources:
+                self.md.reset()
+                lines = source.split('\n')
+                for preprocessor in previous:
+                    lines = preprocessor.run(lines)
+                text = '\n'.join(lines)
+                idx = 0
+                while idx < len(text):
+                    idx += self._replace_block(text[idx:])[1]
+        finally:
+            self._local.context = None
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # the same diagram can be in many documents
+        jobs = list(OrderedDict.fromkeys(ctx.prefetch))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rendered = sum(executor.map(lambda job: self._prefetch_diagram(ctx, *job), jobs))
+
+        for cache in ctx.caches:
+            cache.flush()
+        return rendered
+
+    def _prefetch_diagram(self, context: RenderContext, code: str, img_format: str, requested_format: str) -> int:
+        # the context is copied, as the renders running together must not share their state
+        ctx = copy.copy(context)
+        self._local.context = ctx
+        try:
+            if self.config['dark_theme'] and img_format != 'txt':
+                _, _, err = self._render_variants(code, requested_format)
+            else:
+                _, err = self._render_diagram(code, requested_format)
+            if not err and requested_format == 'png' and ctx.image_maps:
+                self._render_diagram(code, 'map')
+        finally:
+            self._local.context = None
+        # the diagrams failing are not in the cache
+        return 1 if ctx.rendered_by and not err else 0
+
+    def __setup_caches(self) -> List[CacheBackend]:
+        caches = []
+
+        layers = self.config['cachedir']
+        if not isinstance(layers, list):
+            layers = [layers] if layers else []
+
+        for layer in layers:
+            # a path, or a dictionary with the path and the options of the layer
+            if not isinstance(layer, dict):
+                layer = {'path': layer}
+            read_only = str(layer.get('read_only', False)).lower() in ['true', 'on', 'yes', '1']
+            try:
+                cache = get_backend(layer.get('backend') or self.config['cache_backend'], str(layer['path']),
+                                    read_only)
+            except OSError as exc:
+                # a shared layer may be not mounted, or its database may be missing
+                logger.warning(f"[plantuml_markdown] Cache layer {layer['path']} not available: {exc}")
+                continue
+            caches.append(cache)
+
+        if self.config['cache_pack']:
+            # read-only cache shipped as a single file
+            pack = open_pack(self.config['cache_pack'])
+            if pack is not None:
+                caches.append(pack)
+            else:
+                logger.warning(f"[plantuml_markdown] Cache pack {self.config['cache_pack']} not found")
+
+        # always wrapped, as compressed entries can be found even if the compression is not enabled (anymore)
+        compression = compression_config(self.config['cache_compression'])
+        return [CompressedCache(cache, compression) for cache in caches]
+
+    # servers, base directories and config file, resolved once for every configuration (the most recent ones)
+    _setups: 'OrderedDict[str, Tuple[List[Dict], bool, List[str], Optional[str]]]' = OrderedDict()
+    _setups_lock = threading.Lock()
+    MAX_SETUPS = 64
+
+    def __setup(self, ctx: RenderContext) -> Optional[str]:
+        """
+        Resolves servers, base directories and the PlantUML config file. The resolution is done only the first time a
+        configuration is found, and reused for the following documents.
+
+        Returns:
+            Optional[str]: An error message if the config file cannot be found, None otherwise.
+        """
+        key = json.dumps([self.config[name] for name in ('servers', 'server', 'kroki_server', 'base_dir', 'config')],
+                         default=str)
+
+        with self._setups_lock:
+            setup = self._setups.get(key)
+            if setup is not None:
+                self._setups.move_to_end(key)
+
+        if setup is None:
+            servers, kroki_server = self.__resolve_servers()
+            base_dir = self.config['base_dir']
+
+            if not isinstance(base_dir, list):
+                base_dir = [base_dir]
+
+            # make sure they are strings (can be DocsDirPlaceholder is !relative is used in mkdocs.yml)
+            base_dir = [str(v) for v in base_dir]
+            config_path = None
+            err = None
+
+            if self.config['config']:
+                config_path = self.config['config']
+                # try to find config file
+                for search_dir in base_dir:
+                    if os.path.isfile(os.path.join(search_dir, self.config['config'])):
+                        config_path = os.path.join(search_dir, self.config['config'])
+                        break
+                else:
+                    # not kept, the file is searched again for the next document
+                    ctx.plantuml_servers, ctx.kroki_server, ctx.base_dir, ctx.config_path = \
+                        servers, kroki_server, base_dir, config_path
+                    return f'Could not find config file {config_path} in any of {base_dir}'
+
+            setup = (servers, kroki_server, base_dir, config_path)
+
+            with self._setups_lock:
+                self._setups[key] = setup
+                while len(self._setups) > self.MAX_SETUPS:
+                    self._setups.popitem(last=False)
+
+        ctx.plantuml_servers, ctx.kroki_server, ctx.base_dir, ctx.config_path = setup
+        return None
+
+    def __resolve_servers(self) -> Tuple[List[Dict], bool]:
+        plantuml_servers = []
+        kroki_server = False
+
         if 'servers' in self.config and isinstance(self.config['servers'], list):
-            self._plantuml_servers = self.config['servers']
+            plantuml_servers = list(self.config['servers'])
 
         # get the remote server, for compatibility: it overrides the `servers` configuration
         if self.config['server'] and not isinstance(self.config['server'], list):
-            self._plantuml_servers = [self.config['server']]
+            plantuml_servers = [self.config['server']]
         elif self.config['server'] != '':
-            self._plantuml_servers = self.config['server']
+            plantuml_servers = list(self.config['server'])
 
         # handle the kroki server, for compatibility
         if isinstance(self.config['kroki_server'], bool):                         # new configuration
-            self._kroki_server = self.config['kroki_server']
+            kroki_server = self.config['kroki_server']
         elif self.config['kroki_server'] in ('True', 'False', 'true', 'false'):   # needed to parse the default value
-            self._kroki_server = self.config['kroki_server'] in ['True', 'true']
+            kroki_server = self.config['kroki_server'] in ['True', 'true']
         else:                                                                     # old configuration, it holds an url
-            self._kroki_server = True
-            self._plantuml_servers.insert(0, str(self.config['kroki_server']))
+            kroki_server = True
+            plantuml_servers.insert(0, str(self.config['kroki_server']))
 
         # fix urls if needed
         servers = []
-        for entry in self._plantuml_servers:
+        for entry in plantuml_servers:
             kroki = None  # default is autodetect
+            rate, burst = 0.0, 0
             if isinstance(entry, dict):
                 # check if it is a kroki server
                 kroki = entry['kroki'] in ('true', 'True', True) if 'kroki' in entry else None
                 url = str(entry['url']) if 'url' in entry else None
+                # requests per second allowed by the server, and how many can be sent at once
+                rate = float(entry.get('rate', 0))
+                burst = int(entry.get('burst', 0)) or max(1, int(rate))
             else:
                 url = entry
             if url:
@@ -212,9 +1016,9 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
                     url += '/plantuml/'
                 if not url.endswith('/'):             # make sure the url ends with a `/`
                     url += '/'
-                servers.append({'url': url, 'kroki': kroki})
+                servers.append({'url': url, 'kroki': kroki, 'rate': rate, 'burst': burst})
 
-        self._plantuml_servers = servers
+        return servers, kroki_server
 
     # regex for removing some parts from the plantuml generated svg
     ADAPT_SVG_REGEX = re.compile(r'^<\?xml .*?\?>')
@@ -237,10 +1041,24 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
             if not m:
                 return text, len(text)
 
+        # blocks are identified by their id, or by their position in the page
+        self._context.stale_key = None
+        if self._context.page_key:
+            block = f"{self._context.page_key}:{m.group('id') or self._context.block_index}"
+            self._context.stale_key = hashlib.sha1(block.encode('utf-8')).hexdigest()[:16]
+        self._context.block_index += 1
+
+        if self._context.manifest and self._context.prefetch is None:
+            # the block may have been already rendered
+            diag_tag = self._context.manifest.get(m.group(0), self.md, self._reused_html)
+            if diag_tag is not None:
+                return text[:m.start()] + m.group('indent') + diag_tag + text[m.end():], \
+                       m.start() + len(m.group('indent')) + len(diag_tag)
+
         # Parse configuration params
         img_format = m.group('format') if m.group('format') else self.config['format']
         source = m.group('source') if m.group('source') else None
-        self._lang: str = m.group('lang')
+        self._context.lang = m.group('lang')
         options = {
             'classes': m.group('classes') if m.group('classes') else self.config['classes'],
             'alt': m.group('alt') if m.group('alt') else self.config['alt'],
@@ -262,14 +1080,16 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
 
         # Extract the PlantUML code.
         code = ""
+        depends = [self._context.config_path] if self._context.config_path else []
         # Add external diagram source.
-        if source and self._base_dir:
-            for base_dir in self._base_dir:
+        if source and self._context.base_dir:
+            for base_dir in self._context.base_dir:
                 source_path = os.path.join(base_dir, source)
 
                 if os.path.exists(source_path):
-                    with open(source_path, 'r', encoding=self._encoding) as f:
+                    with open(source_path, 'r', encoding=self._context.encoding) as f:
                         code += f.read()
+                    depends.append(source_path)
                     break
             else:
                 diag_tag = self._render_error('Cannot find external diagram source: ' + source)
@@ -278,30 +1098,60 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
         # Add extracted markdown diagram text.
         code += m.group('code')
 
+        if self._context.max_source_size and len(code.encode('utf-8')) > self._context.max_source_size:
+            # not even sent to PlantUML
+            logger.error(f'[plantuml_markdown] Diagram source larger than {self._context.max_source_size} bytes')
+            diag_tag = self._render_error(f'[uml directive] Diagram source too large: more than '
+                                          f'{self._context.max_source_size} bytes')
+            return (text[:m.start()] + m.group('indent') + diag_tag + text[m.end():],
+                    m.start() + len(m.group('indent')) + len(diag_tag))
+
+        if self._context.prefetch is not None:
+            # the diagram is only collected, to be rendered later
+            self._context.prefetch.append((code, img_format, requested_format))
+            return text, m.end()
+
         # Extract diagram source end convert it
-        diagram, err = self._render_diagram(code, requested_format)
+        self._context.render_failed = False
+        dark_diagram = None
+        if self.config['dark_theme'] and img_format != 'txt':
+            diagram, dark_diagram, err = self._render_variants(code, requested_format)
+        else:
+            diagram, err = self._render_diagram(code, requested_format)
 
         if err:
             # there is an error message: create a nice tag to show it
             diag_tag = self._render_error(err)
         else:
-            diag_tag = self._image_tag(img_format, diagram, options, code)
+            diag_tag = self._image_tag(img_format, diagram, options, code, dark_diagram)
+
+        if self._context.manifest and not self._context.render_failed and not self.LOCAL_INCLUDE_RE.search(code):
+            self._context.manifest.put(m.group(0), diag_tag, self.md, depends)
 
         return text[:m.start()] + m.group('indent') + diag_tag + text[m.end():], \
                m.start() + len(m.group('indent')) + len(diag_tag)
 
-    def _image_tag(self, img_format: str, diagram: bytes, options: Dict[str, Optional[str]], code: str) -> str:
+    def _image_tag(self, img_format: str, diagram: bytes, options: Dict[str, Optional[str]], code: str,
+                   dark_diagram: Optional[bytes] = None) -> str:
         if img_format == 'txt':
             return self._txt_code(diagram)
         # These are images
+        elif img_format in ('svg_inline', 'svg_object') and dark_diagram is not None:
+            # there is no `picture` equivalent: both variants are added, and CSS shows only one of them
+            render = self._inline_svg_image if img_format == 'svg_inline' else self._svg_object_image
+            light_options = dict(options, classes=f"{options['classes']} plantuml-light")
+            dark_options = dict(options, classes=f"{options['classes']} plantuml-dark",
+                                id=f"{options['id']}-dark" if options['id'] else None)
+            self._context.dark_mode_style = True
+            return render(diagram, light_options) + render(dark_diagram, dark_options)
         elif img_format == 'svg_inline':
             return self._inline_svg_image(diagram, options)
         elif img_format == 'svg':
-            return self._svg_image(diagram, options)
+            return self._svg_image(diagram, options, dark_diagram)
         elif img_format == 'svg_object':
             return self._svg_object_image(diagram, options)
         else:  # png format, explicitly set or as a default when format is not recognized
-            return self._png_image(diagram, options, code)
+            return self._png_image(diagram, options, code, dark_diagram)
 
     def _txt_code(self, diagram: bytes) -> str:
         # logger.debug(diagram)
@@ -320,35 +1170,53 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
             # remove width and height in style attribute
             img.attrib['style'] = re.sub(r'\b(?:width|height):\d+px;', '', img.attrib['style'])
         img.attrib['preserveAspectRatio'] = 'xMaxYMax meet'
-        self._set_tag_attributes(img, options)
+        self._set_tag_attributes(img.attrib, options)
 
         return self.md.htmlStash.store(etree.tostring(img, short_empty_elements=True).decode())
 
-    def _svg_image(self, diagram: bytes, options: Dict[str, Optional[str]]) -> str:
+    def _svg_image(self, diagram: bytes, options: Dict[str, Optional[str]],
+                   dark_diagram: Optional[bytes] = None) -> str:
         # Firefox handles only base64 encoded SVGs
-        data = 'data:image/svg+xml;base64,{0}'.format(base64.b64encode(diagram).decode('ascii'))
-        img = etree.Element('img')
-        img.attrib['src'] = data
-        self._set_tag_attributes(img, options)
-        return etree.tostring(img, short_empty_elements=True).decode()
+        attrib = {'src': DataURI('image/svg+xml', diagram)}
+        self._set_tag_attributes(attrib, options, self._diagram_size(diagram))
+        self._set_loading_attributes(attrib)
+        diag_tag = html_tag('img', attrib)
+
+        if dark_diagram is not None:
+            diag_tag = self._picture(diag_tag, DataURI('image/svg+xml', dark_diagram))
+        return self.md.htmlStash.store(join_tags(diag_tag))
 
     def _svg_object_image(self, diagram: bytes, options: Dict[str, Optional[str]]) -> str:
         # Firefox handles only base64 encoded SVGs
-        data = 'data:image/svg+xml;base64,{0}'.format(base64.b64encode(diagram).decode('ascii'))
-        img = etree.Element('object')
-        img.attrib['data'] = data
-        self._set_tag_attributes(img, options)
+        attrib = {'data': DataURI('image/svg+xml', diagram)}
+        self._set_tag_attributes(attrib, options, self._diagram_size(diagram))
         # object tag must be explicitly closed
-        return etree.tostring(img, short_empty_elements=False).decode()
+        return self.md.htmlStash.store(join_tags(html_tag('object', attrib, short_empty_elements=False)))
+
+    def _reused_html(self, html: str) -> str:
+        """
+        Prepares the HTML of a block reused from the render manifest for the current page.
+        """
+        if 'plantuml-dark' in html:
+            self._context.dark_mode_style = True
+        return self._renumber_maps(html)
 
-    def _png_image(self, diagram: bytes, options: Dict[str, Optional[str]], code: str) -> str:
+    def _renumber_maps(self, html: str) -> str:
+        """
+        Moves the image maps of reused HTML to the position of the current block, keeping their ids unique.
+        """
+        if 'plantuml-map-' not in html:
+            return html
+        return self.MAP_ID_RE.sub(lambda m: m.group(1) + str(self._context.block_index), html)
+
+    def _png_image(self, diagram: bytes, options: Dict[str, Optional[str]], code: str,
+                   dark_diagram: Optional[bytes] = None) -> str:
         map_tag = ''
-        data = 'data:image/png;base64,{0}'.format(base64.b64encode(diagram).decode('ascii'))
-        img = etree.Element('img')
-        img.attrib['src'] = data
+        attrib = {'src': DataURI('image/png', diagram)}
 
-        # check if image maps are enabled
-        if self._image_maps:
+        # check if image maps are enabled; the map of the light variant is used by the dark one too, as a `picture`
+        # has a single `img`
+        if self._context.image_maps:
             # Check for hyperlinks
             map_data, err = self._render_diagram(code, 'map')
 
@@ -359,84 +1227,348 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
                 map_data = map_data.decode("utf-8")
 
                 if map_data.startswith('<map '):
-                    # There are hyperlinks, add the image map
-                    unique_id = str(uuid.uuid4())
+                    # There are hyperlinks, add the image map; the id depends only on the diagram and its position
+                    # in the page, so the same page is always converted to the same HTML
+                    unique_id = f'plantuml-map-{self._diagram_key(code)}-{self._context.block_index}'
                     map = etree.fromstring(map_data)
                     map.attrib['id'] = unique_id
                     map.attrib['name'] = unique_id
                     map_tag = etree.tostring(map, short_empty_elements=True).decode()
-                    img.attrib['usemap'] = '#' + unique_id
+                    attrib['usemap'] = '#' + unique_id
 
-        self._set_tag_attributes(img, options)
-        diag_tag = etree.tostring(img, short_empty_elements=True).decode()
+        self._set_tag_attributes(attrib, options, self._diagram_size(diagram))
+        self._set_loading_attributes(attrib)
+        diag_tag = html_tag('img', attrib)
 
-        return diag_tag + map_tag
+        if dark_diagram is not None:
+            diag_tag = self._picture(diag_tag, DataURI('image/png', dark_diagram))
+        return self.md.htmlStash.store(join_tags(diag_tag) + map_tag)
 
     @staticmethod
-    def _set_tag_attributes(img, options: Dict[str, Optional[str]]):
+    def _picture(img_tag: List[Union[bytes, DataURI]], dark_data: DataURI) -> List[Union[bytes, DataURI]]:
+        """
+        Wraps an image in a `picture` tag, with the dark variant of the diagram as alternative source.
+        """
+        source = html_tag('source', {'media': '(prefers-color-scheme: dark)', 'srcset': dark_data})
+        return [b'<picture>'] + source + img_tag + [b'</picture>']
+
+    def _diagram_size(self, diagram: bytes) -> Optional[Tuple[int, int]]:
+        return image_size(diagram) if self._context.intrinsic_size else None
+
+    def _set_loading_attributes(self, attrib: Dict):
+        if self._context.lazy_loading:
+            attrib['loading'] = 'lazy'
+            attrib['decoding'] = 'async'
+
+    @staticmethod
+    def _set_tag_attributes(attrib: Dict, options: Dict[str, Optional[str]], size: Optional[Tuple[int, int]] = None):
         styles = []
-        if 'style' in img.attrib and img.attrib['style'] != '':
-            styles.append(re.sub(r';$', '', img.attrib['style']))
+        if 'style' in attrib and attrib['style'] != '':
+            styles.append(re.sub(r';$', '', attrib['style']))
         if options['width']:
             styles.append("max-width:" + options['width'])
         if options['height']:
             styles.append("max-height:" + options['height'])
 
         if styles:
-            img.attrib['style'] = ";".join(styles)
-            img.attrib['width'] = '100%'
-            if 'height' in img.attrib:
-                img.attrib.pop('height')
-
-        img.attrib['class'] = options['classes']
-        img.attrib['alt'] = options['alt']
-        img.attrib['title'] = options['title']
+            if size:
+                # the image is scaled by the browser, but the space to reserve is still known
+                styles.append("aspect-ratio:%d/%d" % size)
+            attrib['style'] = ";".join(styles)
+            attrib['width'] = '100%'
+            if 'height' in attrib:
+                attrib.pop('height')
+        elif size:
+            attrib['width'] = str(size[0])
+            attrib['height'] = str(size[1])
+
+        attrib['class'] = options['classes']
+        attrib['alt'] = options['alt']
+        attrib['title'] = options['title']
 
         if options['id']:
-            img.attrib['id'] = options['id']
+            attrib['id'] = options['id']
 
     @staticmethod
     def _render_error(msg: str) -> str:
         return f'<div style="color: red">{msg}</div>'
 
     def _render_diagram(self, code: str, requested_format: str) -> Tuple[Optional[bytes], Optional[str]]:
-        cached_diagram_file = None
         diagram = None
+        diagram_name = self._diagram_key(code) + '.' + requested_format
 
-        if self._cache_dir:
-            os.makedirs(self._cache_dir, exist_ok=True)
-            diagram_hash = "%08x" % (adler32(code.encode('UTF-8')) & 0xffffffff)
-            cached_diagram_file = os.path.expanduser(
-                    os.path.join(self._cache_dir, diagram_hash + '.' + requested_format))
-
-            if os.path.isfile(cached_diagram_file):
-                with open(cached_diagram_file, 'rb') as f:
-                    diagram = f.read()
+        stale_key = f'{self._context.stale_key}.{requested_format}' if self._context.stale_key else None
 
+        # the error of the diagram, if it has already failed, is looked up together
+        error_name = diagram_name + '.err' if self._context.error_cache_ttl else None
+        found = self._cache_lookup([diagram_name], [error_name] if error_name else [])
+        diagram = found.get(diagram_name)
         if diagram is not None:
             # if cache found then end this function here
+            if stale_key:
+                StaleOutputs.put(stale_key, diagram_name, diagram, self._context.caches)
             return diagram, None
 
-        # if cache not found create the diagram
+        if error_name in found:
+            # the diagram has already failed, with an error that cannot change
+            err = self._cached_error(error_name, found[error_name])
+            if err is not None:
+                self._context.render_failed = True
+                return None, err
+
+        if stale_key:
+            stale = StaleOutputs.get(stale_key, self._context.caches, self._context.max_stale)
+            if stale is not None:
+                if stale[0] == diagram_name:
+                    return stale[1], None  # not stale at all, the diagram is unchanged
+                # serve the previous output of the block, and render the new one in background, with its own copy of
+                # the context: it must not change the page state, and the page render budget does not apply to it
+                context = copy.copy(self._context)
+                context.deadline = None
+                StaleOutputs.refresh(diagram_name,
+                                     lambda: self._render_in_context(context, code, requested_format, diagram_name,
+                                                                     stale_key))
+                self._context.render_failed = True  # the HTML is not final
+                return stale[1], None
+
+        err = self._budget_error()
+        if err:
+            return None, err
+
+        diagram, err = self._render_fresh(code, requested_format, diagram_name, self._context.caches, stale_key)
+        if err:
+            self._context.render_failed = True
+        return diagram, err
+
+    def _cache_lookup(self, names: List[str], optional: List[str] = ()) -> Dict[str, bytes]:
+        """
+        Searches entries through the cache layers in order; with `cache_promote`, the entries found in a layer are
+        copied to the first writable layer before it. The `optional` entries are read in the same requests, but the
+        search stops as soon as all the `names` are found, and they are not promoted.
+        """
+        found: Dict[str, bytes] = {}
+        writable = None
+        for cache in self._context.caches:
+            hits = cache.get_many([name for name in list(names) + list(optional) if name not in found])
+            if hits and writable is not None and self._context.cache_promote:
+                for name, data in hits.items():
+                    if name not in optional:
+                        writable.put(name, data)
+            found.update(hits)
+            if all(name in found for name in names):
+                break
+            if writable is None and not cache.read_only:
+                writable = cache
+        return found
+
+    def _diagram_key(self, code: str) -> str:
+        """
+        Returns the cache key of a diagram: equivalent sources have the same key with `normalize_cache_keys`.
+        """
+        if self._context.normalize_cache_keys:
+            code = canonical_source(code)
+        return "%08x" % (adler32(code.encode('UTF-8')) & 0xffffffff)
+
+    def _render_in_context(self, context: RenderContext, code: str, requested_format: str, diagram_name: str,
+                           stale_key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        # background renders run in other threads, which see the context of the page that requested them
+        self._local.context = context
+        try:
+            return self._render_fresh(code, requested_format, diagram_name, context.caches, stale_key, background=True)
+        finally:
+            self._local.context = None
+
+    def _budget_error(self) -> Optional[str]:
+        """
+        Returns an error message if the render budget of the page is exhausted.
+        """
+        if self._remaining_time() == 0:
+            # do not wait for other diagrams
+            logger.warning('[plantuml_markdown] Page render budget exhausted, diagram not rendered')
+            self._context.render_failed = True
+            return '[uml directive] Diagram not rendered: page render budget exhausted'
+        return None
+
+    def _render_variants(self, code: str, requested_format: str) -> Tuple[Optional[bytes], Optional[bytes],
+                                                                          Optional[str]]:
+        """
+        Renders the light and the dark variants of a diagram together, and caches them as a pair; the light variant is
+        shared with the pages rendered without dark variants.
+
+        Returns:
+            Tuple[Optional[bytes], Optional[bytes], Optional[str]]: The light and dark images, or an error message.
+        """
+        key = self._diagram_key(code)
+        names = [f'{key}.{requested_format}', f'{key}.dark.{requested_format}']
+
+        found = self._cache_lookup(names)
+        if len(found) == len(names):
+            return found[names[0]], found[names[1]], None
+
+        err = self._budget_error()
+        if err:
+            return None, None, err
+
+        themes = [self.config['theme'].strip(), self.config['dark_theme'].strip()]
+        start = time.perf_counter()
+        if self._context.plantuml_servers:
+            # the connections are shared by both variants
+            with self._set_session(self._context.plantuml_servers) as session:
+                diagrams, err = self._render_remote_variants(code, requested_format, themes, session)
+        else:
+            diagrams, err = self._render_local_variants(code, requested_format, themes)
+            self._context.rendered_by = 'local'
+
+        if err:
+            self._context.render_failed = True
+            return None, None, err
+
+        render_time = (time.perf_counter() - start) / len(names)
+        for cache in self._context.caches:
+            if not cache.read_only:
+                for name, diagram in zip(names, diagrams):
+                    cache.put(name, diagram, render_time, self._context.rendered_by)
+                break
+
+        return diagrams[0], diagrams[1], None
+
+    def _render_local_variants(self, code: str, img_format: str,
+                               themes: List[str]) -> Tuple[Optional[List[bytes]], Optional[str]]:
+        """
+        Renders the variants of a diagram with a single PlantUML process.
+        """
+        sources = []
+        for theme in themes:
+            source = self._set_theme(code, theme).strip()
+            if not source.startswith('@start'):
+                source = f'@startuml\n{source}\n@enduml'
+            sources.append(source)
+
+        out, err = self._render_local_uml_image('\n'.join(sources) + '\n', img_format, PIPE_DELIMITER)
+        if err:
+            return None, err
+
+        diagrams = [diagram.lstrip(b'\r\n') for diagram in out.split(PIPE_DELIMITER)][:len(themes)]
+        if len(diagrams) < len(themes):
+            logger.error('[plantuml_markdown] PlantUML has not rendered all the variants of the diagram')
+            return None, '[uml directive] Cannot render the diagram variants'
+        return diagrams, None
+
+    def _render_remote_variants(self, code: str, img_format: str, themes: List[str],
+                                session: 'requests.Session') -> Tuple[Optional[List[bytes]], Optional[str]]:
+        """
+        Renders the variants of a diagram with remote servers. Includes are expanded once, unless some file names
+        contain the light theme name: then the dark variant includes the files named after the dark theme.
+        """
+        code = self._with_config(code)
+        includer = PlantUMLIncluder(self._context.lang, self._context.kroki_server, self.config['server_include_whitelist'], False,
+                                    themes[0] or None, themes[1])
+        light_source = includer.readFile(code, self._context.base_dir)
+        dark_source = light_source
+        if includer.themed_includes:
+            dark_source = PlantUMLIncluder(self._context.lang, self._context.kroki_server, self.config['server_include_whitelist'],
+                                           True, themes[0], themes[1]).readFile(code, self._context.base_dir)
+
+        err = self._include_size_error(light_source) or self._include_size_error(dark_source)
+        if err:
+            return None, err
+
+        diagrams = []
+        for source, theme in zip((light_source, dark_source), themes):
+            diagram, err = self._render_remote_source(self._set_theme(source, theme), img_format, session)
+            if err:
+                return None, err
+            diagrams.append(diagram)
+        return diagrams, None
+
+    def _render_fresh(self, code: str, requested_format: str, diagram_name: str, caches: List[CacheBackend],
+                      stale_key: Optional[str] = None,
+                      background: bool = False) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Renders a diagram, and saves it in the caches; background renders are flushed at once, as they end after the
+        page.
+        """
         code = self._set_theme(code)
+        start = time.perf_counter()
 
-        if self._plantuml_servers:
+        if self._context.plantuml_servers:
             # remote rendering
-            with self._set_session() as session:
+            with self._set_session(self._context.plantuml_servers) as session:
                 diagram, err = self._render_remote_uml_image(code, requested_format, session)
         else:
             # local rendering
             diagram, err = self._render_local_uml_image(code, requested_format)
+            self._context.rendered_by = 'local'
 
-        if not err and self._cache_dir:
-            with open(cached_diagram_file, 'wb') as f:
-                f.write(diagram)
+        if not err:
+            for cache in caches:
+                if not cache.read_only:
+                    cache.put(diagram_name, diagram, time.perf_counter() - start, self._context.rendered_by)
+                    break
+            if stale_key:
+                StaleOutputs.put(stale_key, diagram_name, diagram, caches)
+        elif isinstance(err, DiagramError) and self._context.error_cache_ttl:
+            # save the error, so the diagram is not sent again until it changes
+            entry = json.dumps({'error': err, 'expires': time.time() + self._context.error_cache_ttl})
+            for cache in caches:
+                if not cache.read_only:
+                    cache.put(diagram_name + '.err', entry.encode('utf-8'))
+                    break
+
+        if background:
+            for cache in caches:
+                cache.flush()
 
         return diagram, err
 
+    def _cached_error(self, error_name: str, entry: bytes) -> Optional[DiagramError]:
+        """
+        Returns the cached error message of a diagram, if not expired; expired and corrupted errors are removed from
+        the cache.
+        """
+        try:
+            entry = json.loads(entry)
+            if entry['expires'] > time.time():
+                return DiagramError(entry['error'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f'[plantuml_markdown] Ignoring corrupted cache entry {error_name}')
+        for cache in self._context.caches:
+            if not cache.read_only:
+                cache.delete(error_name)  # where errors are saved
+                break
+        return None
+
+    def _remaining_time(self) -> Optional[float]:
+        """
+        Returns the seconds left to render the diagrams of the page, or None if there is no render budget.
+        """
+        if self._context.deadline is None:
+            return None
+        return max(0.0, self._context.deadline - time.monotonic())
+
+    def _timeout(self, timeout: Optional[float]) -> Optional[float]:
+        """
+        Limits a timeout to the render budget left for the page.
+        """
+        remaining = self._remaining_time()
+        if remaining is None:
+            return timeout
+        return min(timeout, remaining) if timeout else remaining
+
     @staticmethod
-    def _set_session() -> Session:
-        retries = Retry(
+    def _set_session(servers: List[Dict] = ()) -> 'requests.Session':
+        import requests
+        from requests.adapters import HTTPAdapter, Retry
+        from urllib3.exceptions import ReadTimeoutError
+
+        class Retries(Retry):
+            def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+                # the server has already used all the time it had: try the next one instead
+                if isinstance(error, ReadTimeoutError):
+                    raise error
+                return super().increment(method, url, response, error, *args, **kwargs)
+
+        retries = Retries(
             total=3,
             backoff_factor=1,
             respect_retry_after_header=True,
@@ -446,10 +1578,18 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
         session = requests.Session()
         session.mount('http://', adapter)
         session.mount('https://', adapter)
+
+        # 429 answers from rate limited servers are handled by their rate limiter, not by sleeping in the request
+        limited = HTTPAdapter(max_retries=retries.new(status_forcelist=[500, 502, 503, 504],
+                                                      respect_retry_after_header=False))
+        for srv in servers:
+            if srv.get('rate'):
+                session.mount(srv['url'], limited)
         return session
 
-    def _set_theme(self, code):
-        theme = self.config['theme'].strip()
+    def _set_theme(self, code: str, theme: Optional[str] = None) -> str:
+        if theme is None:
+            theme = self.config['theme'].strip()
 
         if theme:
             # if theme configured, add it to the beginning of plantuml code
@@ -494,96 +1634,302 @@ class PlantUMLPreprocessor(markdown.preprocessors.Preprocessor):
 
         return code
 
-    def _render_local_uml_image(self, plantuml_code: str, img_format: str) -> Tuple[Optional[bytes], Optional[str]]:
+    def _render_local_uml_image(self, plantuml_code: str, img_format: str,
+                                delimiter: Optional[bytes] = None) -> Tuple[Optional[bytes], Optional[str]]:
         plantuml_code = plantuml_code.encode('utf8')
         cmdline = self.config['plantuml_cmd'].split(' ')
         cmdline.extend(['-pipemap' if img_format == 'map' else '-p', "-t" + img_format, '-charset', 'UTF-8'])
 
-        if self._config_path:
-            cmdline.extend(['-config', self._config_path])
+        if delimiter:
+            # several diagrams in the input, the images are separated by the delimiter
+            cmdline.extend(['-pipedelimitor', delimiter.decode('ascii')])
+
+        if self._context.config_path:
+            cmdline.extend(['-config', self._context.config_path])
+
+        # the budget may have been spent preparing the diagram, and a timeout of 0 would mean no timeout
+        err = self._budget_error()
+        if err:
+            return None, err
 
         try:
-            # On Windows run batch files through a shell so the extension can be resolved
-            p = Popen(cmdline, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=(os.name == 'nt'))
-            out, err = p.communicate(input=plantuml_code)
+            result = None
+            if self.config['daemon_socket']:
+                from .daemon import render
+                # the render daemon shared by the builds of the host, if running
+                result = render(self.config['daemon_socket'], cmdline, plantuml_code,
+                                self._timeout(self._context.local_timeout), self._context.max_output_size)
+
+            if result is not None:
+                out, returncode, err = result
+            else:
+                out, returncode, err = run_plantuml(cmdline, plantuml_code, self._timeout(self._context.local_timeout),
+                                                    self._context.max_output_size)
+        except TimeoutExpired:
+            # a stuck PlantUML must not stop the whole build
+            logger.error(f'[plantuml_markdown] Timeout running plantuml')
+            return None, '[uml directive] Timeout rendering the diagram'
+        except DiagramTooLarge as exc:
+            # neither a runaway diagram
+            logger.error(f'[plantuml_markdown] Diagram output larger than {exc.max_size} bytes, render stopped')
+            return None, str(exc)  # not cached, it depends on the limit
         except Exception as exc:
             raise Exception(f'[plantuml_markdown] Failed to run plantuml: {exc}')
         else:
-            if p.returncode != 0:
+            if returncode != 0:
                 # plantuml returns a nice image in case of syntax error so log but still return out
                 logger.error(f'[plantuml_markdown] Error in "uml" directive: {err}')
 
             return out, None
 
     def _render_remote_uml_image(
-            self, plantuml_code: str, img_format: str, session: requests.Session
+            self, plantuml_code: str, img_format: str, session: 'requests.Session'
         ) -> Tuple[Optional[bytes], Optional[str]]:
-        if self._config_path:
-            # insert an include directive for the config file as the first statement
-            plantuml_code = re.sub(r'^\s*(@start\w+\n)?', r'\1!include '+self._config_path+'\n', plantuml_code)
-
         # build the whole source diagram, executing include directives
-        temp_file = PlantUMLIncluder(self._lang, self._kroki_server,
+        temp_file = PlantUMLIncluder(self._context.lang, self._context.kroki_server,
                                      self.config['server_include_whitelist'],
-                                     False).readFile(plantuml_code, self._base_dir)
+                                     False).readFile(self._with_config(plantuml_code), self._context.base_dir)
+        err = self._include_size_error(temp_file)
+        if err:
+            return None, err
+        return self._render_remote_source(temp_file, img_format, session)
+
+    def _include_size_error(self, source: str) -> Optional[str]:
+        """
+        Returns an error message if the diagram source, with the includes expanded, is too large.
+        """
+        if self._context.max_include_size and len(source.encode('utf-8')) > self._context.max_include_size:
+            logger.error(f'[plantuml_markdown] Diagram source with includes larger than '
+                         f'{self._context.max_include_size} bytes')
+            return f'[uml directive] Diagram source too large with includes: more than ' \
+                   f'{self._context.max_include_size} bytes'
+        return None
+
+    def _with_config(self, plantuml_code: str) -> str:
+        if self._context.config_path:
+            # insert an include directive for the config file as the first statement
+            plantuml_code = re.sub(r'^\s*(@start\w+\n)?', r'\1!include '+self._context.config_path+'\n', plantuml_code)
+        return plantuml_code
+
+    def _minify(self, source: str) -> str:
+        """
+        Minifies a diagram source, measuring the bytes saved.
+        """
+        minified = minify_source(source)
+        size, minified_size = len(source.encode('utf-8')), len(minified.encode('utf-8'))
+        with self._stats_lock:
+            self.minify_stats['diagrams'] += 1
+            self.minify_stats['source_bytes'] += size
+            self.minify_stats['minified_bytes'] += minified_size
+        logger.debug(f'[plantuml_markdown] Diagram source minified from {size} to {minified_size} bytes '
+                     f'({size - minified_size} bytes saved)')
+        return minified
+
+    def _render_remote_source(self, temp_file: str, img_format: str,
+                              session: 'requests.Session') -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Renders a diagram source, with all the local includes expanded, trying the servers in order.
+        """
+        import requests
+
+        if self._context.minify_source:
+            temp_file = self._minify(temp_file)
+
         ssl_verify = not self.config['insecure']
 
         if not ssl_verify:
             # urllib3 gives a warning is an insecure connection is made, and the warning is included in the output page
             # not the best solution, but it works
+            import urllib3
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
             # alternative solution
             # requests.packages.urllib3.disable_warnings()
 
-        for srv in self._plantuml_servers:
+        # the encodings are computed at most once, and shared by all the servers tried
+        body = temp_file.encode('utf-8')
+        encodings: Dict[bool, str] = {}
+
+        def get_url(server: Dict) -> str:
+            if server['kroki'] not in encodings:
+                encodings[server['kroki']] = self._compress_and_encode(temp_file) if server['kroki'] \
+                    else self._deflate_and_encode(temp_file)
+            return f"{server['url']}{img_format}/{encodings[server['kroki']]}"
+
+        for srv in self._context.plantuml_servers:
             try:
+                # what has been learned about the server: if POST is supported and the longest accepted GET url
+                methods = self._server_methods.setdefault(srv['url'], {'post': None, 'max_url': self._context.max_url_length})
+                method = self._context.http_method
+
+                if method == 'AUTO':
+                    # switch to POST if the url would be too long, unless the server does not support it
+                    too_long = len(get_url(srv)) > methods['max_url']
+                    method = 'POST' if too_long and methods['post'] is not False else 'GET'
+
                 # Use GET if preferred, use POST with GET as fallback if POST fails
-                if self._http_method == "POST":
-                    # image_url for POST attempt first
-                    image_url = f"{srv['url']}/{img_format}/"
-                    # download manually the image to be able to continue in case of errors
-                    r = session.post(image_url, data=temp_file, headers={"Content-Type": 'text/plain; charset=utf-8'},
-                                     verify=ssl_verify)
-
-                    if r.ok:
-                        return r.content, None
-                    logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' has returned error {r.status_code} on POST")
-                    if self._fallback_to_get:
+                if method == "POST":
+                    content, stop = self._post_diagram(session, srv, img_format, body, ssl_verify, methods)
+                    if stop:
+                        return content, None
+                    if self._context.fallback_to_get:
                         logger.warning('[plantuml_markdown] Falling back to GET')
                     else:
                         continue  # try another server
 
                 # issue a GET request
-                if srv['kroki']:
-                    compressed_diag = self._compress_and_encode(temp_file)
-                else:
-                    compressed_diag = self._deflate_and_encode(temp_file)
-                content, err, stop = self._handle_response(session.get(f"{srv['url']}{img_format}/{compressed_diag}", verify=ssl_verify), srv)
+                image_url = get_url(srv)
+                resp = self._send(session, srv, 'GET', image_url, verify=ssl_verify)
+
+                if resp.status_code == 414 and self._context.http_method == 'AUTO':
+                    resp.close()
+                    # the url is too long for the server (or a proxy before it): remember the limit and try POST
+                    logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' refused a {len(image_url)} "
+                                   f"characters url")
+                    methods['max_url'] = min(methods['max_url'], len(image_url) - 1)
+                    if method == 'GET' and methods['post'] is not False:
+                        content, stop = self._post_diagram(session, srv, img_format, body, ssl_verify, methods)
+                        if stop:
+                            return content, None
+                    continue
+
+                content, err, stop = self._handle_response(resp, srv)
 
                 if stop:
+                    self._context.rendered_by = srv['url']
                     if srv['kroki']:
-                        self._image_maps = False  # Kroki does not support image maps
+                        self._context.image_maps = False  # Kroki does not support image maps
                     return content, err  # no errors (return image) or unrecoverable error (return message)
+            except requests.exceptions.Timeout:
+                logger.warning(f"[plantuml_markdown] Timeout calling url '{srv['url']}'")
             except requests.exceptions.ConnectionError:
                 logger.warning(f"[plantuml_markdown] Connection error to url '{srv['url']}'")
+            except requests.exceptions.RetryError:
+                logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' keeps failing")
+            except DiagramTooLarge as exc:
+                # the other servers would send the same image
+                logger.error(f"[plantuml_markdown] Diagram from '{srv['url']}' larger than {exc.max_size} bytes, "
+                             f"download stopped")
+                return None, str(exc)  # not cached, it depends on the limit
+
+            if self._remaining_time() == 0:
+                logger.error(f'[plantuml_markdown] Page render budget exhausted')
+                return None, '[uml directive] Diagram not rendered: page render budget exhausted'
         else:
             logger.error(f'[plantuml_markdown] No server available')
             return None, '[uml directive] No server available'
 
-    def _handle_response(self, resp: Response, srv: dict) -> Tuple[Optional[bytes], Optional[str], Optional[bool]]:
-        if resp.status_code in (404, 500) :  # server error, report it so it can continue with another server
+    # what is known about each server, by url: if POST is supported (None if unknown) and the longest GET url accepted
+    _server_methods: Dict[str, Dict] = {}
+
+    def _post_diagram(self, session: 'requests.Session', srv: Dict, img_format: str, body: bytes, ssl_verify: bool,
+                      methods: Dict) -> Tuple[Optional[bytes], bool]:
+        """
+        Renders a diagram with a POST request.
+
+        Returns:
+            Tuple[Optional[bytes], bool]: The image, and True if the image has been rendered.
+        """
+        image_url = f"{srv['url']}/{img_format}/"
+        # download manually the image to be able to continue in case of errors
+        r = self._send(session, srv, 'POST', image_url, data=body,
+                       headers={"Content-Type": 'text/plain; charset=utf-8'}, verify=ssl_verify)
+
+        if r.ok:
+            methods['post'] = True
+            self._context.rendered_by = srv['url']
+            return self._read_content(r), True
+
+        r.close()
+        if r.status_code in (404, 405, 501):
+            methods['post'] = False  # POST not supported, do not try it again
+        logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' has returned error {r.status_code} on POST")
+        return None, False
+
+    # how many times a request is sent again to a rate limited server answering with 429
+    MAX_THROTTLED_RETRIES = 3
+
+    def _send(self, session: 'requests.Session', srv: Dict, method: str, url: str, **kwargs) -> 'requests.Response':
+        """
+        Sends a request to a server, respecting its rate limit.
+        """
+        # with a size limit, images are downloaded in chunks, stopping when the limit is exceeded
+        kwargs['stream'] = self._context.max_output_size > 0
+        if not srv.get('rate'):
+            return session.request(method, url, timeout=self._request_timeout(), **kwargs)
+
+        import requests
+        limiter = RateLimiter.for_server(srv['url'], srv['rate'], srv['burst'])
+        for _ in range(self.MAX_THROTTLED_RETRIES + 1):
+            if not limiter.acquire(self._remaining_time()):
+                raise requests.exceptions.Timeout(f"Rate limit of '{srv['url']}' exceeds the page render budget")
+            resp = session.request(method, url, timeout=self._request_timeout(), **kwargs)
+            if resp.status_code != 429:
+                limiter.succeeded()
+                return resp
+            resp.close()
+            logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' is throttling requests, slowing down")
+            limiter.throttled(RateLimiter.retry_after(resp.headers.get('Retry-After')))
+        return resp
+
+    def _request_timeout(self) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Returns the connect and read timeouts for a request, limited to the render budget left for the page.
+
+        Raises:
+            requests.exceptions.Timeout: If the render budget is exhausted, for example while waiting for the rate
+            limiter: requests does not accept a timeout of 0.
+        """
+        if self._remaining_time() == 0:
+            import requests
+            raise requests.exceptions.Timeout('Page render budget exhausted')
+        return self._timeout(self._context.timeouts[0]), self._timeout(self._context.timeouts[1])
+
+    def _read_content(self, resp: 'requests.Response') -> bytes:
+        """
+        Reads the body of a response, raising DiagramTooLarge as soon as it exceeds the maximum output size.
+        """
+        max_size = self._context.max_output_size
+        if not max_size:
+            return resp.content
+
+        try:
+            length = resp.headers.get('Content-Length', '')
+            if length.isdigit() and int(length) > max_size:
+                raise DiagramTooLarge(max_size)
+            chunks = []
+            size = 0
+            # the size of decompressed data is checked, so compressed answers cannot fool the limit
+            for chunk in resp.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > max_size:
+                    raise DiagramTooLarge(max_size)
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            resp.close()
+
+    # answers of Kroki servers meaning that the diagram itself is wrong, and that are remembered by the error cache
+    DIAGRAM_ERROR_STATUSES = (400, 422)
+
+    def _handle_response(self, resp: 'requests.Response', srv: dict) -> Tuple[Optional[bytes], Optional[str], Optional[bool]]:
+        if resp.status_code in (404, 429, 500) :  # server error, report it so it can continue with another server
             logger.warning(f"[plantuml_markdown] Remote server '{srv['url']}' not responding on GET")
-            return None, resp.text, False
+            resp.close()
+            return None, None, False
         elif resp.status_code != 200:
         # if not resp.ok:
             if srv['kroki']:
                 # Kroki sends and HTTP 400 with a text description of the error
+                message = self._read_content(resp).decode('utf-8')
                 logger.warning(f"[plantuml_markdown] Remote '{srv['url']}' server has returned error {resp.status_code} "
-                               f"on GET: {resp.content.decode('utf-8')}")
-                return None, resp.content.decode('utf-8'), True
+                               f"on GET: {message}")
+                if resp.status_code in self.DIAGRAM_ERROR_STATUSES:
+                    # a bad diagram; other client errors are about the request, like a wrong path or credentials
+                    return None, DiagramError(message), True
+                return None, message, True
 
         # the response is ok or the server is PlantUML, which sends always a valid image
-        return resp.content, None, True
+        return self._read_content(resp), None, True
 
     @staticmethod
     def _deflate_and_encode(source: str) -> str:
@@ -605,11 +1951,15 @@ class PlantUMLIncluder:
         self._dark_mode = dark_mode
         self._light_theme = light_theme
         self._dark_theme = dark_theme
+        # True if some included file names contain the light theme name
+        self.themed_includes = False
         self._definitions: Dict[str, str] = {}
         self._lang = lang
         self._kroki = kroki
         self._white_lists = white_lists
         self._diagram_type = 'uml'
+        # real paths of the included files
+        self._included: Set[str] = set()
 
     # Given a PlantUML source, replace any "!include" directive with the included code, recursively
     def readFile(self, plantuml_code: str, directory: List[str]) -> str:
@@ -624,27 +1974,24 @@ class PlantUMLIncluder:
             str: The processed PlantUML code with all "!include" directives replaced.
 
         """
-        lines = plantuml_code.splitlines()
+        # all the lines go in a single buffer, joined only at the end
+        out: List[str] = []
+        self._included.clear()
+        self._readFileRec(plantuml_code.splitlines(), directory, out)
         # Wrap the whole combined text between startuml and enduml tags as recursive processing would have removed them
         # This is necessary for it to work correctly with plamtuml POST processing
-        all_lines = self._readFileRec(lines, directory)
-        return "@start"+self._diagram_type+"\n" + "\n".join(all_lines) + "\n@end"+self._diagram_type+"\n"
+        return "@start"+self._diagram_type+"\n" + "\n".join(out) + "\n@end"+self._diagram_type+"\n"
 
     # Reads the file recursively
-    def _readFileRec(self, lines: List[str], search_dirs: List[str]) -> List[str]:
+    def _readFileRec(self, lines: Iterable[str], search_dirs: List[str], out: List[str]):
         """
         Recursively reads a list of lines and replaces any "!include" directives with the included code.
 
         Args:
-            lines (List[str]): The list of lines to process.
+            lines (Iterable[str]): The lines to process.
             search_dirs (List[str]): A list of directories to search for included files.
-
-        Returns:
-            List[str]: The processed list of lines with all "!include" directives replaced.
-
+            out (List[str]): The buffer receiving the processed lines.
         """
-        result: List[str] = []
-
         for line in lines:
             line_striped = line.strip()
 
@@ -658,9 +2005,9 @@ class PlantUMLIncluder:
             if match:
                 # variable definition, save the mapping as the value can be used in !include directives
                 self._definitions[match.group('varname')] = match.group('value')
-                result.append(line_striped)
+                out.append(line_striped)
             elif line_striped.startswith("!include"):
-                result.append(self._readInclLine(line_striped, search_dirs).strip())
+                self._readInclLine(line_striped, search_dirs, out)
             elif line_striped.startswith("@start"):
                 # remove startuml as plantuml POST method doesn't like it in include files
                 # we will wrap the whole combined text between start and end tags at the end
@@ -671,33 +2018,30 @@ class PlantUMLIncluder:
                 # we will wrap the whole combined text between start and end tags at the end
                 continue
             else:
-                result.append(line_striped)
+                out.append(line_striped)
 
-        return result
-
-    def _readInclLine(self, line: str, search_dirs: List[str]) -> str:
+    def _readInclLine(self, line: str, search_dirs: List[str], out: List[str]):
         """
-        Reads the contents of an included file and returns its contents.
+        Writes the contents of an included file, or the original line if the inclusion is handled by the server.
 
         Args:
             line (str): The line containing the !include directive.
             search_dirs (List[str]): A list of directories to search for the included file.
-
-        Returns:
-            str: The processed line containing the included file contents, or the original line if the inclusion is
-            handled by the server.
-
+            out (List[str]): The buffer receiving the processed lines.
         """
         # If includeurl is found, we do not have to do anything here. Server can handle that (if enabled)
         if "!includeurl" in line:
-            return line
+            out.append(line)
+            return
 
         # use line comment as a sort of "directive" for hinting that the file will be included by the server
         if re.match(r"[^']+'\s*server.*$", line):  # ex: !include file.puml 'server-side include
-            return line  # include handled by server, return it untouched
+            out.append(line)  # include handled by server, return it untouched
+            return
 
         # extract the file to include
-        line_match = re.match(r"^!include(?:_once|_many)?\s+(?P<filename>[^']+)(?:\s+'(?P<comment>.*))?$", line)
+        line_match = re.match(r"^!include(?P<kind>_once|_many)?\s+(?P<filename>[^']+)(?:\s+'(?P<comment>.*))?$",
+                              line)
         inc_file = line_match.group('filename')
 
         # expand variables to be able to detect what kind of file/include is
@@ -706,13 +2050,16 @@ class PlantUMLIncluder:
                 inc_file = inc_file.replace(varname, value)
                 break
 
-        if self._dark_mode:
-            inc_file = inc_file.replace(self._light_theme, self._dark_theme)
+        if self._light_theme and self._light_theme in inc_file:
+            self.themed_includes = True
+            if self._dark_mode:
+                inc_file = inc_file.replace(self._light_theme, self._dark_theme)
 
         # According to plantuml, simple !include can also have urls, or use the <> format to include stdlib files,
         # ignore that and continue
         if inc_file.startswith("http") or inc_file.startswith("<"):
-            return line  # handled by the server
+            out.append(line)  # handled by the server
+            return
 
         # At his point we have a file name/path; it may be handled by the server, or we need to execute the inclusion
         if re.match(r".*'\s*local.*$", line):  # include hint, ex: !include file.puml 'local file
@@ -722,21 +2069,20 @@ class PlantUMLIncluder:
             remote = any(re.match(r, inc_file) for r in self._white_lists)
 
         if remote:
-            return line  # inclusion handled by the server
+            out.append(line)  # inclusion handled by the server
         else:
-            # Read contents of the included file
-            return self._load_file(search_dirs, inc_file)
+            # Read contents of the included file; like PlantUML, only `!include_many` includes a file many times
+            self._load_file(search_dirs, inc_file, out, line_match.group('kind') != '_many')
 
-    def _load_file(self, search_dirs: List[str], inc_file_rel: str):
+    def _load_file(self, search_dirs: List[str], inc_file_rel: str, out: List[str], once: bool = False):
         """
         Loads a file from a list of search directories.
 
         Args:
             search_dirs (List[str]): A list of directories to search for the file.
             inc_file_rel (str): The relative path of the file to load.
-
-        Returns:
-            str: The contents of the loaded file.
+            out (List[str]): The buffer receiving the processed lines of the file.
+            once (bool): Skip the file if already included.
 
         Raises:
             FileNotFoundError: If the file is not found in any of the search directories.
@@ -745,11 +2091,26 @@ class PlantUMLIncluder:
         for inc_dir in search_dirs:
             inc_file_abs = os.path.normpath(os.path.join(inc_dir, inc_file_rel))
             if os.path.exists(inc_file_abs):
+                real_path = os.path.realpath(inc_file_abs)
+                if once and real_path in self._included:
+                    return  # already included, maybe with another path
+                self._included.add(real_path)
                 try:
                     with open(inc_file_abs, "r") as inc:
-                        include_dirs = [os.path.dirname(os.path.realpath(inc_file_abs))]
+                        include_dirs = [os.path.dirname(real_path)]
                         include_dirs.extend(search_dirs)
-                        return "\n".join(self._readFileRec(inc.readlines(), include_dirs))
+                        start = len(out)
+                        self._readFileRec(inc, include_dirs, out)
+                        # the included text is trimmed of the blank lines around it
+                        while len(out) > start and not out[-1]:
+                            out.pop()
+                        blank = start
+                        while blank < len(out) and not out[blank]:
+                            blank += 1
+                        del out[start:blank]
+                        if len(out) == start:
+                            out.append('')
+                        return
                 except Exception as exc:
                     logger.error("Could not find include " + str(exc))
                     raise exc
@@ -781,16 +2142,71 @@ class PlantUMLMarkdownExtension(markdown.Extension):
                                          "List of regular expressions defining which include files are supported by "
                                          "the server. Defaults to [r'^c4.*$']"],
             'insecure': [False, "Disable SSL certificates verification; set to True if you server uses self-signed certificates. Defaults to False"],
-            'cachedir': ["", "Directory for caching of diagrams. Defaults to '', no caching"],
+            'cachedir': ["", "Directory for caching of diagrams, or a list of cache layers searched in order: paths or "
+                             "dictionaries with the `path` and optionally `read_only` and `backend` keys. New diagrams "
+                             "are saved in the first writable layer. Defaults to '', no caching"],
+            'cache_backend': ["directory", "Cache backend: `directory` (a file for every diagram), `sqlite` (a single "
+                                           "database in `cachedir`), `http` (an HTTP object store at the `cachedir` "
+                                           "url) or a `module:Class` reference to a custom `CacheBackend`. "
+                                           "Defaults to 'directory'"],
+            'cache_compression': ["", "Compression of the text diagrams (svg, txt and map) saved in the cache: `zlib`, "
+                                      "`gzip` or `lzma` for all of them, or a mapping from format to method. "
+                                      "Defaults to '', no compression"],
+            'cache_promote': [False, "Copy the diagrams found in a cache layer to the first writable layer before it. "
+                                     "Defaults to False"],
+            'cache_pack': ["", "Cache pack file (see the `plantuml-markdown-cache` command), read when a diagram is "
+                               "not found in `cachedir`. Defaults to '', no cache pack"],
             'image_maps': ["true", "Enable generation of PNG image maps, allowing to use hyperlinks with PNG images."
                                    "Defaults to true"],
+            'intrinsic_size': [False, "Set the `width` and `height` of `png`, `svg` and `svg_object` diagrams to the "
+                                      "image size, so browsers can reserve the space before loading them. "
+                                      "Defaults to False"],
+            'lazy_loading': [False, "Add the `loading=\"lazy\"` and `decoding=\"async\"` attributes to `png` and "
+                                    "`svg` diagrams. Defaults to False"],
+            'render_manifest': [False, "Keep in memory the HTML of rendered diagram blocks, and reuse it when the same "
+                                       "block is converted again (useful with live-reload servers). "
+                                       "Defaults to False"],
+            'normalize_cache_keys': [False, "Compute the cache keys from a canonical form of the diagram sources, so "
+                                            "changes of indentation, line endings, trailing whitespace and comments "
+                                            "do not cause new renders. Defaults to False"],
             'priority': ["30", "Extension priority. Higher values means the extension is applied sooner than others. "
                                "Defaults to 30"],
             'base_dir': [".", "Base directory for external files inclusion. Defaults to '.', can be a list of paths."],
             'encoding': ["utf8", "Default character encoding for external files (default: utf8)"],
-            'http_method': ["GET", "Http Method for server - GET or POST", "Defaults to GET"],
+            'http_method': ["GET", "Http Method for server - GET, POST or AUTO (POST if the GET url is longer than "
+                                   "`max_url_length`)", "Defaults to GET"],
+            'max_include_size': [0, "Maximum size in bytes of a diagram source with the includes expanded (remote "
+                                    "rendering only), 0 for no limit. Defaults to 0"],
+            'max_output_size': [0, "Maximum size in bytes of a rendered diagram: PlantUML is stopped, or the download "
+                                   "aborted, as soon as it is exceeded; 0 for no limit. Defaults to 0"],
+            'max_source_size': [0, "Maximum size in bytes of a diagram source, 0 for no limit. Defaults to 0"],
+            'minify_source': [False, "Remove comments, blank lines and indentation from the diagram sources sent to "
+                                     "the servers. Defaults to False"],
+            'max_url_length': [4096, "With `http_method` AUTO, the longest url for a GET request; longer diagrams "
+                                     "are sent with POST. Defaults to 4096"],
             'fallback_to_get': [True, "Fallback to GET if POST fails", "Defaults to True"],
+            'stale_while_revalidate': [False, "Serve the previous output of a changed diagram block at once, and "
+                                              "render the new one in background. Defaults to False"],
+            'max_stale': [0, "With `stale_while_revalidate`, oldest output (in seconds) that can be served. "
+                             "Defaults to 0, no limit"],
+            'force_fresh': [False, "Always render diagrams before serving them, disabling `stale_while_revalidate` "
+                                   "(for release builds). Defaults to False"],
+            'error_cache_ttl': [300, "Seconds to remember in the cache that a diagram cannot be rendered, like a "
+                                     "syntax error reported by Kroki; 0 to disable. Defaults to 300"],
+            'daemon_socket': ["", "Unix socket of the render daemon (see the `plantuml-markdown-daemon` command) running "
+                                  "the local renders; PlantUML is run directly if the daemon is not running. "
+                                  "Defaults to '', no daemon"],
+            'connect_timeout': [10, "Seconds to wait for the connection to a server; 0 to wait forever. "
+                                    "Defaults to 10"],
+            'read_timeout': [60, "Seconds to wait for the response of a server; 0 to wait forever. Defaults to 60"],
+            'local_timeout': [120, "Seconds to wait for the local PlantUML to render a diagram, after which it is "
+                                   "killed; 0 to wait forever. Defaults to 120"],
+            'page_timeout': [0, "Seconds to render all the diagrams of a page; when expired, the remaining diagrams "
+                                "are taken from the cache or replaced with an error message. Defaults to 0, no limit"],
             'theme': ["", "Default Theme to use, will be overridden  by !theme directive", "Defaults to blank"],
+            'dark_theme': ["", "Theme for the dark variant of the diagrams; if set, diagrams are rendered in a light and "
+                               "in a dark variant, and the browser shows the one matching its color scheme. "
+                               "Defaults to blank, no dark variant"],
             'puml_notheme_cmdlist': [[
                                      'version', 
                                      'listfonts', 
@@ -809,6 +2225,34 @@ class PlantUMLMarkdownExtension(markdown.Extension):
 
         super(PlantUMLMarkdownExtension, self).__init__(**kwargs)
 
+    def prefetch(self, sources: Iterable[str], max_workers: int = 8, extensions: Iterable = (),
+                 extension_configs: Optional[Dict[str, Dict]] = None) -> int:
+        """
+        Renders concurrently the diagrams of many Markdown documents into the cache, before converting them; useful
+        for static site generators, which convert the pages one after the other. The configuration of the extension
+        is used, so the documents converted later find their diagrams in the cache (`cachedir` must be set).
+
+        The documents are prepared by the preprocessors running before this extension, like in a conversion: the
+        other extensions of the site (for example the ones including files) must be passed too, or the diagrams they
+        produce are not found, or found with different sources. Diagrams produced by later processing steps are never
+        prefetched.
+
+        Args:
+            sources (Iterable[str]): The Markdown documents.
+            max_workers (int): The diagrams rendered at the same time.
+            extensions (Iterable): The other extensions used to convert the documents, as passed to `Markdown`.
+            extension_configs (Optional[Dict[str, Dict]]): Their configuration, as passed to `Markdown`.
+
+        Returns:
+            int: The number of diagrams rendered, those already in the cache excluded.
+        """
+        # this extension replaces the one in the list, if any
+        others = [ext for ext in extensions
+                  if ext not in ('plantuml_markdown', 'plantuml_markdown.plantuml_markdown')
+                  and not isinstance(ext, PlantUMLMarkdownExtension)]
+        md = markdown.Markdown(extensions=others + [self], extension_configs=extension_configs or {})
+        return md.preprocessors['plantuml'].prefetch(sources, max_workers)
+
     def extendMarkdown(self, md):
         md.registerExtension(self)
         blockprocessor = PlantUMLPreprocessor(md)
@@ -819,6 +2263,29 @@ class PlantUMLMarkdownExtension(markdown.Extension):
             md.preprocessors.add('plantuml', blockprocessor, '_begin')
         else:
             md.preprocessors.register(blockprocessor, 'plantuml', int(blockprocessor.config['priority']))
+        self._serialize_conversions(md)
+
+    @staticmethod
+    def _serialize_conversions(md):
+        """
+        Lets a `Markdown` instance be shared by many threads: Python-Markdown keeps the state of a conversion in the
+        instance, so conversions and resets of the same instance run one at a time.
+        """
+        if getattr(md, '_plantuml_lock', None) is not None:
+            return
+        md._plantuml_lock = lock = threading.RLock()
+        convert, reset = md.convert, md.reset
+
+        def locked_convert(source):
+            with lock:
+                return convert(source)
+
+        def locked_reset():
+            with lock:
+                return reset()
+
+        md.convert = locked_convert
+        md.reset = locked_reset
 
 
 def makeExtension(**kwargs):
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+"""
+   Stand-in PlantUML/Kroki server for the [PlantUML][] extension
+   ============================================================
+
+   A small HTTP server speaking the URL formats of PlantUML and Kroki servers, returning deterministic images instead
+   of real diagrams, so remote rendering, failover, retries and throughput can be tested and benchmarked on a single
+   machine, without Java, Docker or network access:
+
+      plantuml-markdown-stand-in --port 8080 --latency 0.05 --error-rate 0.1
+      plantuml-markdown-stand-in --port 8000 --kroki --throttle-rate 0.2 --retry-after 1
+
+   Supported requests:
+
+   * PlantUML: `GET [/prefix]/<format>/<encoded diagram>` (deflate encoding, or `~h` hex encoding) and
+     `POST [/prefix]/<format>/` with the diagram source as body
+   * Kroki: `GET [/prefix]/plantuml/<format>/<encoded diagram>` (zlib and url safe base64 encoding) and
+     `POST [/prefix]/plantuml/<format>`
+
+   Formats are `png`, `svg`, `txt` and `map` (PlantUML only). Images depend only on the diagram source: PNG and SVG
+   images have a size and a color computed from a digest of the source, text diagrams echo the source, maps have an
+   area for every `[[link]]`. A source with a `!error <message>` line is a syntax error: PlantUML servers answer
+   HTTP 400 with an image, Kroki servers with the message.
+
+   Failures are injected with configurable rates, from a seeded random generator: HTTP 500 errors, HTTP 429 answers
+   with a `Retry-After` header, and connections closed without an answer. Every request waits for a configurable
+   latency.
+
+   With `--object-store` it is instead an in-memory HTTP object store (`GET`, `HEAD`, `PUT` and `DELETE` of
+   `/<name>`), standing in for the cache server shared by the `http` cache backend.
+
+   [PlantUML]: https://plantuml.com
+"""
+
+import base64
+import hashlib
+import logging
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('MARKDOWN')
+
+FORMATS = ('png', 'svg', 'txt', 'map')
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'txt': 'text/plain; charset=utf-8',
+    'map': 'text/plain; charset=utf-8',
+}
+PLANTUML_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_'
+BASE64_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+PLANTUML_TO_B64 = str.maketrans(PLANTUML_ALPHABET, BASE64_ALPHABET)
+ERROR_RE = re.compile(r'^\s*!error\b\s*(.*)$', re.MULTILINE)
+LINK_RE = re.compile(r'\[\[\s*(\S+?)[\s\]]')
+
+
+def decode_plantuml(encoded: str) -> str:
+    """
+    Decodes a diagram encoded for a PlantUML server.
+    """
+    if encoded.startswith('~h'):
+        return bytes.fromhex(encoded[2:]).decode('utf-8')
+    data = encoded.translate(PLANTUML_TO_B64)
+    data += '=' * (-len(data) % 4)
+    return zlib.decompress(base64.b64decode(data), -zlib.MAX_WBITS).decode('utf-8')
+
+
+def decode_kroki(encoded: str) -> str:
+    """
+    Decodes a diagram encoded for a Kroki server.
+    """
+    encoded += '=' * (-len(encoded) % 4)
+    return zlib.decompress(base64.urlsafe_b64decode(encoded)).decode('utf-8')
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def render(source: str, img_format: str) -> bytes:
+    """
+    Builds the deterministic image of a diagram source.
+    """
+    digest = hashlib.sha1(source.encode('utf-8')).digest()
+    width = 100 + digest[0] * 2
+    height = 50 + digest[1]
+    color = digest[2:5]
+
+    if img_format == 'png':
+        row = b'\x00' + color * width
+        return b'\x89PNG\r\n\x1a\n' + \
+            _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+            _png_chunk(b'IDAT', zlib.compress(row * height)) + \
+            _png_chunk(b'IEND', b'')
+    elif img_format == 'svg':
+        return (f'<?xml version="1.0" encoding="us-ascii" standalone="no"?>'
+                f'<svg xmlns="http://www.w3.org/2000/svg" height="{height}px" preserveAspectRatio="none" '
+                f'style="width:{width}px;height:{height}px;background:#FFFFFF;" version="1.1" '
+                f'viewBox="0 0 {width} {height}" width="{width}px">'
+                f'<rect fill="#{color.hex()}" height="{height}" width="{width}" x="0" y="0"/>'
+                f'<text x="4" y="16">{digest.hex()[:12]}</text></svg>').encode('utf-8')
+    elif img_format == 'map':
+        links = LINK_RE.findall(source)
+        if not links:
+            return b''
+        map_id = 'plantuml_map_' + digest.hex()[:8]
+        areas = ''.join(f'<area shape="rect" id="id{i}" href="{link}" title="{link}" '
+                        f'coords="{i * 10},0,{i * 10 + 9},9"/>' for i, link in enumerate(links, 1))
+        return f'<map id="{map_id}" name="{map_id}">\n{areas}\n</map>\n'.encode('utf-8')
+    else:
+        lines = [line for line in source.splitlines() if not line.strip().startswith(('@start', '@end'))]
+        return '\n'.join(lines).strip().encode('utf-8')
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    """
+    HTTP server staying silent when a client goes away before the answer, as clients giving up after a timeout do.
+    """
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):  # broken pipes and connections reset by the client
+            logger.debug(f'[stand-in server] Client {client_address[0]}:{client_address[1]} has gone away')
+            return
+        super().handle_error(request, client_address)
+
+
+class _BackgroundServer:
+    """
+    HTTP server running in a background thread, also usable as a context manager.
+    """
+    THREAD_NAME = 'plantuml-stand-in'
+
+    _httpd: _QuietHTTPServer
+    _thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=self.THREAD_NAME, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StandInServer(_BackgroundServer):
+    """
+    Stand-in PlantUML or Kroki server, running in a background thread:
+
+        with StandInServer(kroki=True, latency=0.05) as server:
+            ... render diagrams with server.url ...
+            print(server.stats)
+    """
+
+    def __init__(self, kroki: bool = False, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, drop_rate: float = 0.0, retry_after: float = 1, seed: int = 0,
+                 host: str = '127.0.0.1', port: int = 0):
+        """
+        Args:
+            kroki (bool): Speak the Kroki url format instead of the PlantUML one.
+            latency (float): Seconds to wait before answering every request.
+            jitter (float): Random seconds added to the latency, up to this value.
+            error_rate (float): Fraction of requests answered with HTTP 500.
+            throttle_rate (float): Fraction of requests answered with HTTP 429.
+            drop_rate (float): Fraction of requests whose connection is closed without an answer.
+            retry_after (float): Value of the `Retry-After` header of HTTP 429 answers.
+            seed (int): Seed of the random generator deciding the failures.
+            host (str): Address to listen on.
+            port (int): Port to listen on; 0 takes a free port.
+        """
+        self.kroki = kroki
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.stats: Dict[str, int] = dict.fromkeys(('requests', 'rendered', 'diagram_errors', 'errors', 'throttled',
+                                                    'dropped', 'bad_requests'), 0)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = _QuietHTTPServer((host, port), self._handler_class())
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _failure(self) -> Optional[str]:
+        """
+        Decides if the request must fail, and how.
+        """
+        with self._lock:
+            draw = self._random.random()
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        for failure, rate in (('dropped', self.drop_rate), ('errors', self.error_rate),
+                              ('throttled', self.throttle_rate)):
+            if draw < rate:
+                return failure
+            draw -= rate
+        return None
+
+    def _parse_path(self, path: str) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Extracts the format and the encoded diagram from the request path.
+        """
+        segments: List[str] = [segment for segment in path.split('?')[0].split('/') if segment]
+        for idx, segment in enumerate(segments):
+            if segment in FORMATS:
+                if self.kroki and (idx == 0 or segments[idx - 1] != 'plantuml' or segment == 'map'):
+                    return None
+                return segment, segments[idx + 1] if idx + 1 < len(segments) else None
+        return None
+
+    def _answer(self, path: str, body: Optional[bytes]) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Builds the answer to a request: status, headers and body.
+        """
+        parsed = self._parse_path(path)
+        if parsed is None:
+            self._count('bad_requests')
+            return 404, {'Content-Type': 'text/plain'}, b'Not found'
+        img_format, encoded = parsed
+
+        try:
+            if body is not None:
+                source = body.decode('utf-8')
+            elif encoded:
+                source = decode_kroki(encoded) if self.kroki else decode_plantuml(encoded)
+            else:
+                raise ValueError('no diagram')
+        except (ValueError, zlib.error, UnicodeDecodeError):
+            self._count('bad_requests')
+            return 400, {'Content-Type': 'text/plain'}, b'Cannot decode the diagram'
+
+        error = ERROR_RE.search(source)
+        if error:
+            self._count('diagram_errors')
+            message = f'Syntax Error? {error.group(1)}'.strip()
+            if self.kroki:
+                return 400, {'Content-Type': 'text/plain'}, message.encode('utf-8')
+            # PlantUML draws the error in the image
+            return 400, {'Content-Type': CONTENT_TYPES[img_format]}, render(message, img_format)
+
+        self._count('rendered')
+        return 200, {'Content-Type': CONTENT_TYPES[img_format]}, render(source, img_format)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle(None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self._handle(self.rfile.read(length))
+
+            def _handle(self, body: Optional[bytes]):
+                server._count('requests')
+                failure = server._failure()
+
+                if failure == 'dropped':
+                    server._count('dropped')
+                    self.close_connection = True  # no answer at all
+                    return
+                if failure == 'errors':
+                    server._count('errors')
+                    self._send(500, {'Content-Type': 'text/plain'}, b'Internal server error')
+                elif failure == 'throttled':
+                    server._count('throttled')
+                    self._send(429, {'Content-Type': 'text/plain', 'Retry-After': f'{server.retry_after:g}'},
+                               b'Too many requests')
+                else:
+                    self._send(*server._answer(self.path, body))
+
+            def _send(self, status: int, headers: Dict[str, str], body: bytes):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('[stand-in server] ' + format % args)
+
+        return Handler
+
+
+class StandInObjectStore(_BackgroundServer):
+    """
+    Stand-in HTTP object store, keeping in memory the objects saved with `PUT <url>/<name>`, returning them with
+    `GET` and `HEAD` and removing them with `DELETE`, to test and benchmark the `http` cache backend:
+
+        with StandInObjectStore() as store:
+            ... convert documents with `cache_backend: http` and `cachedir: store.url` ...
+            print(store.stats, len(store.objects))
+    """
+    THREAD_NAME = 'plantuml-stand-in-store'
+
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        """
+        Args:
+            latency (float): Seconds to wait before answering every request.
+            host (str): Address to listen on.
+            port (int): Port to listen on; 0 takes a free port.
+        """
+        self.latency = latency
+        self.objects: Dict[str, bytes] = {}
+        self.stats: Dict[str, int] = dict.fromkeys(('requests', 'get', 'head', 'put', 'delete', 'hits',
+                                                    'misses'), 0)
+        self._lock = threading.Lock()
+        self._httpd = _QuietHTTPServer((host, port), self._handler_class())
+
+    def _handler_class(self):
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._read('get', True)
+
+            def do_HEAD(self):
+                self._read('head', False)
+
+            def do_PUT(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self._count('put')
+                with store._lock:
+                    created = self.path not in store.objects
+                    store.objects[self.path] = data
+                self._send(201 if created else 204, b'')
+
+            def do_DELETE(self):
+                self._count('delete')
+                with store._lock:
+                    found = store.objects.pop(self.path, None) is not None
+                self._send(204 if found else 404, b'')
+
+            def _read(self, method: str, with_body: bool):
+                self._count(method)
+                with store._lock:
+                    data = store.objects.get(self.path)
+                    store.stats['hits' if data is not None else 'misses'] += 1
+                if data is None:
+                    self._send(404, b'Not found', with_body)
+                else:
+                    self._send(200, data, with_body)
+
+            def _count(self, method: str):
+                if store.latency:
+                    time.sleep(store.latency)
+                with store._lock:
+                    store.stats['requests'] += 1
+                    store.stats[method] += 1
+
+            def _send(self, status: int, body: bytes, with_body: bool = True):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('[stand-in object store] ' + format % args)
+
+        return Handler
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='plantuml-markdown-stand-in',
+                                     description='Stand-in PlantUML/Kroki server, returning deterministic images')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--kroki', action='store_true', help='speak the Kroki url format')
+    parser.add_argument('--object-store', action='store_true',
+                        help='be an in-memory object store for the http cache backend instead')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of HTTP 500 answers')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of HTTP 429 answers')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of connections closed with no answer')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After value of HTTP 429 answers')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the failures random generator')
+    args = parser.parse_args(argv)
+
+    if args.object_store:
+        store = StandInObjectStore(latency=args.latency, host=args.host, port=args.port)
+        with store:
+            print(f'Stand-in object store listening on {store.url}')
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+        print(' '.join(f'{name}={value}' for name, value in store.stats.items()))
+        return 0
+
+    server = StandInServer(kroki=args.kroki, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, drop_rate=args.drop_rate, retry_after=args.retry_after,
+                           seed=args.seed, host=args.host, port=args.port)
+    with server:
+        print(f"Stand-in {'Kroki' if args.kroki else 'PlantUML'} server listening on {server.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    print(' '.join(f'{name}={value}' for name, value in server.stats.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
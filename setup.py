@@ -27,7 +27,10 @@ setuptools.setup(
     install_requires=install_requirements,
     tests_require=test_requirements,
     entry_points={
-        'markdown.extensions': ['plantuml_markdown = plantuml_markdown:PlantUMLMarkdownExtension']
+        'markdown.extensions': ['plantuml_markdown = plantuml_markdown:PlantUMLMarkdownExtension'],
+        'console_scripts': ['plantuml-markdown-cache = plantuml_markdown.cache:main',
+                            'plantuml-markdown-daemon = plantuml_markdown.daemon:main',
+                            'plantuml-markdown-stand-in = plantuml_markdown.stand_in_server:main']
     },
     classifiers=[
         "Programming Language :: Python",
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import tempfile
+import time
+from unittest import TestCase
+
+import markdown
+import mock
+
+from plantuml_markdown.cache import COMPRESSED_MAGIC, CacheBackend, CachePack, CompressedCache, DirectoryCache, \
+    HttpCache, SqliteCache, _flush_backends, compression_config, export_cache, get_backend, import_cache, main, \
+    open_pack
+from plantuml_markdown.plantuml_markdown import PlantUMLPreprocessor
+from plantuml_markdown.stand_in_server import StandInObjectStore
+
+
+class CachePackTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.pack_file = os.path.join(self.temp_dir.name, 'diagrams.pack')
+        os.makedirs(self.cache_dir)
+        self.entries = {
+            '0000abcd.png': b'\x89PNG fake image',
+            '0000abcd.map': b'',
+            '1234abcd.svg': '<svg>àèìòù</svg>'.encode('utf-8'),
+        }
+        for name, data in self.entries.items():
+            with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_export_and_read(self):
+        """
+        Verify that every cache entry can be read back from the pack
+        """
+        self.assertEqual(3, export_cache(self.cache_dir, self.pack_file))
+
+        with CachePack(self.pack_file) as pack:
+            self.assertEqual(3, len(pack))
+            for name, data in self.entries.items():
+                self.assertIn(name, pack)
+                self.assertEqual(data, pack.get(name))
+            self.assertIsNone(pack.get('missing.png'))
+
+    def test_import(self):
+        """
+        Verify the round trip from a cache directory to another one
+        """
+        export_cache(self.cache_dir, self.pack_file)
+        other_dir = os.path.join(self.temp_dir.name, 'other')
+
+        self.assertEqual(3, import_cache(self.pack_file, other_dir))
+        self.assertEqual(sorted(self.entries), sorted(os.listdir(other_dir)))
+        for name, data in self.entries.items():
+            with open(os.path.join(other_dir, name), 'rb') as f:
+                self.assertEqual(data, f.read())
+        # existing entries are left untouched
+        self.assertEqual(0, import_cache(self.pack_file, other_dir))
+        self.assertEqual(3, import_cache(self.pack_file, other_dir, overwrite=True))
+
+    def test_command_line(self):
+        """
+        Verify the `plantuml-markdown-cache` command
+        """
+        other_dir = os.path.join(self.temp_dir.name, 'other')
+        with mock.patch('builtins.print'):
+            self.assertEqual(0, main(['export', self.cache_dir, self.pack_file]))
+            self.assertEqual(0, main(['import', self.pack_file, other_dir]))
+        self.assertEqual(sorted(self.entries), sorted(os.listdir(other_dir)))
+
+    def test_invalid_pack(self):
+        """
+        Verify that a file which is not a pack is refused
+        """
+        with open(self.pack_file, 'wb') as f:
+            f.write(b'not a pack' * 10)
+        self.assertRaises(ValueError, CachePack, self.pack_file)
+        self.assertIsNone(open_pack(os.path.join(self.temp_dir.name, 'missing.pack')))
+
+    def test_unsafe_entry_names(self):
+        """
+        Verify that a pack with entry names pointing outside the cache directory is refused
+        """
+        from plantuml_markdown.cache import _FOOTER, _HEADER, _INDEX_ENTRY, _NAME_LEN, PACK_MAGIC, PACK_VERSION
+
+        other_dir = os.path.join(self.temp_dir.name, 'other')
+        for name in ('../escaped.txt', '/tmp/escaped.txt', 'sub/escaped.txt', '..', '.', ''):
+            encoded = name.encode('utf-8')
+            with open(self.pack_file, 'wb') as f:
+                f.write(_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0) + b'data')
+                f.write(_NAME_LEN.pack(len(encoded)) + encoded + _INDEX_ENTRY.pack(_HEADER.size, 4))
+                f.write(_FOOTER.pack(_HEADER.size + 4, 1, PACK_MAGIC))
+            self.assertRaises(ValueError, CachePack, self.pack_file)
+            self.assertRaises(ValueError, import_cache, self.pack_file, other_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, 'escaped.txt')))
+
+    def test_render_from_pack(self):
+        """
+        Verify that the extension reads diagrams from the pack without rendering them
+        """
+        text = '```uml\nA --> B\n```\n'
+        cache_dir = os.path.join(self.temp_dir.name, 'render-cache')
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'format': 'txt', 'cachedir': cache_dir}})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(b'from the renderer', None)):
+            md.convert(text)
+        export_cache(cache_dir, self.pack_file)
+
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'format': 'txt',
+                                                                        'cache_pack': self.pack_file}})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image') as renderer:
+            self.assertEqual('<pre><code class="text">from the renderer</code></pre>', md.convert(text))
+            renderer.assert_not_called()
+
+
+class MemoryCache(CacheBackend):
+    """
+    Custom backend, for testing the `module:Class` syntax of the `cache_backend` option
+    """
+    entries = {}
+
+    def __init__(self, location):
+        self.location = location
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def put(self, name, data, render_time=None, backend=None):
+        self.entries[name] = data
+
+
+class CacheBackendTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _convert(self, config, renderer_output=b'rendered'):
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': dict(format='txt', **config)})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(renderer_output, None)) as renderer:
+            html = md.convert('```uml\nA --> B\n```\n')
+        return html, renderer.call_count
+
+    def test_sqlite_backend(self):
+        """
+        Verify that the sqlite backend saves entries with their metadata
+        """
+        cache = SqliteCache(self.temp_dir.name, batch_size=2)
+        cache.put('a.png', b'first', 1.5, 'local')
+        # pending writes are visible before being saved
+        self.assertEqual(b'first', cache.get('a.png'))
+        cache.put('b.svg', b'second', None, 'https://kroki.io/plantuml/')
+        cache.put('c.txt', b'third')
+        cache.flush()
+
+        other = SqliteCache(self.temp_dir.name)
+        self.assertEqual({'a.png': b'first', 'c.txt': b'third'}, other.get_many(['a.png', 'c.txt', 'missing.png']))
+        meta = other.metadata('a.png')
+        self.assertEqual(5, meta['size'])
+        self.assertEqual(1.5, meta['render_time'])
+        self.assertEqual('local', meta['backend'])
+        self.assertEqual('https://kroki.io/plantuml/', other.metadata('b.svg')['backend'])
+        self.assertIsNone(other.metadata('missing.png'))
+        other.delete('c.txt')
+        self.assertIsNone(other.get('c.txt'))
+        other.flush()
+        self.assertIsNone(SqliteCache(self.temp_dir.name).get('c.txt'))
+
+        with other._connection() as conn:
+            self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_sqlite_concurrent_writers(self):
+        """
+        Verify that several writers on the same database do not lose entries
+        """
+        import threading
+        caches = [SqliteCache(self.temp_dir.name, batch_size=5) for _ in range(4)]
+
+        def write(idx, cache):
+            for i in range(50):
+                cache.put('%d-%d.png' % (idx, i), b'x' * i)
+            cache.flush()
+
+        threads = [threading.Thread(target=write, args=(idx, cache)) for idx, cache in enumerate(caches)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(200, len(caches[0].get_many('%d-%d.png' % (idx, i) for idx in range(4) for i in range(50))))
+
+    def test_sqlite_locked(self):
+        """
+        Verify that writes not saved because the database is locked by another writer are kept for the next flush
+        """
+        import sqlite3
+        cache = SqliteCache(self.temp_dir.name, timeout=0.1)
+        locker = sqlite3.connect(os.path.join(self.temp_dir.name, SqliteCache.DB_NAME), isolation_level=None)
+        locker.execute('BEGIN IMMEDIATE')
+        cache.put('a.png', b'first')
+        with self.assertLogs('MARKDOWN', 'WARNING') as logs:
+            cache.flush()
+        self.assertIn('Could not save the diagram cache', logs.output[0])
+        self.assertEqual(b'first', cache.get('a.png'))
+
+        locker.execute('ROLLBACK')
+        locker.close()
+        cache.flush()
+        self.assertEqual(b'first', SqliteCache(self.temp_dir.name).get('a.png'))
+
+    def test_extension_sqlite(self):
+        """
+        Verify that the extension uses the sqlite backend
+        """
+        config = {'cachedir': self.temp_dir.name, 'cache_backend': 'sqlite'}
+        self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), self._convert(config))
+        self.assertEqual(('<pre><code class="text">rendered</code></pre>', 0), self._convert(config))
+        self.assertEqual(['diagrams.sqlite'], [f for f in os.listdir(self.temp_dir.name) if f.endswith('.sqlite')])
+        self.assertFalse(any(f.endswith('.txt') for f in os.listdir(self.temp_dir.name)))
+
+        backend = get_backend('sqlite', self.temp_dir.name)
+        name = backend._connection().execute('SELECT name FROM diagrams').fetchone()[0]
+        self.assertEqual('local', backend.metadata(name)['backend'])
+
+    def test_extension_custom_backend(self):
+        """
+        Verify that a custom backend can be plugged in
+        """
+        config = {'cachedir': 'memory', 'cache_backend': 'test.test_cache:MemoryCache'}
+        self._convert(config)
+        self.assertEqual([b'rendered'], list(MemoryCache.entries.values()))
+        self.assertEqual(('<pre><code class="text">rendered</code></pre>', 0), self._convert(config))
+
+    def test_compressed_entries(self):
+        """
+        Verify that text entries are compressed with every method and read back, while older entries are still read
+        """
+        svg = b'<svg>' + b'<text x="10" y="20">label</text>' * 100 + b'</svg>'
+        for method in ('zlib', 'gzip', 'lzma'):
+            directory = DirectoryCache(os.path.join(self.temp_dir.name, method))
+            cache = CompressedCache(directory, compression_config(method))
+            cache.put('a.svg', svg)
+            cache.put('a.png', b'\x89PNG' * 100)
+            cache.put('short.txt', b'A')  # not smaller when compressed
+            self.assertTrue(directory.get('a.svg').startswith(COMPRESSED_MAGIC))
+            self.assertLess(len(directory.get('a.svg')), len(svg) / 10)
+            self.assertEqual(b'\x89PNG' * 100, directory.get('a.png'))
+            self.assertEqual(b'A', directory.get('short.txt'))
+            self.assertEqual(svg, cache.get('a.svg'))
+            self.assertEqual({'a.svg': svg, 'short.txt': b'A'}, cache.get_many(['a.svg', 'short.txt', 'missing.svg']))
+
+            directory.put('old.svg', svg)
+            self.assertEqual(svg, cache.get('old.svg'))
+
+        self.assertEqual({'svg': 'lzma', 'txt': 'zlib'}, compression_config({'svg': 'LZMA', 'txt': 'zlib', 'map': ''}))
+        with self.assertRaises(ValueError):
+            compression_config('bzip2')
+
+    def test_extension_compression(self):
+        """
+        Verify that the extension saves text diagrams compressed, and reads them with or without the compression
+        """
+        text = b'A ---> B\n' * 1000
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        config = {'cachedir': cache_dir, 'cache_compression': {'txt': 'gzip'}}
+        html, renders = self._convert(config, text)
+        self.assertEqual(1, renders)
+        name, = os.listdir(cache_dir)
+        self.assertLess(os.path.getsize(os.path.join(cache_dir, name)), len(text) / 10)
+
+        self.assertEqual((html, 0), self._convert(config))
+        self.assertEqual((html, 0), self._convert({'cachedir': cache_dir}))
+        # packs keep the entries compressed
+        pack_file = os.path.join(self.temp_dir.name, 'diagrams.pack')
+        export_cache(cache_dir, pack_file)
+        self.assertEqual((html, 0), self._convert({'cache_pack': pack_file}))
+
+    def test_cache_layers(self):
+        """
+        Verify that the cache layers are searched in order, that new diagrams are saved only in the writable layer and
+        that diagrams found in a lower layer are promoted when enabled
+        """
+        local_dir = os.path.join(self.temp_dir.name, 'local')
+        shared_dir = os.path.join(self.temp_dir.name, 'shared')
+        layers = [local_dir, {'path': shared_dir, 'read_only': True}]
+
+        # the shared layer, populated by CI
+        self.assertEqual(('<pre><code class="text">from CI</code></pre>', 1),
+                         self._convert({'cachedir': shared_dir}, b'from CI'))
+        name, = os.listdir(shared_dir)
+
+        self.assertEqual(('<pre><code class="text">from CI</code></pre>', 0), self._convert({'cachedir': layers}))
+        self.assertFalse(os.path.exists(os.path.join(local_dir, name)))
+        self.assertEqual(('<pre><code class="text">from CI</code></pre>', 0),
+                         self._convert({'cachedir': layers, 'cache_promote': True}))
+        self.assertTrue(os.path.exists(os.path.join(local_dir, name)))
+
+        # new diagrams are not written in the read-only layer
+        os.remove(os.path.join(shared_dir, name))
+        os.remove(os.path.join(local_dir, name))
+        self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), self._convert({'cachedir': layers}))
+        self.assertEqual([name], os.listdir(local_dir))
+        self.assertEqual([], os.listdir(shared_dir))
+
+    def test_read_only_sqlite_layer(self):
+        """
+        Verify that a read-only sqlite layer is opened read-only, is never written, not even its access times, and is
+        skipped when its database is missing
+        """
+        shared_dir = os.path.join(self.temp_dir.name, 'shared')
+        self._convert({'cachedir': shared_dir, 'cache_backend': 'sqlite'}, b'from CI')
+        writer = get_backend('sqlite', shared_dir)
+        name, = [row[0] for row in writer._connection().execute('SELECT name FROM diagrams')]
+        last_access = writer.metadata(name)['last_access']
+        # a published database has all its changes in the main file
+        writer._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        layer = {'path': shared_dir, 'backend': 'sqlite', 'read_only': True}
+        self.assertEqual(('<pre><code class="text">from CI</code></pre>', 0), self._convert({'cachedir': [layer]}))
+        reader = get_backend('sqlite', shared_dir, read_only=True)
+        self.assertEqual({}, reader._accessed)
+        with self.assertRaises(PermissionError):
+            reader.put(name, b'overwritten')
+        _flush_backends()
+        self.assertEqual(last_access, writer.metadata(name)['last_access'])
+
+        missing = {'path': os.path.join(self.temp_dir.name, 'missing'), 'backend': 'sqlite', 'read_only': True}
+        with self.assertLogs('MARKDOWN', 'WARNING') as logs:
+            self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1),
+                             self._convert({'cachedir': [missing]}))
+        self.assertIn('not available', logs.output[0])
+
+    def test_read_only_sqlite_without_wal_files(self):
+        """
+        Verify that a read-only sqlite database in WAL mode is read without its -wal and -shm files, which cannot be
+        created on a read-only mount
+        """
+        writer = SqliteCache(self.temp_dir.name)
+        writer.put('a.png', b'published')
+        writer.flush()
+        # closing the last connection removes the -wal and -shm files
+        writer._connection().close()
+        db_path = os.path.join(self.temp_dir.name, SqliteCache.DB_NAME)
+        self.assertEqual([SqliteCache.DB_NAME], os.listdir(self.temp_dir.name))
+
+        reader = SqliteCache(self.temp_dir.name, read_only=True)
+        self.assertEqual(b'published', reader.get('a.png'))
+        self.assertFalse(os.path.exists(db_path + '-wal'))
+        self.assertFalse(os.path.exists(db_path + '-shm'))
+
+    def test_http_backend(self):
+        """
+        Verify that the entries are saved in the object store once, after checking which ones are already there, and
+        that a diagram rendered by a runner is found by the others
+        """
+        with StandInObjectStore() as store:
+            url = store.url + 'plantuml'
+            cache = HttpCache(url)
+            self.assertIsNone(cache.get('0000abcd.png'))
+            cache.put('0000abcd.png', b'png image')
+            cache.put('0000abcd.map', b'')
+            self.assertEqual(b'png image', cache.get('0000abcd.png'))  # pending writes are read too
+            cache.flush()
+            self.assertEqual({'/plantuml/0000abcd.png': b'png image', '/plantuml/0000abcd.map': b''}, store.objects)
+
+            # another runner, rendering the same diagram
+            other = HttpCache(url)
+            other.put('0000abcd.png', b'png image')
+            other.put('1234abcd.svg', b'<svg/>')
+            other.flush()
+            self.assertEqual(3, store.stats['put'])
+            self.assertEqual(4, store.stats['head'])
+            self.assertEqual({'0000abcd.png': b'png image', '1234abcd.svg': b'<svg/>'},
+                             other.get_many(['0000abcd.png', '1234abcd.svg', 'ffffffff.svg']))
+            other.delete('1234abcd.svg')
+            self.assertNotIn('/plantuml/1234abcd.svg', store.objects)
+            other.close()
+            cache.close()
+
+            config = {'cachedir': url + '/', 'cache_backend': 'http'}
+            self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), self._convert(config))
+            self.assertIs(get_backend('http', url + '/'), get_backend('http', url + '/'))
+            # a runner with an empty local cache
+            local_dir = os.path.join(self.temp_dir.name, 'local')
+            self.assertEqual(('<pre><code class="text">rendered</code></pre>', 0),
+                             self._convert({'cachedir': [local_dir, {'path': url + '/', 'backend': 'http'}],
+                                            'cache_promote': True}))
+            self.assertEqual(1, len(os.listdir(local_dir)))
+
+    def test_http_backend_unavailable(self):
+        """
+        Verify that diagrams are rendered locally when the object store does not answer, without waiting for it again
+        """
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:%d/plantuml/' % sock.getsockname()[1]  # nothing listening
+
+        config = {'cachedir': url, 'cache_backend': 'http'}
+        with self.assertLogs('MARKDOWN', 'WARNING') as logs:
+            start = time.monotonic()
+            self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), self._convert(config))
+            self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), self._convert(config))
+            self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('not available', logs.output[0])
+        self.assertFalse(get_backend('http', url).available)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase, skipUnless
+
+import markdown
+import mock
+
+from plantuml_markdown.plantuml_markdown import PlantUMLPreprocessor, canonical_source
+
+DIAGRAM = '@startuml\nAlice -> Bob: hello\nnote left of Alice\n  multi line\n  note\nend note\n@enduml\n'
+
+# sources equivalent to DIAGRAM
+VARIANTS = {
+    'crlf': DIAGRAM.replace('\n', '\r\n'),
+    'trailing whitespace': DIAGRAM.replace('\n', '  \t\n'),
+    'indented': ''.join('    ' + line + '\n' for line in DIAGRAM.splitlines()),
+    'comments': DIAGRAM.replace('Alice ->', "' who speaks first\n  /' single line block '/\nAlice ->"),
+    'blank lines around': '\n\n' + DIAGRAM + '\n\n',
+}
+
+# sources that must keep their own key
+DIFFERENT = {
+    'changed message': DIAGRAM.replace('hello', 'hello!'),
+    'relative indentation': DIAGRAM.replace('  multi line', '    multi line'),
+    'block comment': DIAGRAM.replace('Alice ->', "/'\n' not a comment on its own\n'/\nAlice ->"),
+}
+
+
+class CanonicalSourceTest(TestCase):
+    """
+    Tests on the canonical form of diagram sources, used by `normalize_cache_keys`.
+    """
+
+    def test_equivalent_sources(self):
+        """
+        Verify that sources differing only in ways not changing the picture have the same canonical form
+        """
+        for name, variant in VARIANTS.items():
+            self.assertEqual(canonical_source(DIAGRAM), canonical_source(variant), name)
+
+    def test_different_sources(self):
+        """
+        Verify that changes that can change the picture are kept
+        """
+        for name, variant in DIFFERENT.items():
+            self.assertNotEqual(canonical_source(DIAGRAM), canonical_source(variant), name)
+        # in raw data diagrams a single quote does not start a comment
+        json = "@startjson\n'data'\n@endjson\n"
+        self.assertEqual(json, canonical_source(json))
+
+    def test_cache_hits(self):
+        """
+        Verify that with `normalize_cache_keys` a re-indented or reformatted block is taken from the cache
+        """
+        with tempfile.TemporaryDirectory() as cachedir:
+            def convert(text, **config):
+                md = markdown.Markdown(extensions=['plantuml_markdown'], extension_configs={
+                    'plantuml_markdown': dict(format='txt', cachedir=cachedir, **config)})
+                with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                                       return_value=(b'rendered', None)) as renderer:
+                    md.convert(text)
+                return renderer.call_count
+
+            page = '```uml\n' + DIAGRAM + '```\n'
+            self.assertEqual(1, convert(page, normalize_cache_keys=True))
+            in_list = '* item\n\n    ```uml\n' + ''.join('    ' + line + '  \n' for line in DIAGRAM.splitlines()) + \
+                      '    ```\n'
+            self.assertEqual(0, convert(in_list, normalize_cache_keys=True))
+            self.assertEqual(1, convert(in_list))  # not enabled
+
+
+@skipUnless(shutil.which('plantuml') or os.environ.get('PLANTUML_SERVER'), 'PlantUML not available')
+class CanonicalRenderTest(TestCase):
+    """
+    Correctness suite: equivalent sources, as decided by the canonical form, are rendered identically by PlantUML.
+    """
+
+    # the SVG images embed their source
+    SOURCE_RE = re.compile(r'<\?plantuml-src [^?]*\?>|<!--SRC=\[[^]]*]-->')
+
+    def _render(self, source: str, img_format: str) -> str:
+        config = {'format': img_format, 'image_maps': False}
+        if os.environ.get('PLANTUML_SERVER'):
+            config['server'] = os.environ['PLANTUML_SERVER']
+        md = markdown.Markdown(extensions=['plantuml_markdown'], extension_configs={'plantuml_markdown': config})
+        return self.SOURCE_RE.sub('', md.convert('```uml\n' + source + '\n```\n'))
+
+    def test_same_rendering(self):
+        """
+        Verify that every equivalent source renders like the canonical one
+        """
+        for img_format in ('txt', 'svg_inline'):
+            expected = self._render(canonical_source(DIAGRAM), img_format)
+            self.assertEqual(expected, self._render(DIAGRAM, img_format))
+            for name, variant in VARIANTS.items():
+                self.assertEqual(expected, self._render(variant, img_format), f'{name} ({img_format})')
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, skipUnless
+
+import markdown
+
+from plantuml_markdown.plantuml_markdown import DiagramTooLarge
+from plantuml_markdown.daemon import RenderDaemon
+
+FAKE_PLANTUML = '''import os, sys, time
+source = sys.stdin.read()
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runs'), 'a') as f:
+    f.write('run\\n')
+time.sleep(0.2)
+if 'slow' in source:
+    time.sleep(30)
+if 'big' in source:
+    sys.stdout.write('x' * 100000)
+for line in source.splitlines():
+    if line.startswith('!include '):
+        with open(line.split(None, 1)[1]) as f:
+            sys.stdout.write(f.read())
+sys.stdout.write('rendered by %d' % os.getpid())
+'''
+
+
+@skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets not supported')
+class RenderDaemonTest(TestCase):
+    """
+    Tests on the local render daemon, with a fake PlantUML command.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.temp_dir.name, 'daemon.sock')
+        script = os.path.join(self.temp_dir.name, 'plantuml.py')
+        with open(script, 'w') as f:
+            f.write(FAKE_PLANTUML)
+        self.plantuml_cmd = f'{sys.executable} {script}'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _runs(self):
+        runs = os.path.join(self.temp_dir.name, 'runs')
+        if not os.path.exists(runs):
+            return 0
+        with open(runs) as f:
+            return len(f.readlines())
+
+    def _convert(self, text='```uml\nA --> B\n```\n', **config):
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': dict(format='txt',
+                                                                            plantuml_cmd=self.plantuml_cmd,
+                                                                            daemon_socket=self.socket_path,
+                                                                            **config)})
+        return md.convert(text)
+
+    def test_shared_renders(self):
+        """
+        Verify that the daemon renders once the diagrams requested by many builds, and keeps them
+        """
+        with RenderDaemon(self.socket_path, workers=2) as daemon:
+            self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+            with ThreadPoolExecutor(4) as executor:
+                pages = list(executor.map(lambda _: self._convert(), range(4)))
+            self.assertEqual(1, len(set(pages)))
+            self.assertNotIn(str(os.getpid()), pages[0])  # rendered by PlantUML, not by the daemon
+            self.assertEqual(pages[0], self._convert())
+            self.assertEqual(1, self._runs())
+            self.assertEqual(5, daemon.stats['requests'])
+            self.assertEqual(1, daemon.stats['rendered'])
+            self.assertGreaterEqual(daemon.stats['cached'], 1)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_timeout(self):
+        """
+        Verify that a stuck PlantUML is killed by the daemon after the timeout
+        """
+        with RenderDaemon(self.socket_path) as daemon:
+            start = time.monotonic()
+            self.assertEqual('<div style="color: red">[uml directive] Timeout rendering the diagram</div>',
+                             self._convert('```uml\nslow\n```\n', local_timeout=0.5))
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(1, daemon.stats['timeouts'])
+
+    def test_too_large(self):
+        """
+        Verify that the daemon stops the renders exceeding the maximum output size of the build
+        """
+        with RenderDaemon(self.socket_path):
+            self.assertIn('rendered by', self._convert('```uml\nbig\n```\n'))
+            self.assertEqual('<div style="color: red">[uml directive] Diagram too large: more than 1000 bytes</div>',
+                             self._convert('```uml\nbig\n```\n', max_output_size=1000))
+            self.assertEqual('<div style="color: red">[uml directive] Diagram too large: more than 1000 bytes</div>',
+                             self._convert('```uml\nbig again\n```\n', max_output_size=1000))
+
+    def test_shared_render_limits(self):
+        """
+        Verify that a build waiting for the render of another build is not stopped by the limits of the other build
+        """
+        cmdline = self.plantuml_cmd.split()
+        with RenderDaemon(self.socket_path) as daemon, ThreadPoolExecutor(1) as executor:
+            limited = executor.submit(daemon.render, cmdline, self.temp_dir.name, b'big', None, 1000)
+            time.sleep(0.1)
+            out, returncode, _ = daemon.render(cmdline, self.temp_dir.name, b'big', None, 0)
+            self.assertEqual(0, returncode)
+            self.assertIn(b'rendered by', out)
+            with self.assertRaises(DiagramTooLarge):
+                limited.result()
+            self.assertEqual(1, daemon.stats['shared'])
+            self.assertEqual(2, self._runs())
+
+    def test_no_daemon(self):
+        """
+        Verify that PlantUML is run directly when the daemon is not running, even if it has left its socket
+        """
+        self.assertIn('rendered by', self._convert())
+        with open(self.socket_path, 'w'):
+            pass
+        self.assertIn('rendered by', self._convert('```uml\nB --> C\n```\n'))
+        self.assertEqual(2, self._runs())
+
+        # the socket left is replaced by a new daemon
+        with RenderDaemon(self.socket_path) as daemon:
+            self._convert('```uml\nC --> D\n```\n')
+            self.assertEqual(1, daemon.stats['rendered'])
+
+    def test_changed_files(self):
+        """
+        Verify that the daemon does not keep diagrams including local files, and sees the changes of the config file
+        """
+        included = os.path.join(self.temp_dir.name, 'included.puml')
+        config = os.path.join(self.temp_dir.name, 'config.puml')
+        for path in (included, config):
+            with open(path, 'w') as f:
+                f.write('first\n')
+        text = f'```uml\n!include {included}\nA --> B\n```\n'
+
+        with RenderDaemon(self.socket_path) as daemon:
+            self.assertIn('first', self._convert(text))
+            with open(included, 'w') as f:
+                f.write('second\n')
+            self.assertIn('second', self._convert(text))
+            self.assertEqual(2, daemon.stats['rendered'])
+
+            self._convert(config=config)
+            self._convert(config=config)
+            self.assertEqual(3, daemon.stats['rendered'])
+            with open(config, 'w') as f:
+                f.write('second\n')
+            self._convert(config=config)
+            self.assertEqual(4, daemon.stats['rendered'])
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import base64
+import re
+import struct
+from unittest import TestCase
+from xml.etree import ElementTree as etree
+
+import markdown
+import mock
+
+from plantuml_markdown.plantuml_markdown import PIPE_DELIMITER, DataURI, PlantUMLPreprocessor, html_tag, image_size, \
+    join_tags
+
+
+def fake_png(width, height):
+    """
+    Builds the beginning of a PNG image, enough to read its size.
+    """
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', width, height) + b'\x08\x06\x00'
+
+
+FAKE_SVG = b'<?xml version="1.0" encoding="us-ascii" standalone="no"?><svg xmlns="http://www.w3.org/2000/svg" ' \
+           b'contentStyleType="text/css" height="161px" preserveAspectRatio="none" ' \
+           b'style="width:113px;height:161px;background:#FFFFFF;" version="1.1" viewBox="0 0 113 161" ' \
+           b'width="113px" zoomAndPan="magnify"><g></g></svg>'
+
+
+class ImageTagsTest(TestCase):
+    """
+    Tests on the generated tags, with a mocked renderer so no PlantUML is needed.
+    """
+
+    def _convert(self, text, diagram, **config):
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': dict(image_maps='false', **config)})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', return_value=(diagram, None)):
+            return md.convert(text)
+
+    def test_image_size(self):
+        """
+        Verify the detection of the intrinsic image size
+        """
+        self.assertEqual((640, 480), image_size(fake_png(640, 480)))
+        self.assertEqual((113, 161), image_size(FAKE_SVG))
+        self.assertEqual((20, 31), image_size(b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 20 30.6">'
+                                              b'</svg>'))
+        self.assertIsNone(image_size(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'))
+        self.assertIsNone(image_size(b'plain text'))
+
+    def test_html_tag(self):
+        """
+        Verify that tags are serialized exactly like ElementTree does
+        """
+        data = bytes(range(256)) * 1000 + b'end'
+        attrib = {'src': 'data:image/png;base64,' + base64.b64encode(data).decode('ascii'),
+                  'alt': 'a "diagram" & <Bob\'s>\n\r\twith àè€', 'title': ''}
+        for short_empty_elements in (True, False):
+            element = etree.Element('img')
+            element.attrib.update(attrib)
+            self.assertEqual(etree.tostring(element, short_empty_elements=short_empty_elements).decode(),
+                             join_tags(html_tag('img', dict(attrib, src=DataURI('image/png', data)),
+                                                short_empty_elements)))
+        self.assertEqual('<p><a href="data:text/plain;base64," /></p>',
+                         join_tags([b'<p>'] + html_tag('a', {'href': DataURI('text/plain', b'')}) + [b'</p>']))
+
+    def test_stashed_tags(self):
+        """
+        Verify that the image tags are stashed, so the processors running later do not scan the data URIs
+        """
+        for img_format in ('png', 'svg', 'svg_object'):
+            md = markdown.Markdown(extensions=['plantuml_markdown'],
+                                   extension_configs={'plantuml_markdown': {'image_maps': 'false'}})
+            text = f'Text *before*\n\n```uml format="{img_format}"\nA --> B\n```\n\nText *after*'
+            diagram = fake_png(640, 480) if img_format == 'png' else FAKE_SVG
+            with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', return_value=(diagram, None)):
+                lines = md.preprocessors['plantuml'].run(text.split('\n'))
+            self.assertEqual(['Text *before*', '', md.htmlStash.get_placeholder(0), '', 'Text *after*'], lines)
+            self.assertIn(';base64,' + base64.b64encode(diagram).decode('ascii'), md.htmlStash.rawHtmlBlocks[0])
+
+    def test_reproducible_image_maps(self):
+        """
+        Verify that repeated builds of a page with image maps produce the same HTML, with distinct map ids, also when
+        the HTML of the blocks is reused by the render manifest
+        """
+        def render(code, img_format, *args):
+            if img_format == 'map':
+                return b'<map id="plantuml_map" name="plantuml_map">\n<area shape="rect" id="id1" ' \
+                       b'href="https://plantuml.com" coords="1,2,3,4"/>\n</map>\n', None
+            return fake_png(640, 480), None
+
+        text = '```uml\nA --> B [[https://plantuml.com]]\n```\n\ntext\n\n' * 2 + \
+               '```uml\nB --> C [[https://plantuml.com]]\n```\n'
+        for render_manifest in (False, True):
+            builds = []
+            for _ in range(2):
+                md = markdown.Markdown(extensions=['plantuml_markdown'], extension_configs={
+                    'plantuml_markdown': {'render_manifest': render_manifest}})
+                with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', side_effect=render):
+                    builds.append(md.convert(text).encode('utf-8'))
+            self.assertEqual(builds[0], builds[1])
+            map_ids = re.findall(r'<map id="([^"]+)" name="\1">', builds[0].decode('utf-8'))
+            self.assertEqual(3, len(set(map_ids)), f'render_manifest={render_manifest}')
+            for map_id in map_ids:
+                self.assertIn(f'usemap="#{map_id}"', builds[0].decode('utf-8'))
+
+    def test_no_size_by_default(self):
+        """
+        Verify that the generated tags are unchanged if the options are not enabled
+        """
+        html = self._convert('```uml\nA --> B\n```\n', fake_png(640, 480))
+        self.assertNotIn('width=', html)
+        self.assertNotIn('loading=', html)
+
+    def test_png_size_and_lazy_loading(self):
+        """
+        Verify the `intrinsic_size` and `lazy_loading` options with a PNG image
+        """
+        html = self._convert('```uml\nA --> B\n```\n', fake_png(640, 480), intrinsic_size=True, lazy_loading=True)
+        self.assertIn(' width="640"', html)
+        self.assertIn(' height="480"', html)
+        self.assertIn(' loading="lazy"', html)
+        self.assertIn(' decoding="async"', html)
+
+    def test_svg_size(self):
+        """
+        Verify the `intrinsic_size` option with SVG images
+        """
+        html = self._convert('```uml format="svg"\nA --> B\n```\n', FAKE_SVG, intrinsic_size=True)
+        self.assertIn(' width="113" height="161"', html)
+        html = self._convert('```uml format="svg_object"\nA --> B\n```\n', FAKE_SVG, intrinsic_size=True,
+                             lazy_loading=True)
+        self.assertIn(' width="113" height="161"', html)
+        self.assertNotIn('loading=', html)  # not supported by the object tag
+
+    def test_size_with_user_width(self):
+        """
+        Verify that the user defined size wins, keeping the aspect ratio of the image
+        """
+        html = self._convert('```uml width="300px"\nA --> B\n```\n', fake_png(640, 480), intrinsic_size=True)
+        self.assertIn(' style="max-width:300px;aspect-ratio:640/480" width="100%"', html)
+        self.assertNotIn('height=', html)
+
+    def test_dark_variant(self):
+        """
+        Verify that with `dark_theme` both variants are rendered by one PlantUML run, and added to a `picture` tag
+        """
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'image_maps': 'false', 'theme': 'plain',
+                                                                        'dark_theme': 'cyborg'}})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(fake_png(640, 480) + PIPE_DELIMITER + b'\n' + fake_png(320, 240),
+                                             None)) as renderer:
+            html = md.convert('```uml\nA --> B\n```\n')
+        self.assertEqual(1, renderer.call_count)
+        source, _, delimiter = renderer.call_args[0]
+        self.assertEqual('@startuml\n!theme plain\nA --> B\n@enduml\n@startuml\n!theme cyborg\nA --> B\n@enduml\n',
+                         source)
+        self.assertEqual(PIPE_DELIMITER, delimiter)
+
+        self.assertTrue(html.startswith('<p><picture><source media="(prefers-color-scheme: dark)" '
+                                        'srcset="data:image/png;base64,'))
+        self.assertIn('</picture></p>', html)
+        self.assertEqual(2, html.count('data:image/png;base64,'))
+
+    def test_dark_variant_inline(self):
+        """
+        Verify that inline SVG variants are paired, and shown according to the color scheme
+        """
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'dark_theme': 'cyborg'}})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(FAKE_SVG + PIPE_DELIMITER + FAKE_SVG, None)):
+            html = md.convert('```uml id="seq" format="svg_inline"\nA --> B\n```\n')
+        self.assertIn('.plantuml-dark {display: none}', html)
+        self.assertIn(' class="uml plantuml-light"', html)
+        self.assertIn(' class="uml plantuml-dark"', html)
+        self.assertIn(' id="seq"', html)
+        self.assertIn(' id="seq-dark"', html)
+
+    def test_dark_variant_style_once(self):
+        """
+        Verify that the style showing one of the paired variants is added once to a page, also when its blocks are
+        reused from the render manifest
+        """
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': {'dark_theme': 'cyborg',
+                                                                        'render_manifest': 'true'}})
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(FAKE_SVG + PIPE_DELIMITER + FAKE_SVG, None)):
+            first = md.convert('```uml format="svg_inline"\nA --> B\n```\n\n```uml format="svg_object"\nA --> C\n```\n')
+            self.assertEqual(1, first.count('<style>'))
+            self.assertEqual(4, first.count(' class="uml plantuml-'))
+            # only the second block is rendered again
+            second = md.reset().convert('```uml format="svg_inline"\nA --> D\n```\n\n'
+                                        '```uml format="svg_object"\nA --> C\n```\n')
+            self.assertEqual(1, second.count('<style>'))
+            reused = md.reset().convert('```uml format="svg_object"\nA --> C\n```\n')
+            self.assertEqual(1, reused.count('<style>'))
+            self.assertEqual(0, md.reset().convert('```uml format="svg"\nA --> C\n```\n').count('<style>'))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from unittest import TestCase
+
+from plantuml_markdown.plantuml_markdown import PlantUMLIncluder
+
+FILES = {
+    'common.puml': '@startuml\n\nskinparam monochrome true\n\n@enduml\n',
+    'actors.puml': '!include_once common.puml\nactor Alice\n\n',
+    'empty.puml': '\n\n',
+    'sub/nested.puml': '!include ../common.puml\n!include_once ../actors.puml\nactor Bob\n',
+}
+
+
+class PlantUMLIncluderTest(TestCase):
+    """
+    Tests on the expansion of the local includes.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        for name, text in FILES.items():
+            path = os.path.join(self.temp_dir.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _expand(self, code: str) -> str:
+        return PlantUMLIncluder('', False, [], False).readFile(code, [self.temp_dir.name])
+
+    def test_include(self):
+        """
+        Verify that included files are expanded recursively, without their start/end tags and surrounding blank lines
+        """
+        self.assertEqual('@startuml\nA -> B\nskinparam monochrome true\nactor Alice\n\nC -> D\n@enduml\n',
+                         self._expand('@startuml\nA -> B\n!include actors.puml\n\nC -> D\n@enduml'))
+        self.assertEqual('@startuml\nA -> B\n\nC -> D\n@enduml\n',
+                         self._expand('@startuml\nA -> B\n!include empty.puml\nC -> D\n@enduml'))
+
+    def test_include_once(self):
+        """
+        Verify that a file is included once, even with different paths, unless included with `!include_many`
+        """
+        self.assertEqual('@startuml\nskinparam monochrome true\nactor Alice\nactor Bob\n@enduml\n',
+                         self._expand('@startuml\n!include actors.puml\n!include_once common.puml\n'
+                                      '!include sub/nested.puml\n!include_once actors.puml\n@enduml'))
+        self.assertEqual('@startuml\nskinparam monochrome true\nskinparam monochrome true\nactor Alice\n@enduml\n',
+                         self._expand('@startuml\n!include common.puml\n!include_many common.puml\n'
+                                      '!include actors.puml\n@enduml'))
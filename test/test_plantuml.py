@@ -394,7 +394,7 @@ class PlantumlTest(TestCase):
                          self.md.convert(text))
 
     COORDS_REGEX = re.compile(r' coords="\d+(?:,\d+)+"')
-    UUID_REGEX = re.compile(r'"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"')
+    MAP_ID_REGEX = re.compile(r'"#?plantuml-map-[0-9a-f]{8}-\d+"')
 
     def test_plantuml_map(self):
         """
@@ -405,7 +405,7 @@ class PlantumlTest(TestCase):
             self._stripImageData("""<p><img alt="uml diagram" class="uml" src="data:image/png;base64,%s" title="" usemap="test" /><map id="test" name="test">
 <area shape="rect" id="id1" href="https://www.google.fr" title="https://www.google.fr" alt="" coords="1,2,3,4" />
 </map></p>""" % self.FAKE_IMAGE),
-            self.UUID_REGEX.sub('"test"', self.COORDS_REGEX.sub(' coords="1,2,3,4"', self._stripImageData(self.md.convert(text)))))
+            self.MAP_ID_REGEX.sub('"test"', self.COORDS_REGEX.sub(' coords="1,2,3,4"', self._stripImageData(self.md.convert(text)))))
 
     def test_plantuml_map_disabled(self):
         """
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import tempfile
+import time
+from unittest import TestCase
+
+import markdown
+import mock
+from httpservermock import MethodName, MockHTTPResponse, ServedBaseHTTPServerMock
+
+from plantuml_markdown.cache import DirectoryCache
+from plantuml_markdown.plantuml_markdown import PlantUMLMarkdownExtension, PlantUMLPreprocessor, RateLimiter, \
+    minify_source
+
+
+def ok(body=b'rendered'):
+    return MockHTTPResponse(status_code=200, headers={}, reason_phrase='', body=body)
+
+
+def error(status_code, body=b''):
+    return MockHTTPResponse(status_code=status_code, headers={}, reason_phrase='', body=body)
+
+
+class RemoteRenderingTest(TestCase):
+    """
+    Tests on remote rendering, with mocked servers.
+    """
+
+    def setUp(self):
+        PlantUMLPreprocessor._server_methods.clear()
+        RateLimiter._limiters.clear()
+
+    def _convert(self, servers, text='```uml\nA --> B\n```\n', **config):
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': dict(servers=servers, format='txt', **config)})
+        return md.convert(text)
+
+    def test_encode_once(self):
+        """
+        Verify that the diagram is encoded only once when trying several servers
+        """
+        with ServedBaseHTTPServerMock() as first, ServedBaseHTTPServerMock() as second:
+            first.responses[MethodName.GET].append(error(404))
+            second.responses[MethodName.GET].append(ok())
+
+            with mock.patch.object(PlantUMLPreprocessor, '_deflate_and_encode',
+                                   wraps=PlantUMLPreprocessor._deflate_and_encode) as encoder:
+                self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                                 self._convert([first.url, second.url]))
+                self.assertEqual(1, encoder.call_count)
+            self.assertEqual(1, len(first.requests[MethodName.GET]))
+
+    def test_auto_method_small_diagram(self):
+        """
+        Verify that small diagrams are rendered with GET when the method is AUTO
+        """
+        with ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(ok())
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert([server.url], http_method='AUTO'))
+            self.assertEqual(0, len(server.requests[MethodName.POST]))
+
+    def test_auto_method_large_diagram(self):
+        """
+        Verify that large diagrams are rendered with POST when the method is AUTO
+        """
+        with ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.POST].append(ok())
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert([server.url], http_method='AUTO', max_url_length=40))
+            self.assertEqual(0, len(server.requests[MethodName.GET]))
+            self.assertIn(b'A --> B', server.requests[MethodName.POST][0].body)
+
+    def test_auto_method_learns(self):
+        """
+        Verify that a server refusing POST is called with GET, and that the refusal is remembered
+        """
+        with ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.POST].append(error(405))
+            server.responses[MethodName.GET].append(ok())
+            server.responses[MethodName.GET].append(ok(b'again'))
+            self._convert([server.url], http_method='AUTO', max_url_length=40)
+            self.assertEqual('<pre><code class="text">again</code></pre>',
+                             self._convert([server.url], http_method='AUTO', max_url_length=40))
+            self.assertEqual(1, len(server.requests[MethodName.POST]))
+            self.assertEqual(2, len(server.requests[MethodName.GET]))
+
+    def test_auto_method_url_too_long(self):
+        """
+        Verify that an url refused as too long is retried with POST, and that the limit is remembered
+        """
+        with ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(414))
+            server.responses[MethodName.POST].append(ok())
+            server.responses[MethodName.POST].append(ok(b'again'))
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert([server.url], http_method='AUTO'))
+            self.assertEqual('<pre><code class="text">again</code></pre>',
+                             self._convert([server.url], http_method='AUTO'))
+            self.assertEqual(1, len(server.requests[MethodName.GET]))
+            self.assertEqual(2, len(server.requests[MethodName.POST]))
+
+    def test_read_timeout(self):
+        """
+        Verify that a server not responding is abandoned after the read timeout, without retries
+        """
+        with socket.socket() as silent, ServedBaseHTTPServerMock() as server:
+            silent.bind(('127.0.0.1', 0))
+            silent.listen(8)  # connections are accepted by the OS, but never answered
+            server.responses[MethodName.GET].append(ok())
+
+            start = time.monotonic()
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert(['http://127.0.0.1:%d/' % silent.getsockname()[1], server.url],
+                                           read_timeout=0.5))
+            self.assertLess(time.monotonic() - start, 2)
+
+    def test_error_cache(self):
+        """
+        Verify that diagram errors are cached, so broken diagrams are not sent again
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(400, b'Syntax error'))
+            servers = [{'url': server.url, 'kroki': True}]
+            expected = '<div style="color: red">Syntax error</div>'
+            self.assertEqual(expected, self._convert(servers, cachedir=cachedir))
+            self.assertEqual(expected, self._convert(servers, cachedir=cachedir))
+            self.assertEqual(1, len(server.requests[MethodName.GET]))
+
+            # unless disabled
+            server.responses[MethodName.GET].append(error(400, b'Syntax error'))
+            self.assertEqual(expected, self._convert(servers, cachedir=cachedir, error_cache_ttl=0))
+            self.assertEqual(2, len(server.requests[MethodName.GET]))
+
+    def test_error_cache_client_errors(self):
+        """
+        Verify that client errors not caused by the diagram, like a proxy refusing the request, are not cached
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(403, b'Forbidden'))
+            server.responses[MethodName.GET].append(ok())
+            servers = [{'url': server.url, 'kroki': True}]
+            self.assertEqual('<div style="color: red">Forbidden</div>', self._convert(servers, cachedir=cachedir))
+            self.assertEqual('<pre><code class="text">rendered</code></pre>', self._convert(servers, cachedir=cachedir))
+            self.assertEqual(2, len(server.requests[MethodName.GET]))
+
+    def test_error_cache_lookup(self):
+        """
+        Verify that cached errors are read together with the diagram, and removed when expired
+        """
+        get_many = DirectoryCache.get_many
+        lookups = []
+
+        def recording_get_many(cache, names):
+            names = list(names)
+            lookups.append(names)
+            return get_many(cache, names)
+
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server, \
+                mock.patch.object(DirectoryCache, 'get_many', recording_get_many):
+            server.responses[MethodName.GET].append(error(400, b'Syntax error'))
+            servers = [{'url': server.url, 'kroki': True}]
+            self._convert(servers, cachedir=cachedir)
+            name, = os.listdir(cachedir)
+            self.assertEqual([[name[:-len('.err')], name]], lookups)
+
+            with open(os.path.join(cachedir, name), 'w') as f:
+                f.write('{"error": "Syntax error", "expires": 0}')
+            server.responses[MethodName.GET].append(ok())
+            self.assertEqual('<pre><code class="text">rendered</code></pre>', self._convert(servers, cachedir=cachedir))
+            self.assertEqual([name[:-len('.err')]], os.listdir(cachedir))
+
+    def test_error_cache_corrupted(self):
+        """
+        Verify that a corrupted cached error is ignored and removed, without failing the page
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(400, b'Syntax error'))
+            servers = [{'url': server.url, 'kroki': True}]
+            self._convert(servers, cachedir=cachedir)
+            name, = os.listdir(cachedir)
+
+            for corrupted in ('{"error": "Syntax', '["Syntax error"]', '{"error": "Syntax error"}'):
+                with open(os.path.join(cachedir, name), 'w') as f:
+                    f.write(corrupted)
+                server.responses[MethodName.GET].append(ok())
+                with self.assertLogs('MARKDOWN', 'WARNING') as logs:
+                    self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                                     self._convert(servers, cachedir=cachedir))
+                self.assertIn('corrupted cache entry', logs.output[0])
+                self.assertEqual([name[:-len('.err')]], os.listdir(cachedir))
+                os.remove(os.path.join(cachedir, name[:-len('.err')]))
+
+    def test_error_cache_too_large(self):
+        """
+        Verify that a diagram too large is not cached as an error, as it depends on the limit of the build
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(ok(b'x' * 100000))
+            server.responses[MethodName.GET].append(ok(b'x' * 100000))
+            servers = [{'url': server.url, 'kroki': True}]
+            self.assertIn('Diagram too large', self._convert(servers, cachedir=cachedir, max_output_size=50000))
+            self.assertEqual([], os.listdir(cachedir))
+            self.assertEqual('<pre><code class="text">' + 'x' * 100000 + '</code></pre>',
+                             self._convert(servers, cachedir=cachedir))
+
+    def test_prefetch_errors(self):
+        """
+        Verify that prefetch does not count the diagrams answered with an error
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(400, b'Syntax error'))
+            server.responses[MethodName.GET].append(ok())
+            extension = PlantUMLMarkdownExtension(servers=[{'url': server.url, 'kroki': True}], format='txt',
+                                                  cachedir=cachedir)
+            self.assertEqual(1, extension.prefetch(['```uml\nA -->\n```\n', '```uml\nA --> B\n```\n'],
+                                                   max_workers=1))
+            self.assertEqual(2, len(server.requests[MethodName.GET]))
+
+    def test_error_cache_transient(self):
+        """
+        Verify that network errors are not cached
+        """
+        with tempfile.TemporaryDirectory() as cachedir, ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(error(404))
+            server.responses[MethodName.GET].append(ok())
+            self.assertEqual('<div style="color: red">[uml directive] No server available</div>',
+                             self._convert([server.url], cachedir=cachedir))
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert([server.url], cachedir=cachedir))
+
+    def test_dark_variant(self):
+        """
+        Verify that the dark variant includes the files named after the dark theme
+        """
+        with tempfile.TemporaryDirectory() as base_dir, ServedBaseHTTPServerMock() as server:
+            for theme in ('plain', 'cyborg'):
+                with open(os.path.join(base_dir, f'skin-{theme}.puml'), 'w') as f:
+                    f.write(f'skinparam {theme}\n')
+            server.responses[MethodName.POST].append(ok(b'light'))
+            server.responses[MethodName.POST].append(ok(b'dark'))
+
+            html = self._convert([server.url], '```uml format="svg"\n!include skin-plain.puml\nA --> B\n```\n',
+                                 theme='plain', dark_theme='cyborg', base_dir=base_dir, http_method='POST')
+            light, dark = (request.body.decode('utf-8') for request in server.requests[MethodName.POST])
+            self.assertEqual('@startuml\n!theme plain\nskinparam plain\nA --> B\n@enduml\n', light)
+            self.assertEqual('@startuml\n!theme cyborg\nskinparam cyborg\nA --> B\n@enduml\n', dark)
+            self.assertIn('<picture><source media="(prefers-color-scheme: dark)" srcset="data:image/svg+xml;base64,'
+                          'ZGFyaw==" />', html)
+
+    def test_size_limits(self):
+        """
+        Verify that sources too large with the includes are not sent, and that large images are not downloaded
+        """
+        with tempfile.TemporaryDirectory() as base_dir, ServedBaseHTTPServerMock() as server:
+            with open(os.path.join(base_dir, 'big.puml'), 'w') as f:
+                f.write('A --> B\n' * 1000)
+            self.assertEqual('<div style="color: red">[uml directive] Diagram source too large with includes: more '
+                             'than 1000 bytes</div>',
+                             self._convert([server.url], '```uml\n!include big.puml\n```\n', base_dir=base_dir,
+                                           max_include_size=1000))
+
+            server.responses[MethodName.GET].append(ok(b'x' * 100000))
+            server.responses[MethodName.POST].append(ok(b'x' * 100000))
+            server.responses[MethodName.GET].append(ok(b'small'))
+            for method in ('GET', 'POST'):
+                self.assertEqual('<div style="color: red">[uml directive] Diagram too large: more than 50000 '
+                                 'bytes</div>',
+                                 self._convert([server.url], f'```uml\nA --> {method}\n```\n', http_method=method,
+                                               max_output_size=50000))
+            self.assertEqual('<pre><code class="text">small</code></pre>',
+                             self._convert([server.url], max_output_size=50000))
+            self.assertEqual(0, len(server.responses[MethodName.GET]))
+
+    def test_minify_source(self):
+        """
+        Verify that comments and blank lines are not sent to the servers, unless part of a text
+        """
+        with tempfile.TemporaryDirectory() as base_dir, ServedBaseHTTPServerMock() as server:
+            with open(os.path.join(base_dir, 'defs.puml'), 'w') as f:
+                f.write("' shared definitions\n\n/' many\n  lines '/\nskinparam monochrome true\n\n")
+            text = "```uml\n!include defs.puml\n\n  Alice -> Bob : hello   world\n" \
+                   "note left of Alice\n  first\n\n  ' second\nend note\n:multi\n\nline;\n```\n"
+            for minify in (False, True):
+                server.responses[MethodName.POST].append(ok())
+                md = markdown.Markdown(extensions=['plantuml_markdown'], extension_configs={'plantuml_markdown': {
+                    'servers': [server.url], 'format': 'txt', 'http_method': 'POST', 'base_dir': base_dir,
+                    'minify_source': minify}})
+                self.assertEqual('<pre><code class="text">rendered</code></pre>', md.convert(text))
+            source, minified = (request.body.decode('utf-8') for request in server.requests[MethodName.POST])
+            self.assertEqual("@startuml\nskinparam monochrome true\nAlice -> Bob : hello   world\n"
+                             "note left of Alice\nfirst\n\n' second\nend note\n:multi\n\nline;\n@enduml\n",
+                             minified)
+            stats = md.preprocessors['plantuml'].minify_stats
+            self.assertEqual({'diagrams': 1, 'source_bytes': len(source), 'minified_bytes': len(minified)}, stats)
+            self.assertLess(len(minified), len(source))
+
+        # diagrams with raw data are sent as they are
+        json = "@startjson\n{\n  'key': 'value'\n\n}\n@endjson\n"
+        self.assertEqual(json, minify_source(json))
+
+    def test_rate_limiter(self):
+        """
+        Verify the token bucket, and its adaptation to throttling
+        """
+        limiter = RateLimiter(rate=20, burst=2)
+        start = time.monotonic()
+        for _ in range(4):
+            self.assertTrue(limiter.acquire())
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)  # two requests at once, then one every 50ms
+        self.assertFalse(limiter.acquire(timeout=0))
+
+        limiter.throttled(retry_after=0.2)
+        self.assertEqual(10, limiter.rate)
+        self.assertFalse(limiter.acquire(timeout=0.1))
+        self.assertTrue(limiter.acquire(timeout=0.5))
+        for _ in range(30):
+            limiter.succeeded()
+        self.assertEqual(20, limiter.rate)
+
+        self.assertEqual(2.0, RateLimiter.retry_after('2'))
+        self.assertEqual(0.0, RateLimiter.retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertIsNone(RateLimiter.retry_after('soon'))
+
+    def test_rate_limited_server(self):
+        """
+        Verify that 429 answers of a rate limited server slow down the requests, and are retried
+        """
+        with ServedBaseHTTPServerMock() as server:
+            server.responses[MethodName.GET].append(MockHTTPResponse(status_code=429, headers={'Retry-After': '0'},
+                                                                     reason_phrase='', body=b''))
+            server.responses[MethodName.GET].append(ok())
+            self.assertEqual('<pre><code class="text">rendered</code></pre>',
+                             self._convert([{'url': server.url, 'rate': 100, 'burst': 5}]))
+            self.assertEqual(2, len(server.requests[MethodName.GET]))
+            self.assertEqual(55, RateLimiter.for_server(server.url + '/', 100, 5).rate)
+
+    def test_budget_spent_waiting_rate_limit(self):
+        """
+        Verify that a page render budget exhausted while waiting for the rate limiter stops the render gracefully
+        """
+        def acquire(timeout=None):
+            time.sleep(timeout)  # the token arrives just when the budget ends
+            return True
+
+        with ServedBaseHTTPServerMock() as server, mock.patch.object(RateLimiter, 'acquire', side_effect=acquire):
+            server.responses[MethodName.GET].append(ok())
+            self.assertEqual('<div style="color: red">[uml directive] Diagram not rendered: page render budget '
+                             'exhausted</div>',
+                             self._convert([{'url': server.url, 'rate': 100}], page_timeout=0.2))
+            self.assertEqual(0, len(server.requests[MethodName.GET]))
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from zlib import adler32
+
+import markdown
+import mock
+
+from plantuml_markdown.plantuml_markdown import PlantUMLMarkdownExtension, PlantUMLPreprocessor, StaleOutputs
+
+
+class SnippetPreprocessor(markdown.preprocessors.Preprocessor):
+    """
+    Expands `--8<-- name` lines with a diagram, like the extensions including files do.
+    """
+
+    def run(self, lines):
+        return [f'```uml\nA --> {line[7:]}\n```' if line.startswith('--8<-- ') else line for line in lines]
+
+
+class SnippetExtension(markdown.Extension):
+
+    def extendMarkdown(self, md):
+        md.preprocessors.register(SnippetPreprocessor(md), 'snippets', 32)
+
+
+class RenderingTest(TestCase):
+    """
+    Tests on the rendering pipeline, with a mocked renderer so no PlantUML is needed.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _markdown(self, **config):
+        return markdown.Markdown(extensions=['plantuml_markdown'],
+                                 extension_configs={'plantuml_markdown': dict(image_maps='false', **config)})
+
+    def _convert(self, text, renderer_output=b'rendered', **config):
+        """
+        Converts a text with a fresh Markdown instance, returning the HTML and how many diagrams have been rendered.
+        """
+        md = self._markdown(**config)
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(renderer_output, None)) as renderer:
+            html = md.convert(text)
+        return html, renderer.call_count
+
+    def test_render_manifest(self):
+        """
+        Verify that unchanged blocks are reused from the manifest, and only edited diagrams are rendered
+        """
+        config = {'render_manifest': True, 'format': 'txt', 'title': 'manifest test'}
+        text = 'Before\n\n```uml\nA --> B\n```\n\n```uml format="png"\nA --> C\n```\n'
+        html, rendered = self._convert(text, **config)
+        self.assertEqual(2, rendered)
+
+        html2, rendered = self._convert(text.replace('Before', 'Prose changed'), **config)
+        self.assertEqual(0, rendered)
+        self.assertEqual(html.replace('Before', 'Prose changed'), html2)
+
+        html3, rendered = self._convert(text.replace('A --> C', 'A --> D'), **config)
+        self.assertEqual(1, rendered)
+        self.assertEqual(html, html3)  # the mocked renderer returns always the same image
+
+    def test_render_manifest_disabled(self):
+        """
+        Verify that the manifest is not used if not enabled
+        """
+        text = '```uml\nA --> B\n```\n'
+        self.assertEqual(1, self._convert(text, format='txt', title='no manifest')[1])
+        self.assertEqual(1, self._convert(text, format='txt', title='no manifest')[1])
+
+    def test_render_manifest_source_changed(self):
+        """
+        Verify that blocks are rendered again when the external source changes, or when the have local includes
+        """
+        source = os.path.join(self.temp_dir.name, 'source.puml')
+        with open(source, 'w') as f:
+            f.write('A --> B\n')
+        config = {'render_manifest': True, 'format': 'txt', 'base_dir': self.temp_dir.name}
+        text = '```uml source="source.puml"\nB --> C\n```\n'
+
+        self.assertEqual(1, self._convert(text, **config)[1])
+        self.assertEqual(0, self._convert(text, **config)[1])
+        mtime = os.stat(source).st_mtime
+        os.utime(source, (mtime + 10, mtime + 10))
+        self.assertEqual(1, self._convert(text, **config)[1])
+
+        text = '```uml\n!include source.puml\nB --> C\n```\n'
+        self.assertEqual(1, self._convert(text, **config)[1])
+        self.assertEqual(1, self._convert(text, **config)[1])
+
+    def test_lazy_imports(self):
+        """
+        Verify that the libraries needed only by remote servers or by the sqlite cache are not imported with the
+        extension, nor when converting a document with a cache directory
+        """
+        out = subprocess.run([sys.executable, '-c', 'import sys, markdown, plantuml_markdown, tempfile; '
+                                                    'markdown.markdown("```uml\\nA --> B\\n```", '
+                                                    'extensions=["plantuml_markdown"], '
+                                                    'extension_configs={"plantuml_markdown": {"plantuml_cmd": "true", '
+                                                    '"cachedir": tempfile.mkdtemp()}}); '
+                                                    'print([m for m in ("requests", "urllib3", "uuid", "sqlite3") '
+                                                    'if m in sys.modules])'],
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             check=True, capture_output=True, text=True).stdout
+        self.assertEqual('[]', out.strip())
+
+    def test_setup_once(self):
+        """
+        Verify that the config file is searched only for the first document converted with a configuration
+        """
+        with open(os.path.join(self.temp_dir.name, 'config.puml'), 'w') as f:
+            f.write('skinparam monochrome true\n')
+        config = {'format': 'txt', 'config': 'config.puml', 'base_dir': ['/nonexistent', self.temp_dir.name]}
+
+        with mock.patch('os.path.isfile', wraps=os.path.isfile) as isfile:
+            self._convert('```uml\nA --> B\n```\n', **config)
+            searches = isfile.call_count
+            self._convert('```uml\nA --> B\n```\n', **config)
+            self.assertEqual(2, searches)
+            self.assertEqual(searches, isfile.call_count)
+
+        # pages without diagrams are not processed at all
+        with mock.patch.object(PlantUMLPreprocessor, '_replace_block') as replace_block:
+            self.assertEqual('<p>Some text about PlantUML</p>', self._markdown().convert('Some text about PlantUML'))
+            replace_block.assert_not_called()
+
+    def _slow_plantuml(self):
+        """
+        Creates a fake PlantUML command, which hangs for a long time.
+        """
+        script = os.path.join(self.temp_dir.name, 'plantuml.py')
+        with open(script, 'w') as f:
+            f.write('import time\ntime.sleep(30)\n')
+        return f'{sys.executable} {script}'
+
+    def test_local_timeout(self):
+        """
+        Verify that a stuck local PlantUML is killed after the timeout
+        """
+        start = time.monotonic()
+        html = self._markdown(format='txt', plantuml_cmd=self._slow_plantuml(), local_timeout=0.5) \
+            .convert('```uml\nA --> B\n```\n')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual('<div style="color: red">[uml directive] Timeout rendering the diagram</div>', html)
+
+    def test_size_limits(self):
+        """
+        Verify that too large diagrams are not rendered, and that PlantUML is stopped when its output grows too much
+        """
+        html, rendered = self._convert('```uml\nA --> B\nB --> C\n```\n', format='txt', max_source_size=10)
+        self.assertEqual(('<div style="color: red">[uml directive] Diagram source too large: more than 10 bytes</div>',
+                          0), (html, rendered))
+
+        script = os.path.join(self.temp_dir.name, 'plantuml.py')
+        with open(script, 'w') as f:
+            f.write('import sys, time\nfor _ in range(1000):\n    sys.stdout.write("x" * 10000)\n    sys.stdout.flush()\n'
+                    '    time.sleep(0.01)\n')
+        start = time.monotonic()
+        html = self._markdown(format='txt', plantuml_cmd=f'{sys.executable} {script}', max_output_size=50000) \
+            .convert('```uml\nA --> B\n```\n')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual('<div style="color: red">[uml directive] Diagram too large: more than 50000 bytes</div>', html)
+
+    def test_page_timeout(self):
+        """
+        Verify that when the render budget of a page expires, diagrams are taken from the cache or replaced with
+        an error message
+        """
+        cachedir = os.path.join(self.temp_dir.name, 'cache')
+        os.makedirs(cachedir)
+        with open(os.path.join(cachedir, '%08x.txt' % adler32(b'A --> C\n')), 'wb') as f:
+            f.write(b'cached')
+
+        start = time.monotonic()
+        html = self._markdown(format='txt', plantuml_cmd=self._slow_plantuml(), local_timeout=0, page_timeout=1,
+                              cachedir=cachedir) \
+            .convert('```uml\nA --> B\n```\n\n```uml\nA --> D\n```\n\n```uml\nA --> C\n```\n')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual('<div style="color: red">[uml directive] Timeout rendering the diagram</div>\n\n'
+                         '<div style="color: red">[uml directive] Diagram not rendered: page render budget '
+                         'exhausted</div>\n\n'
+                         '<pre><code class="text">cached</code></pre>', html)
+
+    def test_stale_while_revalidate(self):
+        """
+        Verify that the previous output of a changed block is served, while the new one is rendered in background
+        """
+        config = {'stale_while_revalidate': True, 'format': 'txt', 'title': 'stale test'}
+        text = 'Some text\n\n```uml\nA --> B\n```\n'
+        html, rendered = self._convert(text, b'first', **config)
+        self.assertEqual(('<p>Some text</p>\n<pre><code class="text">first</code></pre>', 1), (html, rendered))
+
+        md = self._markdown(**config)
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image',
+                               return_value=(b'second', None)) as renderer:
+            html = md.convert(text.replace('A --> B', 'A --> C'))
+            StaleOutputs.wait()
+        self.assertEqual('<p>Some text</p>\n<pre><code class="text">first</code></pre>', html)
+        self.assertEqual(1, renderer.call_count)
+
+        html, rendered = self._convert(text.replace('A --> B', 'A --> C'), b'third', **config)
+        self.assertEqual(('<p>Some text</p>\n<pre><code class="text">second</code></pre>', 0), (html, rendered))
+
+        # release builds
+        html, rendered = self._convert(text.replace('A --> B', 'A --> D'), b'fresh', force_fresh=True, **config)
+        self.assertEqual(('<p>Some text</p>\n<pre><code class="text">fresh</code></pre>', 1), (html, rendered))
+
+    def test_stale_while_revalidate_context(self):
+        """
+        Verify that background renders have their own context, without the page render budget
+        """
+        config = {'stale_while_revalidate': True, 'format': 'txt', 'page_timeout': 30}
+        text = '```uml\nA --> B\n```\n'
+        self._convert(text, b'first', **config)
+
+        md = self._markdown(**config)
+        preprocessor = md.preprocessors['plantuml']
+        contexts = []
+
+        def render(*args):
+            contexts.append(preprocessor._context)
+            return b'second', None
+
+        render_diagram = preprocessor._render_diagram
+
+        def render_page_diagram(*args):
+            contexts.append(preprocessor._context)
+            return render_diagram(*args)
+
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', side_effect=render), \
+                mock.patch.object(preprocessor, '_render_diagram', side_effect=render_page_diagram):
+            md.convert(text.replace('A --> B', 'A --> E'))
+            StaleOutputs.wait()
+        page, background = contexts
+        self.assertIsNot(page, background)
+        self.assertIsNotNone(page.deadline)
+        self.assertIsNone(background.deadline)
+
+    def test_stale_while_revalidate_cache(self):
+        """
+        Verify that the previous outputs of blocks are saved in the cache, and served by a new process
+        """
+        config = {'stale_while_revalidate': True, 'format': 'txt', 'cachedir': self.temp_dir.name}
+        text = '```uml id="diagram"\nA --> B\n```\n'
+        self._convert(text, b'first', **config)
+        StaleOutputs._outputs.clear()
+
+        md = self._markdown(**config)
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', return_value=(b'second', None)):
+            html = md.convert(text.replace('A --> B', 'A --> C'))
+            StaleOutputs.wait()
+        self.assertIn('first', html)
+
+    def test_setup_config_file_created(self):
+        """
+        Verify that a missing config file is searched again for the following documents, and that the resolved setups
+        are bounded
+        """
+        config = {'format': 'txt', 'config': 'late.puml', 'base_dir': self.temp_dir.name}
+        html, _ = self._convert('```uml\nA --> B\n```\n', **config)
+        self.assertIn('Could not find config file', html)
+
+        with open(os.path.join(self.temp_dir.name, 'late.puml'), 'w') as f:
+            f.write('skinparam monochrome true\n')
+        html, count = self._convert('```uml\nA --> B\n```\n', **config)
+        self.assertEqual(('<pre><code class="text">rendered</code></pre>', 1), (html, count))
+
+        for n in range(PlantUMLPreprocessor.MAX_SETUPS + 10):
+            self._convert('```uml\nA --> B\n```\n', format='txt', base_dir=f'{self.temp_dir.name}/{n}')
+        self.assertEqual(PlantUMLPreprocessor.MAX_SETUPS, len(PlantUMLPreprocessor._setups))
+
+    def test_concurrent_conversions(self):
+        """
+        Verify that Markdown instances reused by several threads, one per thread or shared by all of them, convert every
+        page as if it was converted alone
+        """
+        pages = [''.join(f'Page {n}, diagram {d}\n\n```uml format="{("txt", "png", "svg")[d % 3]}"\n'
+                         f'A --> B{n}_{d}\n```\n\n' for d in range(5)) for n in range(40)]
+
+        def render(code, img_format, *args):
+            time.sleep(0.001)  # let the threads interleave
+            return code.encode('utf-8') + (b'\n' if img_format == 'txt' else b''), None
+
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', side_effect=render):
+            expected = [self._markdown().convert(page) for page in pages]
+            local = threading.local()
+
+            def convert(page):
+                if not hasattr(local, 'md'):
+                    local.md = self._markdown()
+                return local.md.reset().convert(page)
+
+            with ThreadPoolExecutor(8) as executor:
+                self.assertEqual(expected * 3, list(executor.map(convert, pages * 3)))
+
+            # a single instance shared by all the threads
+            shared = self._markdown()
+            with ThreadPoolExecutor(8) as executor:
+                self.assertEqual(expected * 3, list(executor.map(lambda page: shared.reset().convert(page),
+                                                                 pages * 3)))
+
+    def test_prefetch_other_extensions(self):
+        """
+        Verify that prefetch prepares the documents with the other extensions of the site
+        """
+        config = {'cachedir': self.temp_dir.name, 'format': 'txt'}
+        pages = ['# Page\n\n--8<-- B\n\n--8<-- C\n']
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', return_value=(b'text', None)):
+            extension = PlantUMLMarkdownExtension(**config)
+            self.assertEqual(0, extension.prefetch(pages))
+            self.assertEqual(2, extension.prefetch(pages, extensions=[SnippetExtension(), 'plantuml_markdown']))
+
+        md = markdown.Markdown(extensions=[SnippetExtension(), PlantUMLMarkdownExtension(**config)])
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image') as renderer:
+            md.convert(pages[0])
+            renderer.assert_not_called()
+
+    def test_prefetch(self):
+        """
+        Verify that the diagrams of many documents are rendered into the cache before their conversion, with the same
+        cache keys
+        """
+        config = {'cachedir': self.temp_dir.name, 'format': 'svg'}
+        pages = [f'# Page {n}\r\n\r\n```uml\r\nA -->\tB{n % 5}\r\n```\r\n\r\n```uml format="txt"\nA --> C\n```\n'
+                 for n in range(20)]
+        rendered = []
+
+        def render(code, img_format, *args):
+            rendered.append(code)
+            return b'<svg></svg>' if img_format == 'svg' else b'text', None
+
+        with mock.patch.object(PlantUMLPreprocessor, '_render_local_uml_image', side_effect=render):
+            extension = PlantUMLMarkdownExtension(image_maps=False, **config)
+            self.assertEqual(6, extension.prefetch(pages))
+            self.assertEqual(6, len(rendered))
+            self.assertEqual(0, extension.prefetch(pages))
+
+        html, count = self._convert(pages[7], **config)
+        self.assertEqual(0, count)
+        self.assertIn('<pre><code class="text">text</code></pre>', html)
+        self.assertIn('data:image/svg+xml;base64,PHN2Zz48L3N2Zz4=', html)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import base64
+import contextlib
+import io
+from unittest import TestCase
+
+import markdown
+
+from plantuml_markdown.plantuml_markdown import PlantUMLPreprocessor, RateLimiter, image_size
+from plantuml_markdown.stand_in_server import StandInServer, decode_kroki, decode_plantuml
+
+
+class StandInServerTest(TestCase):
+    """
+    Tests on remote rendering against the stand-in PlantUML/Kroki server.
+    """
+
+    def setUp(self):
+        PlantUMLPreprocessor._server_methods.clear()
+        RateLimiter._limiters.clear()
+
+    def _convert(self, servers, text='```uml\nA --> B\n```\n', **config):
+        md = markdown.Markdown(extensions=['plantuml_markdown'],
+                               extension_configs={'plantuml_markdown': dict(servers=servers, **config)})
+        return md.convert(text)
+
+    def test_decode(self):
+        """
+        Verify that the diagrams encoded by the extension are decoded
+        """
+        source = '@startuml\nA --> B: àè\n@enduml'
+        self.assertEqual(source, decode_plantuml(PlantUMLPreprocessor._deflate_and_encode(source)))
+        self.assertEqual(source, decode_kroki(PlantUMLPreprocessor._compress_and_encode(source)))
+        self.assertEqual('A', decode_plantuml('~h41'))
+
+    def test_plantuml(self):
+        """
+        Verify the rendering with GET and POST, and that images are deterministic
+        """
+        with StandInServer() as server:
+            html = self._convert([server.url], format='svg', image_maps=False)
+            self.assertEqual(html, self._convert([server.url], format='svg', image_maps=False, http_method='POST'))
+            data = base64.b64decode(html.split('base64,')[1].split('"')[0])
+            self.assertTrue(data.startswith(b'<?xml'))
+            self.assertIsNotNone(image_size(data))
+
+            html = self._convert([server.url], text='```uml\nA --> B\nB --> C\n```\n', format='png',
+                                 image_maps=False)
+            self.assertTrue(base64.b64decode(html.split('base64,')[1].split('"')[0]).startswith(b'\x89PNG'))
+            self.assertEqual(3, server.stats['rendered'])
+
+    def test_kroki(self):
+        """
+        Verify the Kroki format, and its diagram errors
+        """
+        with StandInServer(kroki=True) as server:
+            servers = [{'url': server.url, 'kroki': True}]
+            self.assertEqual('<pre><code class="text">A --&gt; B</code></pre>', self._convert(servers, format='txt'))
+            self.assertEqual('<div style="color: red">Syntax Error? unknown arrow</div>',
+                             self._convert(servers, text='```uml\nA -~> B\n!error unknown arrow\n```\n',
+                                           format='txt'))
+            self.assertEqual(1, server.stats['diagram_errors'])
+
+    def test_failover(self):
+        """
+        Verify that broken servers are skipped
+        """
+        with StandInServer(error_rate=1) as failing, StandInServer(drop_rate=1) as dropping, \
+                StandInServer() as server:
+            self.assertEqual('<pre><code class="text">A --&gt; B</code></pre>',
+                             self._convert([failing.url, dropping.url, server.url], format='txt', http_method='POST',
+                                           fallback_to_get=False))
+            self.assertEqual(1, failing.stats['errors'])
+            self.assertEqual(1, dropping.stats['dropped'])
+            self.assertEqual(1, server.stats['rendered'])
+
+    def test_throttling(self):
+        """
+        Verify that a rate limited server answering with 429 is called again, at a slower rate
+        """
+        with StandInServer(throttle_rate=0.5, retry_after=0, seed=1) as server:
+            servers = [{'url': server.url, 'rate': 50}]
+            for n in range(5):
+                self.assertEqual(f'<pre><code class="text">A --&gt; B{n}</code></pre>',
+                                 self._convert(servers, text=f'```uml\nA --> B{n}\n```\n', format='txt'))
+            self.assertEqual(5, server.stats['rendered'])
+            self.assertGreater(server.stats['throttled'], 0)
+
+    def test_client_gone(self):
+        """
+        Verify that clients going away before the answer do not print tracebacks
+        """
+        with StandInServer() as server, contextlib.redirect_stderr(io.StringIO()) as stderr:
+            for exc in (BrokenPipeError(), ConnectionResetError()):
+                try:
+                    raise exc
+                except ConnectionError:
+                    server._httpd.handle_error(None, ('127.0.0.1', 12345))
+        self.assertEqual('', stderr.getvalue())